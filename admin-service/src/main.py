@@ -1,7 +1,7 @@
 from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Numeric
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Numeric, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from jose import JWTError, jwt
@@ -11,6 +11,8 @@ from typing import List, Optional
 import os
 import httpx
 
+from shared.jwks import TokenVerifier
+
 app = FastAPI(title="Admin Service", version="1.0.0")
 
 # CORS configuration
@@ -31,9 +33,13 @@ Base = declarative_base()
 # Security
 security = HTTPBearer()
 AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth-service:8000")
+INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "your-internal-api-key-change-in-production")
 NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "http://notification-service:8000")
+PAYMENT_SERVICE_URL = os.getenv("PAYMENT_SERVICE_URL", "http://payment-service:8000")
 JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-jwt-key-change-in-production")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWKS_URL = os.getenv("JWKS_URL", f"{AUTH_SERVICE_URL}/.well-known/jwks.json")
+token_verifier = TokenVerifier(JWT_ALGORITHM, JWT_SECRET, JWKS_URL)
 
 
 # Pydantic Models
@@ -76,6 +82,7 @@ class FlightResponse(BaseModel):
     total_seats: int
     available_seats: int
     price: float
+    status: str = "scheduled"
     created_at: datetime
 
     class Config:
@@ -90,6 +97,11 @@ class StatisticsResponse(BaseModel):
 
 
 # Helper functions
+@app.on_event("startup")
+async def load_jwks():
+    await token_verifier.load()
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -98,46 +110,38 @@ def get_db():
         db.close()
 
 
-async def verify_admin_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    """Verify JWT token and check if user is admin"""
+async def verify_admin_token(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db)
+) -> dict:
+    """Verify JWT token locally, then check admin rights in users.
+    
+    The is_admin claim is not trusted here: it lives as long as the token,
+    so revoking admin rights would not take effect until it expires.
+    """
     try:
-        token = credentials.credentials
-        
-        # Verify token with auth service
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{AUTH_SERVICE_URL}/verify",
-                headers={"Authorization": f"Bearer {token}"}
-            )
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Invalid token"
-                )
-            data = response.json()
-            if not data.get("is_admin", False):
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail="Admin access required"
-                )
-            return {"user_id": data["user_id"]}
-    except httpx.RequestError:
-        # Fallback to local token verification
-        try:
-            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Invalid token"
-                )
-            # Check if user is admin (would need to query DB in production)
-            return {"user_id": user_id}
-        except JWTError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid token"
-            )
+        payload = await token_verifier.decode(credentials.credentials)
+    except JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token"
+        )
+    user_id = payload.get("sub")
+    if user_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token"
+        )
+    is_admin = db.execute(
+        text("SELECT is_admin FROM users WHERE id = :user_id"),
+        {"user_id": int(user_id)}
+    ).scalar()
+    if not is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return {"user_id": int(user_id)}
 
 
 # Routes - Airlines
@@ -424,7 +428,7 @@ async def get_flights(
     result = db.execute(
         text("""
             SELECT id, airline_id, flight_number, origin, destination,
-                   departure_time, arrival_time, total_seats, available_seats, price, created_at
+                   departure_time, arrival_time, total_seats, available_seats, price, created_at, status
             FROM flights
             ORDER BY departure_time DESC
         """)
@@ -443,7 +447,8 @@ async def get_flights(
             total_seats=row[7],
             available_seats=row[8],
             price=float(row[9]),
-            created_at=row[10]
+            created_at=row[10],
+            status=row[11]
         ))
     return flights
 
@@ -452,14 +457,18 @@ async def get_flights(
 async def delete_flight(
     flight_id: int,
     admin_info: dict = Depends(verify_admin_token),
+    credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
 ):
-    """Delete a flight"""
+    """Cancel a flight: refund its payments and cancel its bookings.
+    
+    The flight row is kept (status 'cancelled'): deleting it would cascade
+    to bookings and payments and drop the refund records.
+    """
     from sqlalchemy import text
     
-    # Get flight info before deletion for notification
     flight_result = db.execute(
-        text("SELECT id, flight_number FROM flights WHERE id = :flight_id"),
+        text("SELECT id, flight_number, status FROM flights WHERE id = :flight_id"),
         {"flight_id": flight_id}
     )
     flight_row = flight_result.fetchone()
@@ -469,15 +478,36 @@ async def delete_flight(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Flight not found"
         )
+    if flight_row[2] == "cancelled":
+        return None
+    
+    # Возвращаем деньги (незавершенные платежи отменяются) до отмены рейса:
+    # без успешного возврата рейс не отменяем
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                f"{PAYMENT_SERVICE_URL}/admin/flights/{flight_id}/refunds",
+                headers={"Authorization": f"Bearer {credentials.credentials}"},
+                timeout=60.0
+            )
+            response.raise_for_status()
+            refunds = response.json()
+            print(f"Refunded {refunds['refunded']} and cancelled {refunds['cancelled']} payments for flight {flight_row[1]}")
+    except Exception as e:
+        print(f"Failed to refund payments for flight {flight_id}: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Failed to refund payments, flight was not cancelled"
+        )
     
-    # Delete flight
+    # Снимаем рейс с продажи
     db.execute(
-        text("DELETE FROM flights WHERE id = :flight_id"),
+        text("UPDATE flights SET status = 'cancelled', available_seats = 0 WHERE id = :flight_id"),
         {"flight_id": flight_id}
     )
     db.commit()
     
-    # Send email notification to all users with bookings for this flight
+    # Уведомление ищет подтвержденные бронирования, поэтому отправляется до их отмены
     try:
         async with httpx.AsyncClient() as client:
             await client.post(
@@ -490,7 +520,13 @@ async def delete_flight(
             )
     except Exception as e:
         print(f"Failed to send flight cancellation notification: {e}")
-        # Don't fail the deletion if notification fails
+        # Don't fail the cancellation if notification fails
+    
+    db.execute(
+        text("UPDATE bookings SET status = 'cancelled' WHERE flight_id = :flight_id AND status <> 'cancelled'"),
+        {"flight_id": flight_id}
+    )
+    db.commit()
     
     return None
 
@@ -653,6 +689,28 @@ async def update_client(
     )
     row = result.fetchone()
     
+    # Drop the cached profile in auth-service so /me and /verify see the change
+    try:
+        async with httpx.AsyncClient() as client:
+            await client.post(
+                f"{AUTH_SERVICE_URL}/internal/users/{client_id}/invalidate",
+                headers={"X-Internal-Key": INTERNAL_API_KEY},
+                timeout=5.0
+            )
+    except Exception as e:
+        print(f"Failed to invalidate auth profile cache: {e}")
+    
+    # Receipts in payment-service carry the client's name and contacts
+    try:
+        async with httpx.AsyncClient() as client:
+            await client.post(
+                f"{PAYMENT_SERVICE_URL}/internal/users/{client_id}/receipts/invalidate",
+                headers={"X-Internal-Key": INTERNAL_API_KEY},
+                timeout=5.0
+            )
+    except Exception as e:
+        print(f"Failed to invalidate payment receipts: {e}")
+    
     # Send email notification to client about profile update
     try:
         async with httpx.AsyncClient() as client:
@@ -14,6 +14,8 @@ IS_CI = os.getenv("CI") == "true" or os.getenv("GITHUB_ACTIONS") == "true"
 
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# Add repository root to path (shared helpers)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
 from main import app, get_db, Base
 
@@ -89,6 +91,7 @@ def db():
                 total_seats INTEGER,
                 available_seats INTEGER,
                 price REAL,
+                status TEXT DEFAULT 'scheduled',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """))
@@ -173,6 +176,28 @@ def admin_token():
     return jwt.encode(data, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 
+class TestAdminCheck:
+    """Test that admin rights come from users, not from the token claim"""
+    
+    def test_admin_rights_read_from_database(self, db, admin_token):
+        import asyncio
+        from fastapi import HTTPException
+        from fastapi.security import HTTPAuthorizationCredentials
+        from main import verify_admin_token
+        
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=admin_token)
+        db.execute(text("INSERT INTO users (id, email, first_name, last_name, is_admin) VALUES (1, 'a@x.com', 'A', 'B', 0)"))
+        db.commit()
+        # Права сняты после выдачи токена - утверждение is_admin в нем не учитывается
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(verify_admin_token(credentials, db))
+        assert exc.value.status_code == 403
+        
+        db.execute(text("UPDATE users SET is_admin = 1 WHERE id = 1"))
+        db.commit()
+        assert asyncio.run(verify_admin_token(credentials, db)) == {"user_id": 1}
+
+
 class TestAirlines:
     """Test airline management endpoints"""
     
@@ -267,6 +292,47 @@ class TestFlights:
         assert data["flight_number"] == "FL001"
 
 
+class TestFlightCancellation:
+    """Test that deleting a flight cancels it instead of dropping its rows"""
+    
+    def test_delete_flight_keeps_rows(self, client, admin_token, db):
+        db.execute(text("""
+            INSERT INTO flights (id, flight_number, total_seats, available_seats, price)
+            VALUES (1, 'FL001', 100, 99, 100)
+        """))
+        db.execute(text("INSERT INTO bookings (id, user_id, flight_id, status) VALUES (1, 1, 1, 'confirmed')"))
+        db.commit()
+        calls = []
+        
+        class FakeResponse:
+            def raise_for_status(self):
+                pass
+            
+            def json(self):
+                return {"refunded": 1, "cancelled": 0}
+        
+        class FakeClient:
+            async def __aenter__(self):
+                return self
+            
+            async def __aexit__(self, *args):
+                pass
+            
+            async def post(self, url, **kwargs):
+                calls.append(url)
+                return FakeResponse()
+        
+        with patch("main.httpx.AsyncClient", FakeClient):
+            response = client.delete("/flights/1", headers={"Authorization": f"Bearer {admin_token}"})
+        
+        assert response.status_code == 204
+        assert calls[0].endswith("/admin/flights/1/refunds")
+        assert calls[1].endswith("/notify-flight-change")
+        flight = db.execute(text("SELECT status, available_seats FROM flights WHERE id = 1")).fetchone()
+        assert tuple(flight) == ("cancelled", 0)
+        assert db.execute(text("SELECT status FROM bookings WHERE id = 1")).scalar() == "cancelled"
+
+
 class TestStatistics:
     """Test statistics endpoint"""
     
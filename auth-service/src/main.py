@@ -1,15 +1,27 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from passlib.context import CryptContext
-from jose import JWTError, jwt
+from jose import JWTError, jwt, jwk
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
 from datetime import datetime, timedelta
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import List, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import csv
+import hashlib
+import hmac
+import io
+import json
 import os
+import time
+import httpx
 
 app = FastAPI(title="Auth Service", version="1.0.0")
 
@@ -29,12 +41,82 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Новые хеши создаются схемой PASSWORD_HASH_SCHEME; хеши другой схемы или
+# с другими параметрами стоимости перехешируются при успешном входе.
+# Параметры подбираются под железо скриптом scripts/calibrate_password_hashing.py
+PASSWORD_HASH_SCHEME = os.getenv("PASSWORD_HASH_SCHEME", "argon2")
+pwd_context = CryptContext(
+    schemes=[PASSWORD_HASH_SCHEME] + [s for s in ("argon2", "bcrypt") if s != PASSWORD_HASH_SCHEME],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__time_cost=int(os.getenv("ARGON2_TIME_COST", "3")),
+    argon2__memory_cost=int(os.getenv("ARGON2_MEMORY_COST", "65536")),
+    argon2__parallelism=int(os.getenv("ARGON2_PARALLELISM", "4")),
+    bcrypt__rounds=int(os.getenv("BCRYPT_ROUNDS", "12")),
+)
 security = HTTPBearer()
 
 JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-jwt-key-change-in-production")
+# Ключ для служебных вызовов других сервисов (сброс кеша профилей, метрики)
+INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "your-internal-api-key-change-in-production")
+# payment-service кеширует квитанции с контактами пользователя
+PAYMENT_SERVICE_URL = os.getenv("PAYMENT_SERVICE_URL", "http://payment-service:8000")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 JWT_EXPIRATION_HOURS = 24
+# Асимметричная подпись (RS256): приватные ключи <kid>.pem лежат в JWT_KEYS_DIR,
+# публичные ключи всех файлов публикуются в /.well-known/jwks.json.
+# Активный ключ - JWT_ACTIVE_KID или последний по имени файла
+# Остальные сервисы проверяют токены локально по этому набору (shared/jwks.py)
+# и перечитывают его, встретив неизвестный kid, - так проходит ротация ключей.
+ASYMMETRIC_JWT = JWT_ALGORITHM.startswith("RS")
+JWT_KEYS_DIR = os.getenv("JWT_KEYS_DIR", "")
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID", "")
+
+# Пул для хеширования паролей: bcrypt отпускает GIL, поэтому потоки
+# хешируют параллельно и не блокируют event loop
+HASH_POOL_WORKERS = int(os.getenv("HASH_POOL_WORKERS", str(os.cpu_count() or 2)))
+hash_pool = ThreadPoolExecutor(max_workers=HASH_POOL_WORKERS, thread_name_prefix="pwd-hash")
+
+# Кэш профилей для /me и /verify (в памяти процесса)
+PROFILE_CACHE_TTL_SECONDS = int(os.getenv("PROFILE_CACHE_TTL_SECONDS", "300"))
+PROFILE_CACHE_MAX_ENTRIES = int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "10000"))
+
+
+def generate_private_key_pem() -> str:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode()
+
+
+def load_signing_keys() -> dict:
+    """Load private keys (kid -> PEM); creates one if the directory is empty"""
+    keys = {}
+    if JWT_KEYS_DIR and os.path.isdir(JWT_KEYS_DIR):
+        for name in sorted(os.listdir(JWT_KEYS_DIR)):
+            if name.endswith(".pem"):
+                with open(os.path.join(JWT_KEYS_DIR, name)) as f:
+                    keys[name[:-len(".pem")]] = f.read()
+    if not keys:
+        kid = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        keys[kid] = generate_private_key_pem()
+        if JWT_KEYS_DIR:
+            os.makedirs(JWT_KEYS_DIR, exist_ok=True)
+            with open(os.path.join(JWT_KEYS_DIR, f"{kid}.pem"), "w") as f:
+                f.write(keys[kid])
+        else:
+            print("JWT_KEYS_DIR not set - using an ephemeral signing key")
+    return keys
+
+
+signing_keys = load_signing_keys() if ASYMMETRIC_JWT else {}
+active_kid = JWT_ACTIVE_KID or (max(signing_keys) if signing_keys else "")
+public_jwks = {
+    kid: {**jwk.construct(pem, JWT_ALGORITHM).public_key().to_dict(), "kid": kid, "use": "sig"}
+    for kid, pem in signing_keys.items()
+}
 
 
 # Database Models
@@ -90,6 +172,97 @@ class TokenResponse(BaseModel):
     user: UserResponse
 
 
+class UserImport(BaseModel):
+    email: EmailStr
+    first_name: str
+    last_name: str
+    phone: Optional[str] = None
+    is_admin: bool = False
+    # Either a plaintext password to hash, or a hash migrated as-is
+    password: Optional[str] = None
+    password_hash: Optional[str] = None
+
+
+class UserImportResponse(BaseModel):
+    received: int
+    imported: int
+    skipped: int
+
+
+class ProfileCacheEntry:
+    __slots__ = ("body", "etag", "is_admin", "expires_at")
+
+    def __init__(self, body: bytes, etag: str, is_admin: bool, expires_at: float):
+        self.body = body
+        self.etag = etag
+        self.is_admin = is_admin
+        self.expires_at = expires_at
+
+
+class ProfileCache:
+    """LRU cache of serialized user profiles keyed by user_id.
+    
+    Entries are dropped on profile updates (locally or via the internal
+    invalidation endpoint used by admin-service) and expire after a TTL
+    as a safety net for missed invalidations.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[int, ProfileCacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int) -> Optional[ProfileCacheEntry]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry.expires_at < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry
+
+    def put(self, user: "UserResponse") -> ProfileCacheEntry:
+        body = json.dumps(user.model_dump(mode="json"), separators=(",", ":")).encode()
+        entry = ProfileCacheEntry(
+            body=body,
+            etag='"' + hashlib.sha1(body).hexdigest() + '"',
+            is_admin=user.is_admin,
+            expires_at=time.monotonic() + self.ttl_seconds
+        )
+        self._entries[user.id] = entry
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, user_id: int):
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+        }
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_MAX_ENTRIES, PROFILE_CACHE_TTL_SECONDS)
+
+
 # Helper functions
 def get_db():
     db = SessionLocal()
@@ -107,6 +280,84 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+def verify_and_update_password(plain_password: str, hashed_password: str):
+    """Verify a password; also returns a new hash if the stored one is outdated"""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+async def hash_passwords(passwords: List[str]) -> List[str]:
+    """Hash passwords in parallel on the hashing pool"""
+    loop = asyncio.get_running_loop()
+    return list(await asyncio.gather(
+        *(loop.run_in_executor(hash_pool, get_password_hash, p) for p in passwords)
+    ))
+
+
+USER_COLUMNS = "id, email, first_name, last_name, phone, is_admin, created_at"
+
+
+def insert_user(db: Session, values: dict):
+    """Insert a user in one statement; returns None if the email is taken"""
+    result = db.execute(
+        text(f"""
+            INSERT INTO users (email, password_hash, first_name, last_name, phone, is_admin, created_at)
+            VALUES (:email, :password_hash, :first_name, :last_name, :phone, :is_admin, :created_at)
+            ON CONFLICT (email) DO NOTHING
+            RETURNING {USER_COLUMNS}
+        """),
+        values
+    )
+    return result.fetchone()
+
+
+def copy_users(db: Session, rows: List[dict]) -> int:
+    """Bulk-insert users, skipping existing emails; returns inserted count"""
+    columns = ["email", "password_hash", "first_name", "last_name", "phone", "is_admin", "created_at"]
+    if db.bind.dialect.name != "postgresql":
+        # No COPY outside PostgreSQL (e.g. SQLite in tests) - plain executemany
+        result = db.execute(
+            text(f"""
+                INSERT INTO users ({', '.join(columns)})
+                VALUES ({', '.join(':' + c for c in columns)})
+                ON CONFLICT (email) DO NOTHING
+            """),
+            rows
+        )
+        return result.rowcount
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["" if row[c] is None else row[c] for c in columns])
+    buffer.seek(0)
+
+    db.execute(text("""
+        CREATE TEMP TABLE users_import_staging (
+            email VARCHAR(255),
+            password_hash VARCHAR(255),
+            first_name VARCHAR(100),
+            last_name VARCHAR(100),
+            phone VARCHAR(20),
+            is_admin BOOLEAN,
+            created_at TIMESTAMP
+        ) ON COMMIT DROP
+    """))
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY users_import_staging ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+    finally:
+        cursor.close()
+    result = db.execute(text(f"""
+        INSERT INTO users ({', '.join(columns)})
+        SELECT {', '.join(columns)} FROM users_import_staging
+        ON CONFLICT (email) DO NOTHING
+    """))
+    return result.rowcount
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -114,14 +365,27 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS)
     to_encode.update({"exp": expire})
+    if ASYMMETRIC_JWT:
+        return jwt.encode(
+            to_encode, signing_keys[active_kid], algorithm=JWT_ALGORITHM, headers={"kid": active_kid}
+        )
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
+def decode_access_token(token: str) -> dict:
+    if ASYMMETRIC_JWT:
+        key = public_jwks.get(jwt.get_unverified_header(token).get("kid"))
+        if key is None:
+            raise JWTError("Unknown signing key")
+        return jwt.decode(token, key, algorithms=[JWT_ALGORITHM])
+    return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+
+
+async def get_token_user_id(
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+) -> int:
+    """Decode the JWT and return the user id without touching the database"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -129,48 +393,109 @@ async def get_current_user(
     )
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = decode_access_token(token)
         user_id_raw = payload.get("sub")
         if user_id_raw is None:
             raise credentials_exception
         # Конвертируем user_id в int (может быть строкой или числом)
-        user_id: int = int(user_id_raw) if isinstance(user_id_raw, str) else user_id_raw
+        return int(user_id_raw) if isinstance(user_id_raw, str) else user_id_raw
     except (JWTError, ValueError, TypeError):
         raise credentials_exception
-    
+
+
+async def get_current_user(
+    user_id: int = Depends(get_token_user_id),
+    db: Session = Depends(get_db)
+) -> User:
     user = db.query(User).filter(User.id == user_id).first()
     if user is None:
-        raise credentials_exception
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
 
 
+def get_cached_profile(db: Session, user_id: int) -> ProfileCacheEntry:
+    """Return the cached profile entry, loading it from the database on a miss"""
+    entry = profile_cache.get(user_id)
+    if entry is not None:
+        return entry
+    user = db.query(User).filter(User.id == user_id).first()
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return profile_cache.put(user_to_response(user))
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(
+        (tag[2:] if tag.startswith("W/") else tag) == etag for tag in candidates
+    )
+
+
+def user_to_response(user: User) -> UserResponse:
+    return UserResponse(
+        id=user.id,
+        email=user.email,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        phone=user.phone,
+        is_admin=user.is_admin,
+        created_at=user.created_at
+    )
+
+
+async def get_current_admin(current_user: User = Depends(get_current_user)) -> User:
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return current_user
+
+
+def verify_internal(x_internal_key: Optional[str] = Header(None)):
+    if x_internal_key is None or not hmac.compare_digest(x_internal_key, INTERNAL_API_KEY):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid internal key"
+        )
+
+
 # Routes
 @app.post("/register", response_model=TokenResponse, status_code=status.HTTP_201_CREATED)
 async def register(user_data: UserRegister, db: Session = Depends(get_db)):
-    # Check if user already exists
-    existing_user = db.query(User).filter(User.email == user_data.email).first()
-    if existing_user:
+    hashed_password = (await hash_passwords([user_data.password]))[0]
+    
+    # Single INSERT ... ON CONFLICT: no pre-check SELECT and no race on the unique email
+    new_user = insert_user(db, {
+        "email": user_data.email,
+        "password_hash": hashed_password,
+        "first_name": user_data.first_name,
+        "last_name": user_data.last_name,
+        "phone": user_data.phone,
+        "is_admin": False,
+        "created_at": datetime.utcnow()
+    })
+    if new_user is None:
+        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
-    
-    # Create new user
-    hashed_password = get_password_hash(user_data.password)
-    new_user = User(
-        email=user_data.email,
-        password_hash=hashed_password,
-        first_name=user_data.first_name,
-        last_name=user_data.last_name,
-        phone=user_data.phone,
-        is_admin=False
-    )
-    db.add(new_user)
     db.commit()
-    db.refresh(new_user)
     
     # Create access token (user_id as string for JWT compatibility)
-    access_token = create_access_token(data={"sub": str(new_user.id)})
+    access_token = create_access_token(data={"sub": str(new_user.id), "is_admin": bool(new_user.is_admin)})
     
     return TokenResponse(
         access_token=access_token,
@@ -181,7 +506,7 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
             first_name=new_user.first_name,
             last_name=new_user.last_name,
             phone=new_user.phone,
-            is_admin=new_user.is_admin
+            is_admin=bool(new_user.is_admin)
         )
     )
 
@@ -189,13 +514,24 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
 @app.post("/login", response_model=TokenResponse)
 async def login(credentials: UserLogin, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.email == credentials.email).first()
-    if not user or not verify_password(credentials.password, user.password_hash):
+    valid, new_hash = False, None
+    if user:
+        loop = asyncio.get_running_loop()
+        valid, new_hash = await loop.run_in_executor(
+            hash_pool, verify_and_update_password, credentials.password, user.password_hash
+        )
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
         )
     
-    access_token = create_access_token(data={"sub": str(user.id)})
+    # Transparent migration to the current scheme / cost parameters
+    if new_hash:
+        user.password_hash = new_hash
+        db.commit()
+    
+    access_token = create_access_token(data={"sub": str(user.id), "is_admin": bool(user.is_admin)})
     
     return TokenResponse(
         access_token=access_token,
@@ -212,16 +548,30 @@ async def login(credentials: UserLogin, db: Session = Depends(get_db)):
 
 
 @app.get("/me", response_model=UserResponse)
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
-    return UserResponse(
-        id=current_user.id,
-        email=current_user.email,
-        first_name=current_user.first_name,
-        last_name=current_user.last_name,
-        phone=current_user.phone,
-        is_admin=current_user.is_admin,
-        created_at=current_user.created_at
-    )
+async def get_current_user_info(
+    request: Request,
+    user_id: int = Depends(get_token_user_id),
+    db: Session = Depends(get_db)
+):
+    entry = get_cached_profile(db, user_id)
+    headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, entry.etag):
+        profile_cache.not_modified += 1
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+async def invalidate_receipts(user_id: int):
+    """Drop the user's cached receipts in payment-service so they show the new contacts"""
+    try:
+        async with httpx.AsyncClient() as client:
+            await client.post(
+                f"{PAYMENT_SERVICE_URL}/internal/users/{user_id}/receipts/invalidate",
+                headers={"X-Internal-Key": INTERNAL_API_KEY},
+                timeout=5.0
+            )
+    except Exception as e:
+        print(f"Failed to invalidate payment receipts: {e}")
 
 
 @app.put("/profile", response_model=TokenResponse)
@@ -240,9 +590,11 @@ async def update_profile(
     
     db.commit()
     db.refresh(current_user)
+    profile_cache.invalidate(current_user.id)
+    await invalidate_receipts(current_user.id)
     
     # Generate new token (user_id as string for JWT compatibility)
-    access_token = create_access_token(data={"sub": str(current_user.id)})
+    access_token = create_access_token(data={"sub": str(current_user.id), "is_admin": bool(current_user.is_admin)})
     
     return TokenResponse(
         access_token=access_token,
@@ -260,8 +612,113 @@ async def update_profile(
 
 
 @app.get("/verify")
-async def verify_token(current_user: User = Depends(get_current_user)):
-    return {"valid": True, "user_id": current_user.id, "is_admin": current_user.is_admin}
+async def verify_token(
+    request: Request,
+    user_id: int = Depends(get_token_user_id),
+    db: Session = Depends(get_db)
+):
+    entry = get_cached_profile(db, user_id)
+    headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, entry.etag):
+        profile_cache.not_modified += 1
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(
+        content=json.dumps({"valid": True, "user_id": user_id, "is_admin": entry.is_admin}),
+        media_type="application/json",
+        headers=headers
+    )
+
+
+@app.post("/internal/users/{user_id}/invalidate", status_code=status.HTTP_204_NO_CONTENT,
+          dependencies=[Depends(verify_internal)])
+async def invalidate_user_cache(user_id: int):
+    """Drop a cached profile (internal service endpoint, called after admin edits)"""
+    profile_cache.invalidate(user_id)
+    return None
+
+
+@app.get("/.well-known/jwks.json")
+async def get_jwks():
+    """Public signing keys for local token verification in other services"""
+    return Response(
+        content=json.dumps({"keys": list(public_jwks.values())}),
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=300"}
+    )
+
+
+@app.get("/metrics", dependencies=[Depends(verify_internal)])
+async def get_metrics():
+    return {"profile_cache": profile_cache.stats()}
+
+
+@app.post("/admin/users/import", response_model=UserImportResponse)
+async def import_users(
+    users: List[UserImport],
+    admin: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """Bulk-import users (e.g. migrating an existing customer base)"""
+    # Last record wins for duplicate emails inside one batch
+    by_email = {u.email: u for u in users}
+    for u in by_email.values():
+        if not u.password and not u.password_hash:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Password or password_hash required for {u.email}"
+            )
+        # Хеш неизвестной схемы не проверить при входе (verify_and_update падает)
+        if u.password_hash and not pwd_context.identify(u.password_hash):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unrecognized password_hash format for {u.email}"
+            )
+    
+    to_hash = [u for u in by_email.values() if not u.password_hash]
+    hashes = dict(zip(
+        (u.email for u in to_hash),
+        await hash_passwords([u.password for u in to_hash])
+    ))
+    
+    now = datetime.utcnow()
+    rows = [
+        {
+            "email": u.email,
+            "password_hash": u.password_hash or hashes[u.email],
+            "first_name": u.first_name,
+            "last_name": u.last_name,
+            "phone": u.phone,
+            "is_admin": u.is_admin,
+            "created_at": now
+        }
+        for u in by_email.values()
+    ]
+    imported = copy_users(db, rows) if rows else 0
+    db.commit()
+    
+    return UserImportResponse(
+        received=len(users),
+        imported=imported,
+        skipped=len(users) - imported
+    )
+
+
+@app.delete("/admin/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_user(
+    user_id: int,
+    admin: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """Delete a user; the cached profile goes too, so /verify stops accepting their tokens"""
+    deleted = db.execute(text("DELETE FROM users WHERE id = :user_id"), {"user_id": user_id}).rowcount
+    db.commit()
+    profile_cache.invalidate(user_id)
+    if not deleted:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    return None
 
 
 @app.get("/health")
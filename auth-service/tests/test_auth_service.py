@@ -9,7 +9,9 @@ import os
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from main import app, get_db, Base, get_password_hash, verify_password, create_access_token
+import main
+from main import app, get_db, Base, User, get_password_hash, verify_password, create_access_token, profile_cache
+from passlib.hash import bcrypt
 from datetime import timedelta
 
 # Create in-memory SQLite database for testing
@@ -53,6 +55,7 @@ def client(db):
             pass
     
     app.dependency_overrides[get_db] = override_get_db
+    profile_cache.clear()
     with TestClient(app) as test_client:
         yield test_client
     app.dependency_overrides.clear()
@@ -90,6 +93,10 @@ class TestPasswordHashing:
         password = "testpassword123"
         hashed = get_password_hash(password)
         assert verify_password("wrongpassword", hashed) is False
+    
+    def test_hash_password_argon2id(self):
+        """Test that new hashes use argon2id"""
+        assert get_password_hash("testpassword123").startswith("$argon2id$")
 
 
 class TestJWTToken:
@@ -181,6 +188,21 @@ class TestUserLogin:
         assert response.status_code == 401
         assert "incorrect" in response.json()["detail"].lower()
     
+    def test_login_rehashes_legacy_password(self, client, db, test_user_data):
+        """Test that a legacy bcrypt hash is upgraded on successful login"""
+        client.post("/register", json=test_user_data)
+        user = db.query(User).filter(User.email == test_user_data["email"]).first()
+        user.password_hash = bcrypt.using(rounds=4).hash(test_user_data["password"])
+        db.commit()
+        
+        response = client.post("/login", json={
+            "email": test_user_data["email"],
+            "password": test_user_data["password"]
+        })
+        assert response.status_code == 200
+        db.refresh(user)
+        assert user.password_hash.startswith("$argon2id$")
+    
     def test_login_nonexistent_user(self, client):
         """Test login with non-existent user"""
         login_data = {
@@ -249,6 +271,68 @@ class TestUserProfile:
         assert "access_token" in data
 
 
+class TestProfileCache:
+    """Test cached /me and /verify with conditional requests"""
+    
+    def test_me_not_modified(self, client, test_user_data):
+        """Test that a matching If-None-Match returns 304"""
+        token = client.post("/register", json=test_user_data).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        
+        first = client.get("/me", headers=headers)
+        assert first.status_code == 200
+        etag = first.headers["etag"]
+        
+        second = client.get("/me", headers={**headers, "If-None-Match": etag})
+        assert second.status_code == 304
+        assert second.content == b""
+        
+        stats = client.get("/metrics", headers={"X-Internal-Key": main.INTERNAL_API_KEY}).json()["profile_cache"]
+        assert stats["hits"] >= 1
+        assert stats["not_modified"] == 1
+    
+    def test_update_profile_invalidates_cache(self, client, test_user_data):
+        """Test that a profile update changes the cached /me response"""
+        token = client.post("/register", json=test_user_data).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        etag = client.get("/me", headers=headers).headers["etag"]
+        
+        client.put("/profile", json={"first_name": "Changed"}, headers=headers)
+        
+        response = client.get("/me", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["first_name"] == "Changed"
+        assert response.headers["etag"] != etag
+    
+    def test_internal_invalidate(self, client, db, test_user_data):
+        """Test that the internal endpoint drops a cached profile"""
+        token = client.post("/register", json=test_user_data).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        client.get("/me", headers=headers)
+        
+        db.query(User).update({"last_name": "Edited"})
+        db.commit()
+        assert client.post("/internal/users/1/invalidate").status_code == 401
+        assert client.get("/me", headers=headers).json()["last_name"] != "Edited"
+        response = client.post("/internal/users/1/invalidate", headers={"X-Internal-Key": main.INTERNAL_API_KEY})
+        assert response.status_code == 204
+        
+        assert client.get("/me", headers=headers).json()["last_name"] == "Edited"
+    
+    def test_deleted_user_stops_verifying(self, client, db, test_user_data):
+        """Test that deleting a user drops the cached profile behind /verify"""
+        token = client.post("/register", json=test_user_data).json()["access_token"]
+        other = client.post("/register", json={**test_user_data, "email": "admin@example.com"}).json()
+        db.query(User).filter(User.email == "admin@example.com").update({"is_admin": True})
+        db.commit()
+        headers = {"Authorization": f"Bearer {token}"}
+        assert client.get("/verify", headers=headers).status_code == 200
+        
+        response = client.delete("/admin/users/1", headers={"Authorization": f"Bearer {other['access_token']}"})
+        assert response.status_code == 204
+        assert client.get("/verify", headers=headers).status_code in (401, 404)
+
+
 class TestTokenVerification:
     """Test token verification endpoints"""
     
@@ -277,6 +361,93 @@ class TestTokenVerification:
         assert response.status_code == 401
 
 
+class TestUserImport:
+    """Test bulk user import endpoint"""
+    
+    def _admin_token(self, client, db, test_user_data):
+        register_response = client.post("/register", json=test_user_data)
+        db.query(User).filter(User.email == test_user_data["email"]).update({"is_admin": True})
+        db.commit()
+        return register_response.json()["access_token"]
+    
+    def test_import_users(self, client, db, test_user_data):
+        """Test importing new users, skipping existing emails"""
+        token = self._admin_token(client, db, test_user_data)
+        users = [
+            {"email": "a@example.com", "password": "secret-a", "first_name": "A", "last_name": "One"},
+            {"email": "b@example.com", "password_hash": get_password_hash("secret-b"),
+             "first_name": "B", "last_name": "Two"},
+            {"email": test_user_data["email"], "password": "x", "first_name": "Dup", "last_name": "User"},
+        ]
+        response = client.post(
+            "/admin/users/import",
+            json=users,
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 200
+        assert response.json() == {"received": 3, "imported": 2, "skipped": 1}
+        
+        login_response = client.post("/login", json={"email": "a@example.com", "password": "secret-a"})
+        assert login_response.status_code == 200
+        login_response = client.post("/login", json={"email": "b@example.com", "password": "secret-b"})
+        assert login_response.status_code == 200
+    
+    def test_import_rejects_unknown_hash(self, client, db, test_user_data):
+        """Test that a hash no configured scheme recognizes is rejected up front"""
+        token = self._admin_token(client, db, test_user_data)
+        users = [{"email": "c@example.com", "password_hash": "md5$abc", "first_name": "C", "last_name": "Three"}]
+        response = client.post(
+            "/admin/users/import",
+            json=users,
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 400
+        assert "c@example.com" in response.json()["detail"]
+    
+    def test_import_users_requires_admin(self, client, test_user_data):
+        """Test that non-admin users cannot import"""
+        token = client.post("/register", json=test_user_data).json()["access_token"]
+        response = client.post(
+            "/admin/users/import",
+            json=[],
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 403
+
+
+class TestAsymmetricSigning:
+    """Test RS256 signing and the JWKS endpoint"""
+    
+    @pytest.fixture
+    def rs256(self, monkeypatch):
+        import main
+        from jose import jwk
+        pem = main.generate_private_key_pem()
+        monkeypatch.setattr(main, "JWT_ALGORITHM", "RS256")
+        monkeypatch.setattr(main, "ASYMMETRIC_JWT", True)
+        monkeypatch.setattr(main, "signing_keys", {"k1": pem})
+        monkeypatch.setattr(main, "active_kid", "k1")
+        monkeypatch.setattr(main, "public_jwks", {
+            "k1": {**jwk.construct(pem, "RS256").public_key().to_dict(), "kid": "k1", "use": "sig"}
+        })
+    
+    def test_jwks_and_local_verification(self, client, rs256, test_user_data):
+        """Test that tokens carry a kid that verifies against the published JWKS"""
+        from jose import jwt
+        token = client.post("/register", json=test_user_data).json()["access_token"]
+        assert jwt.get_unverified_header(token)["kid"] == "k1"
+        
+        keys = client.get("/.well-known/jwks.json").json()["keys"]
+        assert len(keys) == 1 and keys[0]["kid"] == "k1" and "d" not in keys[0]
+        
+        payload = jwt.decode(token, keys[0], algorithms=["RS256"])
+        assert payload["sub"] == "1"
+        assert payload["is_admin"] is False
+        
+        response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+
+
 class TestHealthCheck:
     """Test health check endpoint"""
     
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк пакетного приема сканирований багажа против обновления по одному событию
+Использование: python benchmarks/bench_scan_ingest.py [--bags 20000] [--events 20000] [--batch 5000]
+                   [--database-url postgresql://...]
+
+Без --database-url таблица baggage создается во временной базе SQLite
+(staging заполняется executemany). С PostgreSQL работает путь через COPY;
+сканируются уже существующие бирки с верной контрольной цифрой, и их статусы
+меняются - запускайте только на тестовой базе.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from main import BAGGAGE_STATUSES, Baggage, BaggageEvent, FlightBaggageTotals, ScanEvent, encode_baggage_tag, ingest_scan_events, is_valid_baggage_tag
+
+
+def prepare_sqlite(count: int):
+    engine = create_engine(f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE baggage (
+                id INTEGER PRIMARY KEY,
+                booking_id INTEGER,
+                baggage_tag VARCHAR(50) UNIQUE,
+                weight NUMERIC(5, 2),
+                status VARCHAR(50),
+                location VARCHAR(255),
+                created_at TIMESTAMP,
+                last_event_at TIMESTAMP
+            )
+        """))
+        conn.execute(text("CREATE TABLE bookings (id INTEGER PRIMARY KEY, flight_id INTEGER)"))
+        conn.execute(text("INSERT INTO bookings (id, flight_id) VALUES (1, 1)"))
+        BaggageEvent.__table__.create(conn)
+        FlightBaggageTotals.__table__.create(conn)
+        conn.execute(
+            text("INSERT INTO baggage (booking_id, baggage_tag, status) VALUES (1, :tag, 'checked_in')"),
+            [{"tag": encode_baggage_tag(serial)} for serial in range(count)]
+        )
+    return engine, [encode_baggage_tag(serial) for serial in range(count)]
+
+
+def make_events(tags, count: int):
+    start = datetime.utcnow()
+    return [
+        ScanEvent(
+            index=i,
+            tag=random.choice(tags),
+            status=random.choice(BAGGAGE_STATUSES),
+            location=f"Belt {random.randint(1, 40)}",
+            scanned_at=start + timedelta(milliseconds=i)
+        )
+        for i in range(count)
+    ]
+
+
+def run_single(session_factory, events) -> float:
+    """Как PUT /baggage/{id}: поиск багажа, обновление и коммит на каждое событие"""
+    db = session_factory()
+    start = time.perf_counter()
+    for event in events:
+        bag = db.query(Baggage).filter(Baggage.baggage_tag == event.tag).first()
+        bag.status = event.status
+        bag.location = event.location
+        bag.last_event_at = event.scanned_at
+        db.commit()
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed
+
+
+def run_batched(session_factory, events, batch: int) -> float:
+    db = session_factory()
+    start = time.perf_counter()
+    for i in range(0, len(events), batch):
+        rejected = []
+        ingest_scan_events(db, events[i:i + batch], rejected)
+        assert not rejected, rejected[:3]
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарк приема сканирований багажа")
+    parser.add_argument("--bags", type=int, default=20000)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--single-events", type=int, default=2000,
+                        help="Сколько событий прогнать по одному (медленный путь)")
+    parser.add_argument("--database-url")
+    args = parser.parse_args()
+    random.seed(42)
+
+    if args.database_url:
+        engine = create_engine(args.database_url)
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT baggage_tag FROM baggage LIMIT :n"), {"n": args.bags * 2})
+            tags = [row[0] for row in rows if is_valid_baggage_tag(row[0])][:args.bags]
+        if not tags:
+            print("✗ В базе нет бирок с контрольной цифрой")
+            return
+    else:
+        engine, tags = prepare_sqlite(args.bags)
+    session_factory = sessionmaker(bind=engine)
+
+    single_events = make_events(tags, args.single_events)
+    single = run_single(session_factory, single_events)
+    batched_events = make_events(tags, args.events)
+    batched = run_batched(session_factory, batched_events, args.batch)
+
+    print(f"База:                {engine.dialect.name}, бирок {len(tags)}")
+    print(f"По одному событию:   {len(single_events) / single:,.0f} событий/с ({len(single_events)} за {single:.2f} с)")
+    print(f"Пакетами по {args.batch}: {len(batched_events) / batched:,.0f} событий/с "
+          f"({len(batched_events)} за {batched:.2f} с)")
+
+
+if __name__ == "__main__":
+    main_cli()
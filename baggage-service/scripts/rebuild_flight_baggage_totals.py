@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Пересчет итогов багажа по рейсам (flight_baggage_totals) по таблице baggage
+Использование: python scripts/rebuild_flight_baggage_totals.py [--flight-id 12 --flight-id 15]
+
+baggage-service поддерживает итоги сам в транзакциях смены статуса; скрипт
+нужен при первом включении и для восстановления после ручных правок baggage.
+Без --flight-id пересчитываются все рейсы в одной транзакции. Пока она идет,
+смены статуса багажа ждут блокировку таблицы итогов. Базу задает DATABASE_URL.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from main import SessionLocal, rebuild_flight_totals
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Пересчет итогов багажа по рейсам")
+    parser.add_argument("--flight-id", type=int, action="append",
+                        help="Рейс для пересчета (можно указать несколько раз; по умолчанию - все)")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    start = time.perf_counter()
+    try:
+        rows = rebuild_flight_totals(db, args.flight_id)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"✗ Ошибка пересчета: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        db.close()
+
+    scope = ", ".join(str(flight_id) for flight_id in args.flight_id) if args.flight_id else "все рейсы"
+    print(f"✓ Пересчитано за {time.perf_counter() - start:.1f} с ({scope}): {rows} строк итогов")
+
+
+if __name__ == "__main__":
+    main_cli()
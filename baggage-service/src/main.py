@@ -1,15 +1,33 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Header, BackgroundTasks, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Numeric
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Numeric, text, bindparam
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from jose import JWTError, jwt
-from datetime import datetime
+from datetime import date, datetime, timezone
 from pydantic import BaseModel
-from typing import List, Optional
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+import asyncio
+import csv
+import heapq
+import hmac
+import io
+import json
 import os
+import re
 import httpx
+import string
+import struct
+import threading
+import unicodedata
+
+from shared.jwks import TokenVerifier
+from shared.pdf import pdf_text, write_pdf
 
 app = FastAPI(title="Baggage Service", version="1.0.0")
 
@@ -31,8 +49,57 @@ Base = declarative_base()
 # Security
 security = HTTPBearer()
 NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "http://notification-service:8000")
+AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth-service:8000")
 JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-jwt-key-change-in-production")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWKS_URL = os.getenv("JWKS_URL", f"{AUTH_SERVICE_URL}/.well-known/jwks.json")
+token_verifier = TokenVerifier(JWT_ALGORITHM, JWT_SECRET, JWKS_URL)
+# Ключ для служебных вызовов других сервисов (метрики)
+INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "your-internal-api-key-change-in-production")
+# Бирки выдаются из последовательности baggage_tag_seq блоками: один nextval резервирует
+# за процессом BAGGAGE_TAG_BLOCK_SIZE номеров (должен совпадать с INCREMENT BY в init.sql)
+BAGGAGE_TAG_BLOCK_SIZE = 1000
+BAGGAGE_TAG_MAX_ATTEMPTS = 5
+# Пакетный прием сканирований от ленточных сканеров (POST /baggage/scans)
+SCANNER_API_KEY = os.getenv("SCANNER_API_KEY", "your-scanner-api-key-change-in-production")
+BAGGAGE_SCAN_MAX_EVENTS = int(os.getenv("BAGGAGE_SCAN_MAX_EVENTS", "50000"))
+# Тело запроса читается не больше этого размера, до разбора событий
+BAGGAGE_SCAN_MAX_BYTES = int(os.getenv("BAGGAGE_SCAN_MAX_BYTES", str(16 * 1024 * 1024)))
+# Индекс статуса - его код в бинарном формате сканирований
+BAGGAGE_STATUSES = ("checked_in", "in_transit", "loaded", "unloaded", "delivered", "lost")
+# Допустимые переходы статусов багажа (ручные и массовые по рейсу; сканы фиксируют факт и не проверяются)
+BAGGAGE_TRANSITIONS = {
+    "checked_in": {"in_transit", "loaded", "lost"},
+    "in_transit": {"loaded", "unloaded", "delivered", "lost"},
+    "loaded": {"unloaded", "lost"},
+    "unloaded": {"in_transit", "delivered", "lost"},
+    "delivered": set(),
+    "lost": {"in_transit", "delivered"},
+}
+# Бинарная запись: бирка (9 байт ASCII), код статуса, время скана (unix, с), длина локации, затем локация в UTF-8
+SCAN_RECORD = struct.Struct("!9sBIB")
+# История событий багажа (baggage_events) секционирована по месяцам; при старте и затем
+# раз в BAGGAGE_EVENT_PARTITIONS_INTERVAL_SECONDS создаются секции на текущий
+# и BAGGAGE_EVENT_PARTITIONS_AHEAD следующих месяцев
+BAGGAGE_EVENT_PARTITIONS_AHEAD = int(os.getenv("BAGGAGE_EVENT_PARTITIONS_AHEAD", "2"))
+BAGGAGE_EVENT_PARTITIONS_INTERVAL_SECONDS = int(os.getenv("BAGGAGE_EVENT_PARTITIONS_INTERVAL_SECONDS", "86400"))
+# Push-уведомления (SSE): смены статуса раздаются подписчикам брокером в памяти процесса;
+# подписка держит только открытое соединение, без сессии БД
+BAGGAGE_STREAM_KEEPALIVE_SECONDS = float(os.getenv("BAGGAGE_STREAM_KEEPALIVE_SECONDS", "15"))
+BAGGAGE_STREAM_MAX_SUBSCRIBERS = int(os.getenv("BAGGAGE_STREAM_MAX_SUBSCRIBERS", "10000"))
+BAGGAGE_STREAM_QUEUE_SIZE = 100
+# Манифест рейса читается серверным курсором пачками по столько строк
+BAGGAGE_MANIFEST_FETCH_SIZE = int(os.getenv("BAGGAGE_MANIFEST_FETCH_SIZE", "500"))
+# Нечеткий поиск багажа (стойка розыска): в PostgreSQL - триграммные GIN-индексы pg_trgm;
+# кандидатами считаются совпадения с похожестью не ниже порога, по каждому полю не больше
+# BAGGAGE_SEARCH_CANDIDATES лучших
+BAGGAGE_SEARCH_SIMILARITY = float(os.getenv("BAGGAGE_SEARCH_SIMILARITY", "0.3"))
+BAGGAGE_SEARCH_CANDIDATES = 500
+# Печать бирок на стойке регистрации: шаблоны ZPL и PDF разбираются один раз при старте,
+# готовые бирки кешируются по номеру (LRU) и перерисовываются, только если поменялись данные
+BAGGAGE_LABEL_MAX_TAGS = 100
+LABEL_CACHE_MAX_ENTRIES = int(os.getenv("LABEL_CACHE_MAX_ENTRIES", "10000"))
+MANIFEST_COLUMNS = ("baggage_tag", "booking_id", "seat_number", "weight", "status", "location", "last_event_at")
 
 
 # Database Models
@@ -47,6 +114,35 @@ class Baggage(Base):
     status = Column(String(50), default="checked_in")
     location = Column(String(255))
     created_at = Column(DateTime, default=datetime.utcnow)
+    last_event_at = Column(DateTime, nullable=True)
+
+
+class BaggageEvent(Base):
+    __tablename__ = "baggage_events"
+    __table_args__ = {'extend_existing': True}
+    
+    # Append-only; в PostgreSQL таблица секционирована по occurred_at (см. init.sql).
+    # Без внешнего ключа на baggage: история переживает удаление багажа
+    id = Column(Integer, primary_key=True)
+    baggage_id = Column(Integer, nullable=False)
+    baggage_tag = Column(String(50), nullable=False, index=True)
+    status = Column(String(50), nullable=False)
+    location = Column(String(255))
+    source = Column(String(20), nullable=False)  # checkin, update, scan
+    occurred_at = Column(DateTime, nullable=False)
+    recorded_at = Column(DateTime, default=datetime.utcnow)
+
+
+class FlightBaggageTotals(Base):
+    __tablename__ = "flight_baggage_totals"
+    __table_args__ = {'extend_existing': True}
+    
+    # Текущие итоги багажа рейса по статусам; обновляются в той же транзакции,
+    # что и смена статуса багажа, пересчитываются scripts/rebuild_flight_baggage_totals.py
+    flight_id = Column(Integer, primary_key=True)
+    status = Column(String(50), primary_key=True)
+    bags = Column(Integer, nullable=False, default=0)
+    weight = Column(Numeric(12, 2), nullable=False, default=0)
 
 
 # Pydantic Models
@@ -73,6 +169,47 @@ class BaggageResponse(BaseModel):
         from_attributes = True
 
 
+class FlightBaggageTransition(BaseModel):
+    status: str
+    location: Optional[str] = None
+
+
+class FlightBaggageTransitionResponse(BaseModel):
+    flight_id: int
+    status: str
+    transitioned: int
+    remaining: Dict[str, int]
+    notified_passengers: int
+
+
+class BaggageTotals(BaseModel):
+    bags: int
+    weight: float
+
+
+class FlightBaggageTotalsResponse(BaseModel):
+    flight_id: int
+    bags: int
+    weight: float
+    by_status: Dict[str, BaggageTotals]
+
+
+class LabelRequest(BaseModel):
+    booking_id: Optional[int] = None
+    tags: Optional[List[str]] = None
+    format: str = "zpl"
+
+
+class BaggageSearchResult(BaseModel):
+    baggage_tag: str
+    status: str
+    location: Optional[str]
+    booking_id: int
+    passenger_name: Optional[str]
+    flight_number: Optional[str]
+    score: float
+
+
 class BaggageStatusResponse(BaseModel):
     baggage_tag: str
     status: str
@@ -80,7 +217,109 @@ class BaggageStatusResponse(BaseModel):
     booking_id: int
 
 
+class BaggageEventResponse(BaseModel):
+    status: str
+    location: Optional[str]
+    source: str
+    occurred_at: datetime
+
+
+class ScanRejection(BaseModel):
+    index: int
+    tag: Optional[str] = None
+    reason: str
+
+
+class ScanIngestResponse(BaseModel):
+    received: int
+    applied: int
+    stale: int
+    rejected: List[ScanRejection]
+
+
+@dataclass
+class ScanEvent:
+    index: int
+    tag: str
+    status: str
+    location: Optional[str]
+    scanned_at: datetime
+
+
 # Helper functions
+@app.on_event("startup")
+async def load_jwks():
+    await token_verifier.load()
+
+
+def month_start(day: date, months_ahead: int = 0) -> date:
+    month = day.month - 1 + months_ahead
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def ensure_event_partitions(db: Session, today: date, months_ahead: int):
+    """Create monthly baggage_events partitions up to months_ahead from today.
+    
+    Rows of a missing month that already landed in baggage_events_default are
+    moved into the new partition, otherwise attaching it would fail.
+    """
+    # Несколько экземпляров сервиса не создают одну секцию одновременно
+    db.execute(text("SELECT pg_advisory_xact_lock(hashtext('baggage_events_partitions'))"))
+    for offset in range(months_ahead + 1):
+        start = month_start(today, offset)
+        name = f"baggage_events_{start:%Y_%m}"
+        if db.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is not None:
+            continue
+        bounds = {"start": start, "end": month_start(start, 1)}
+        db.execute(text(f"CREATE TABLE {name} (LIKE baggage_events INCLUDING DEFAULTS)"))
+        db.execute(text(f"""
+            WITH moved AS (
+                DELETE FROM baggage_events_default
+                WHERE occurred_at >= :start AND occurred_at < :end
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """), bounds)
+        db.execute(text(f"""
+            ALTER TABLE baggage_events ATTACH PARTITION {name}
+            FOR VALUES FROM ('{bounds["start"]}') TO ('{bounds["end"]}')
+        """))
+    db.commit()
+
+
+def create_event_partitions():
+    db = SessionLocal()
+    try:
+        if db.bind.dialect.name == "postgresql":
+            ensure_event_partitions(db, datetime.utcnow().date(), BAGGAGE_EVENT_PARTITIONS_AHEAD)
+    except Exception as e:
+        db.rollback()
+        print(f"Failed to create baggage event partitions: {e}")
+    finally:
+        db.close()
+
+
+async def event_partitioner():
+    while True:
+        await asyncio.to_thread(create_event_partitions)
+        await asyncio.sleep(BAGGAGE_EVENT_PARTITIONS_INTERVAL_SECONDS)
+
+
+event_partitioner_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def start_event_partitioner():
+    global event_partitioner_task
+    event_partitioner_task = asyncio.create_task(event_partitioner())
+
+
+@app.on_event("shutdown")
+async def stop_event_partitioner():
+    if event_partitioner_task:
+        event_partitioner_task.cancel()
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -93,7 +332,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
     """Verify JWT token and return user info"""
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = await token_verifier.decode(token)
         user_id_raw = payload.get("sub")
         if user_id_raw is None:
             raise HTTPException(
@@ -117,27 +356,1150 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         )
 
 
-def generate_baggage_tag() -> str:
-    """Generate a unique baggage tag"""
-    import random
-    import string
-    letters = ''.join(random.choices(string.ascii_uppercase, k=3))
-    numbers = ''.join(random.choices(string.digits, k=6))
-    return f"{letters}{numbers}"
+async def verify_admin(user_info: dict = Depends(verify_token), db: Session = Depends(get_db)) -> dict:
+    """Ground staff operations require admin rights in users (the token claim outlives a revocation)"""
+    is_admin = db.execute(
+        text("SELECT is_admin FROM users WHERE id = :user_id"),
+        {"user_id": user_info["user_id"]}
+    ).scalar()
+    if not is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return user_info
+
 
+def check_transition(current: str, target: str):
+    if target not in BAGGAGE_TRANSITIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown baggage status: {target}"
+        )
+    if target != current and target not in BAGGAGE_TRANSITIONS.get(current, ()):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cannot change baggage status from {current} to {target}"
+        )
+
+
+def baggage_tag_check_digit(body: str) -> int:
+    """Luhn check digit over the tag body with letters expanded to 10..35 (as in ISIN)"""
+    digits = "".join(str(int(ch, 36)) for ch in body)
+    total = 0
+    for i, ch in enumerate(reversed(digits)):
+        d = int(ch)
+        if i % 2 == 0:
+            d = d * 2 - 9 if d > 4 else d * 2
+        total += d
+    return (10 - total % 10) % 10
+
+
+def encode_baggage_tag(serial: int) -> str:
+    """Tag for a serial: 3 letters (base 26) + 5 digits + check digit"""
+    if not 0 <= serial < 26 ** 3 * 10 ** 5:
+        raise ValueError(f"Baggage tag serial out of range: {serial}")
+    high, low = divmod(serial, 10 ** 5)
+    letters = ""
+    for _ in range(3):
+        high, d = divmod(high, 26)
+        letters = string.ascii_uppercase[d] + letters
+    body = f"{letters}{low:05d}"
+    return f"{body}{baggage_tag_check_digit(body)}"
+
+
+def is_valid_baggage_tag(tag: str) -> bool:
+    """Check the format and check digit, so a mistyped tag is caught without a lookup"""
+    return (
+        len(tag) == 9
+        and all(ch in string.ascii_uppercase for ch in tag[:3])
+        and all(ch in string.digits for ch in tag[3:])
+        and baggage_tag_check_digit(tag[:8]) == int(tag[8])
+    )
+
+
+def reserve_tag_block(db: Session) -> int:
+    """First serial of a fresh block; sequences are not transactional, so it is never reused"""
+    return db.execute(text("SELECT nextval('baggage_tag_seq')")).scalar_one()
+
+
+class TagAllocator:
+    """Hands out tag serials from a block reserved in the database.
+    
+    Allocation is a counter increment; the database is touched once per
+    block_size tags. Blocks left unused when the process stops are skipped.
+    """
+
+    def __init__(self, block_size: int, reserve: Callable[[Session], int]):
+        self.block_size = block_size
+        self.reserve = reserve
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def allocate(self, db: Session) -> int:
+        with self._lock:
+            if self._next >= self._end:
+                self._next = self.reserve(db)
+                self._end = self._next + self.block_size
+            serial = self._next
+            self._next += 1
+            return serial
+
+
+tag_allocator = TagAllocator(BAGGAGE_TAG_BLOCK_SIZE, reserve_tag_block)
+
+
+def generate_baggage_tag(db: Session) -> str:
+    """Allocate the next unique baggage tag"""
+    return encode_baggage_tag(tag_allocator.allocate(db))
+
+
+def record_baggage_event(db: Session, baggage: Baggage, source: str, occurred_at: Optional[datetime] = None):
+    """Append the bag's current status to its history (caller commits)"""
+    occurred_at = occurred_at or datetime.utcnow()
+    db.add(BaggageEvent(
+        baggage_id=baggage.id,
+        baggage_tag=baggage.baggage_tag,
+        status=baggage.status,
+        location=baggage.location,
+        source=source,
+        occurred_at=occurred_at
+    ))
+    baggage.last_event_at = occurred_at
 
-def check_booking_ownership(db: Session, booking_id: int, user_id: int) -> bool:
-    """Check if booking belongs to user"""
+
+class BaggageBroker:
+    """In-process fan-out of bag status changes to stream subscribers.
+    
+    Subscribers register under keys like "tag:ABC123456" or "booking:42".
+    Publishing never blocks: a subscriber whose queue is full loses its
+    oldest pending update. Each worker has its own broker, so a change is
+    pushed to the subscribers of the worker that made it.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, set] = {}
+        self.published = 0
+        self.dropped = 0
+
+    @staticmethod
+    def keys_for(update: dict) -> List[str]:
+        return [f"tag:{update['baggage_tag']}", f"booking:{update['booking_id']}"]
+
+    def subscribe(self, keys: List[str]) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        for key in keys:
+            self._subscribers.setdefault(key, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue, keys: List[str]):
+        for key in keys:
+            queues = self._subscribers.get(key)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[key]
+
+    def publish(self, update: dict):
+        self.published += 1
+        targets = set()
+        for key in self.keys_for(update):
+            targets.update(self._subscribers.get(key, ()))
+        for queue in targets:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(update)
+
+    def subscriber_count(self) -> int:
+        return len({queue for queues in self._subscribers.values() for queue in queues})
+
+
+baggage_broker = BaggageBroker(BAGGAGE_STREAM_QUEUE_SIZE)
+
+
+def baggage_update_message(baggage: Baggage) -> dict:
+    return {
+        "baggage_tag": baggage.baggage_tag,
+        "booking_id": baggage.booking_id,
+        "status": baggage.status,
+        "location": baggage.location,
+        "occurred_at": (baggage.last_event_at or datetime.utcnow()).isoformat(),
+    }
+
+
+def sse_message(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def baggage_event_stream(queue: asyncio.Queue, snapshot: List[dict], keys: List[str]):
+    """Current state first, then every change; a comment line keeps idle proxies open"""
+    try:
+        yield sse_message("snapshot", snapshot)
+        while True:
+            try:
+                update = await asyncio.wait_for(queue.get(), timeout=BAGGAGE_STREAM_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield sse_message("status", update)
+    finally:
+        baggage_broker.unsubscribe(queue, keys)
+
+
+def lock_rows(db: Session, table: str) -> str:
+    """FOR UPDATE clause for text() queries; SQLite serializes writers anyway"""
+    return f"FOR UPDATE OF {table}" if db.bind.dialect.name == "postgresql" else ""
+
+
+def add_flight_totals(db: Session, moves: List[tuple]):
+    """Apply (flight_id, old_status, new_status, weight) moves to flight_baggage_totals (caller commits).
+    
+    old_status is None for a new bag. Call it in the transaction that changes
+    the bags, so the totals never drift from the baggage table.
+    """
+    deltas: Dict[tuple, list] = {}
+    for flight_id, old_status, new_status, weight in moves:
+        if old_status == new_status or flight_id is None:
+            continue
+        weight = float(weight or 0)
+        for key, sign in (((flight_id, old_status), -1), ((flight_id, new_status), 1)):
+            if key[1] is not None:
+                delta = deltas.setdefault(key, [0, 0.0])
+                delta[0] += sign
+                delta[1] += sign * weight
+    if not deltas:
+        return
+    db.execute(
+        text("""
+            INSERT INTO flight_baggage_totals (flight_id, status, bags, weight)
+            VALUES (:flight_id, :status, :bags, :weight)
+            ON CONFLICT (flight_id, status) DO UPDATE SET
+                bags = flight_baggage_totals.bags + excluded.bags,
+                weight = flight_baggage_totals.weight + excluded.weight
+        """),
+        [
+            {"flight_id": flight_id, "status": status_name, "bags": bags, "weight": round(weight, 2)}
+            for (flight_id, status_name), (bags, weight) in sorted(deltas.items())
+        ]
+    )
+
+
+def rebuild_flight_totals(db: Session, flight_ids: Optional[List[int]] = None) -> int:
+    """Recompute flight_baggage_totals from the baggage table (caller commits).
+    
+    On PostgreSQL the totals table is locked first: concurrent status changes
+    wait and then add their deltas on top of the rebuilt rows.
+    """
+    if db.bind.dialect.name == "postgresql":
+        db.execute(text("LOCK TABLE flight_baggage_totals IN EXCLUSIVE MODE"))
+    condition = "flight_id IN :flight_ids" if flight_ids is not None else "flight_id IS NOT NULL"
+    params = {"flight_ids": flight_ids} if flight_ids is not None else {}
+    
+    def statement(sql: str):
+        clause = text(sql)
+        if flight_ids is not None:
+            clause = clause.bindparams(bindparam("flight_ids", expanding=True))
+        return clause
+    
+    db.execute(statement(f"DELETE FROM flight_baggage_totals WHERE {condition}"), params)
+    result = db.execute(statement(f"""
+        INSERT INTO flight_baggage_totals (flight_id, status, bags, weight)
+        SELECT bk.flight_id, b.status, COUNT(*), COALESCE(SUM(b.weight), 0)
+        FROM baggage b
+        JOIN bookings bk ON bk.id = b.booking_id
+        WHERE bk.{condition}
+        GROUP BY bk.flight_id, b.status
+    """), params)
+    return result.rowcount
+
+
+def get_flight_totals(db: Session, flight_id: int) -> Dict[str, BaggageTotals]:
+    rows = db.execute(
+        text("SELECT status, bags, weight FROM flight_baggage_totals WHERE flight_id = :flight_id AND bags > 0"),
+        {"flight_id": flight_id}
+    ).fetchall()
+    return {row[0]: BaggageTotals(bags=row[1], weight=round(float(row[2]), 2)) for row in rows}
+
+
+# Багаж вместе с владельцем бронирования (owner_id) и рейсом - одним запросом
+BAGGAGE_COLUMNS = ("id", "booking_id", "baggage_tag", "weight", "status", "location", "created_at", "last_event_at")
+BAGGAGE_SELECT = ", ".join(f"b.{column}" for column in BAGGAGE_COLUMNS)
+
+
+def find_baggage(db: Session, condition: str, params: dict, lock: bool = False):
+    """One bag with its booking owner_id and flight_id, or None"""
+    return db.execute(
+        text(f"""
+            SELECT {BAGGAGE_SELECT}, bk.user_id AS owner_id, bk.flight_id
+            FROM baggage b
+            LEFT JOIN bookings bk ON bk.id = b.booking_id
+            WHERE {condition}
+            {lock_rows(db, "b") if lock else ""}
+        """).columns(created_at=DateTime, last_event_at=DateTime),
+        params
+    ).first()
+
+
+def find_booking_baggage(db: Session, booking_id: int) -> list:
+    """Bags of a booking with its owner_id; empty if there is no such booking.
+    
+    A booking without bags yields one row whose bag columns are NULL.
+    """
+    return db.execute(
+        text(f"""
+            SELECT {BAGGAGE_SELECT}, bk.user_id AS owner_id, bk.flight_id
+            FROM bookings bk
+            LEFT JOIN baggage b ON b.booking_id = bk.id
+            WHERE bk.id = :booking_id
+            ORDER BY b.id
+        """).columns(created_at=DateTime, last_event_at=DateTime),
+        {"booking_id": booking_id}
+    ).fetchall()
+
+
+def baggage_response(baggage) -> BaggageResponse:
+    return BaggageResponse(
+        id=baggage.id,
+        booking_id=baggage.booking_id,
+        baggage_tag=baggage.baggage_tag,
+        weight=float(baggage.weight) if baggage.weight else None,
+        status=baggage.status,
+        location=baggage.location,
+        created_at=baggage.created_at
+    )
+
+
+def insert_baggage_events(db: Session, rows: List[dict], source: str, occurred_at: datetime):
+    """Append baggage_id/baggage_tag/status/location rows to the history (caller commits)"""
+    db.execute(
+        text("""
+            INSERT INTO baggage_events (baggage_id, baggage_tag, status, location, source, occurred_at, recorded_at)
+            VALUES (:baggage_id, :baggage_tag, :status, :location, :source, :occurred_at, :occurred_at)
+        """),
+        [dict(row, source=source, occurred_at=occurred_at) for row in rows]
+    )
+
+
+def trigrams(value: str) -> set:
+    """Trigrams of every word, padded the way pg_trgm pads them"""
+    grams = set()
+    for word in re.findall(r"[^\W_]+", value.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def trigram_similarity(a: Optional[str], b: Optional[str]) -> float:
+    """Same measure as pg_trgm similarity(): shared trigrams / all trigrams"""
+    if not a or not b:
+        return 0.0
+    left, right = trigrams(a), trigrams(b)
+    if not left or not right:
+        return 0.0
+    return len(left & right) / len(left | right)
+
+
+def search_baggage(db: Session, tag: Optional[str], name: Optional[str], flight: Optional[str],
+                   limit: int) -> List[BaggageSearchResult]:
+    """Bags whose tag or passenger name resemble the query, best matches first.
+    
+    The score averages the similarity of each given field, so the flight
+    number only re-ranks candidates found by tag or name.
+    """
+    fields = sum(value is not None for value in (tag, name, flight))
+    if db.bind.dialect.name == "postgresql":
+        db.execute(
+            text("SELECT set_config('pg_trgm.similarity_threshold', :threshold, true)"),
+            {"threshold": str(BAGGAGE_SEARCH_SIMILARITY)}
+        )
+        rows = db.execute(
+            text("""
+                WITH tag_matches AS (
+                    SELECT b.id FROM baggage b
+                    WHERE b.baggage_tag % CAST(:tag AS TEXT)
+                    ORDER BY similarity(b.baggage_tag, CAST(:tag AS TEXT)) DESC
+                    LIMIT :candidates
+                ), name_matches AS (
+                    SELECT b.id FROM users u
+                    JOIN bookings bk ON bk.user_id = u.id
+                    JOIN baggage b ON b.booking_id = bk.id
+                    WHERE (u.first_name || ' ' || u.last_name) % CAST(:name AS TEXT)
+                    ORDER BY similarity(u.first_name || ' ' || u.last_name, CAST(:name AS TEXT)) DESC
+                    LIMIT :candidates
+                )
+                SELECT b.baggage_tag, b.status, b.location, b.booking_id,
+                       u.first_name || ' ' || u.last_name AS passenger_name, f.flight_number,
+                       (COALESCE(similarity(b.baggage_tag, CAST(:tag AS TEXT)), 0)
+                        + COALESCE(similarity(u.first_name || ' ' || u.last_name, CAST(:name AS TEXT)), 0)
+                        + COALESCE(similarity(f.flight_number, CAST(:flight AS TEXT)), 0)) / :fields AS score
+                FROM baggage b
+                LEFT JOIN bookings bk ON bk.id = b.booking_id
+                LEFT JOIN users u ON u.id = bk.user_id
+                LEFT JOIN flights f ON f.id = bk.flight_id
+                WHERE b.id IN (SELECT id FROM tag_matches UNION SELECT id FROM name_matches)
+                ORDER BY score DESC, b.id
+                LIMIT :limit
+            """),
+            {"tag": tag, "name": name, "flight": flight, "fields": fields,
+             "candidates": BAGGAGE_SEARCH_CANDIDATES, "limit": limit}
+        ).fetchall()
+        return [
+            BaggageSearchResult(
+                baggage_tag=row[0], status=row[1], location=row[2], booking_id=row[3],
+                passenger_name=row[4], flight_number=row[5], score=round(float(row[6]), 3)
+            )
+            for row in rows
+        ]
+    
+    # Без pg_trgm (SQLite в тестах и разработке) - полный просмотр с той же мерой похожести
+    rows = db.execute(text("""
+        SELECT b.id, b.baggage_tag, b.status, b.location, b.booking_id,
+               u.first_name || ' ' || u.last_name AS passenger_name, f.flight_number
+        FROM baggage b
+        LEFT JOIN bookings bk ON bk.id = b.booking_id
+        LEFT JOIN users u ON u.id = bk.user_id
+        LEFT JOIN flights f ON f.id = bk.flight_id
+    """))
+    scored = []
+    for row in rows:
+        tag_score = trigram_similarity(row.baggage_tag, tag)
+        name_score = trigram_similarity(row.passenger_name, name)
+        if max(tag_score, name_score) < BAGGAGE_SEARCH_SIMILARITY:
+            continue
+        score = (tag_score + name_score + trigram_similarity(row.flight_number, flight)) / fields
+        scored.append((score, -row.id, row))
+    return [
+        BaggageSearchResult(
+            baggage_tag=row.baggage_tag, status=row.status, location=row.location, booking_id=row.booking_id,
+            passenger_name=row.passenger_name, flight_number=row.flight_number, score=round(score, 3)
+        )
+        for score, _, row in heapq.nlargest(limit, scored, key=lambda item: item[:2])
+    ]
+
+
+def check_booking_ownership(db: Session, booking_id: int, user_id: int):
+    """Booking row (user_id, flight_id) if it belongs to user, else None"""
     from sqlalchemy import text
     result = db.execute(
-        text("SELECT user_id FROM bookings WHERE id = :booking_id"),
+        text("SELECT user_id, flight_id FROM bookings WHERE id = :booking_id"),
         {"booking_id": booking_id}
     )
     row = result.fetchone()
-    return row and row[0] == user_id
+    return row if row and row.user_id == user_id else None
+
+
+def verify_scanner(x_scanner_key: Optional[str] = Header(None)):
+    if x_scanner_key is None or not hmac.compare_digest(x_scanner_key, SCANNER_API_KEY):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid scanner key"
+        )
+
+
+def verify_internal(x_internal_key: Optional[str] = Header(None)):
+    if x_internal_key is None or not hmac.compare_digest(x_internal_key, INTERNAL_API_KEY):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid internal key"
+        )
+
+
+def parse_scan_time(value: str) -> datetime:
+    """ISO timestamp as naive UTC (like the rest of the table)"""
+    scanned_at = datetime.fromisoformat(value)
+    if scanned_at.tzinfo is not None:
+        scanned_at = scanned_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return scanned_at
+
+
+def parse_scan_lines(body: bytes, received_at: datetime, rejected: List[ScanRejection]) -> List[ScanEvent]:
+    """Scan events from JSON lines: {"tag", "status", "location"?, "scanned_at"?}"""
+    events = []
+    for index, line in enumerate(body.splitlines()):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            scanned_at = item.get("scanned_at")
+            events.append(ScanEvent(
+                index=index,
+                tag=str(item["tag"]).upper(),
+                status=str(item["status"]),
+                location=item.get("location"),
+                scanned_at=parse_scan_time(scanned_at) if scanned_at else received_at
+            ))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            rejected.append(ScanRejection(index=index, reason="malformed"))
+    return events
+
+
+def parse_scan_records(body: bytes, rejected: List[ScanRejection]) -> List[ScanEvent]:
+    """Scan events from packed SCAN_RECORD records"""
+    events = []
+    offset = 0
+    index = 0
+    while offset < len(body):
+        if offset + SCAN_RECORD.size > len(body):
+            raise ValueError(f"Truncated record {index}")
+        tag, code, scanned_at, location_size = SCAN_RECORD.unpack_from(body, offset)
+        offset += SCAN_RECORD.size
+        if offset + location_size > len(body):
+            raise ValueError(f"Truncated record {index}")
+        location = body[offset:offset + location_size].decode("utf-8", errors="replace") or None
+        offset += location_size
+        if code < len(BAGGAGE_STATUSES):
+            events.append(ScanEvent(
+                index=index,
+                tag=tag.decode("ascii", errors="replace").upper(),
+                status=BAGGAGE_STATUSES[code],
+                location=location,
+                scanned_at=datetime.utcfromtimestamp(scanned_at)
+            ))
+        else:
+            rejected.append(ScanRejection(index=index, reason="invalid_status"))
+        index += 1
+    return events
+
+
+def copy_scan_staging(db: Session, events: List[ScanEvent], latest: set):
+    """Load events into the staging table: COPY on PostgreSQL, executemany elsewhere.
+    
+    is_latest marks the one event per tag that may update the bag itself.
+    """
+    columns = "tag VARCHAR(50), status VARCHAR(50), location VARCHAR(255), scanned_at TIMESTAMP, is_latest BOOLEAN"
+    if db.bind.dialect.name == "postgresql":
+        db.execute(text(f"CREATE TEMP TABLE baggage_scan_staging ({columns}) ON COMMIT DROP"))
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for event in events:
+            writer.writerow((event.tag, event.status, event.location, event.scanned_at.isoformat(),
+                             event.index in latest))
+        buffer.seek(0)
+        cursor = db.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                "COPY baggage_scan_staging (tag, status, location, scanned_at, is_latest) FROM STDIN WITH (FORMAT csv)",
+                buffer
+            )
+        finally:
+            cursor.close()
+        return
+    db.execute(text(f"CREATE TEMP TABLE IF NOT EXISTS baggage_scan_staging ({columns})"))
+    db.execute(text("DELETE FROM baggage_scan_staging"))
+    db.execute(
+        text("""
+            INSERT INTO baggage_scan_staging (tag, status, location, scanned_at, is_latest)
+            VALUES (:tag, :status, :location, :scanned_at, :is_latest)
+        """),
+        [
+            {"tag": e.tag, "status": e.status, "location": e.location, "scanned_at": e.scanned_at,
+             "is_latest": e.index in latest}
+            for e in events
+        ]
+    )
+
+
+def ingest_scan_events(db: Session, events: List[ScanEvent], rejected: List[ScanRejection]) -> Dict[str, int]:
+    """Validate scan events, append them to the history and update the bags (one commit).
+    
+    Every valid event of a known bag goes to baggage_events once, even if it
+    is repeated within the batch or the batch is retried. Only the latest scan per tag updates the bag, and
+    only if it is newer than the bag's last event, so reordered batches are safe.
+    Tags are rejected only if no such bag exists: bags issued before the check
+    digit carry random last digits, so it only explains why a tag is unknown.
+    """
+    valid = []
+    latest: Dict[str, ScanEvent] = {}
+    superseded = 0
+    for event in events:
+        if event.status not in BAGGAGE_STATUSES:
+            rejected.append(ScanRejection(index=event.index, tag=event.tag, reason="invalid_status"))
+        else:
+            valid.append(event)
+            current = latest.get(event.tag)
+            if current is None or current.scanned_at <= event.scanned_at:
+                latest[event.tag] = event
+            superseded += current is not None
+    if not latest:
+        return {"applied": 0, "stale": superseded, "updates": []}
+
+    copy_scan_staging(db, valid, {event.index for event in latest.values()})
+    # GROUP BY схлопывает повторы внутри пачки, NOT EXISTS - уже записанные события
+    db.execute(text("""
+        INSERT INTO baggage_events (baggage_id, baggage_tag, status, location, source, occurred_at, recorded_at)
+        SELECT b.id, s.tag, s.status, COALESCE(MAX(s.location), b.location), 'scan', s.scanned_at, :now
+        FROM baggage_scan_staging s
+        JOIN baggage b ON b.baggage_tag = s.tag
+        WHERE NOT EXISTS (
+            SELECT 1 FROM baggage_events e
+            WHERE e.baggage_tag = s.tag AND e.occurred_at = s.scanned_at AND e.status = s.status
+        )
+        GROUP BY b.id, b.location, s.tag, s.status, s.scanned_at
+    """), {"now": datetime.utcnow()})
+    previous = {row[0]: row[1:] for row in db.execute(text(f"""
+        SELECT b.id, bk.flight_id, b.status, b.weight
+        FROM baggage b
+        JOIN baggage_scan_staging s ON s.tag = b.baggage_tag
+        LEFT JOIN bookings bk ON bk.id = b.booking_id
+        WHERE s.is_latest AND (b.last_event_at IS NULL OR b.last_event_at < s.scanned_at)
+        {lock_rows(db, "b")}
+    """))}
+    updated = db.execute(text("""
+        UPDATE baggage
+        SET status = s.status,
+            location = COALESCE(s.location, baggage.location),
+            last_event_at = s.scanned_at
+        FROM baggage_scan_staging s
+        WHERE baggage.baggage_tag = s.tag AND s.is_latest
+          AND (baggage.last_event_at IS NULL OR baggage.last_event_at < s.scanned_at)
+        RETURNING baggage.baggage_tag, baggage.booking_id, baggage.status, baggage.location, baggage.id
+    """)).fetchall()
+    add_flight_totals(db, [
+        (previous[row[4]][0], previous[row[4]][1], row[2], previous[row[4]][2])
+        for row in updated if row[4] in previous
+    ])
+    unknown = {row[0] for row in db.execute(text("""
+        SELECT s.tag FROM baggage_scan_staging s
+        WHERE s.is_latest AND NOT EXISTS (SELECT 1 FROM baggage b WHERE b.baggage_tag = s.tag)
+    """))}
+    db.commit()
+
+    for tag in sorted(unknown):
+        reason = "unknown_tag" if is_valid_baggage_tag(tag) else "invalid_tag"
+        rejected.append(ScanRejection(index=latest[tag].index, tag=tag, reason=reason))
+    return {
+        "applied": len(updated),
+        "stale": superseded + len(latest) - len(updated) - len(unknown),
+        "updates": [
+            {"baggage_tag": row[0], "booking_id": row[1], "status": row[2], "location": row[3],
+             "occurred_at": latest[row[0]].scanned_at.isoformat()}
+            for row in updated
+        ],
+    }
+
+
+def transition_flight_baggage(db: Session, flight_id: int, target: str, location: Optional[str]) -> dict:
+    """Move every bag on a flight that may enter target into it with one UPDATE (one commit)"""
+    sources = [current for current, targets in BAGGAGE_TRANSITIONS.items() if target in targets]
+    now = datetime.utcnow()
+    previous = {row[0]: row[1:] for row in db.execute(
+        text(f"""
+            SELECT b.id, b.status, b.weight
+            FROM baggage b
+            JOIN bookings bk ON bk.id = b.booking_id
+            WHERE bk.flight_id = :flight_id AND b.status IN :sources
+            {lock_rows(db, "b")}
+        """).bindparams(bindparam("sources", expanding=True)),
+        {"flight_id": flight_id, "sources": sources}
+    )}
+    updated = []
+    if previous:
+        updated = db.execute(
+            text("""
+                UPDATE baggage
+                SET status = :target, location = COALESCE(:location, location), last_event_at = :now
+                WHERE id IN :ids
+                RETURNING id, baggage_tag, booking_id, status, location
+            """).bindparams(bindparam("ids", expanding=True)),
+            {"target": target, "location": location, "now": now, "ids": sorted(previous)}
+        ).fetchall()
+        add_flight_totals(db, [(flight_id, previous[row[0]][0], target, previous[row[0]][1]) for row in updated])
+    if updated:
+        insert_baggage_events(db, [
+            {"baggage_id": row[0], "baggage_tag": row[1], "status": row[3], "location": row[4]}
+            for row in updated
+        ], "flight", now)
+    remaining = {
+        status_name: totals.bags
+        for status_name, totals in get_flight_totals(db, flight_id).items() if status_name != target
+    }
+    db.commit()
+    
+    updates = [
+        {"baggage_tag": row[1], "booking_id": row[2], "status": row[3], "location": row[4],
+         "occurred_at": now.isoformat()}
+        for row in updated
+    ]
+    return {"updates": updates, "remaining": remaining}
+
+
+def group_tags_by_passenger(db: Session, updates: List[dict]) -> Dict[int, List[str]]:
+    """Passenger user_id -> tags of their bags among updates (one query)"""
+    booking_ids = sorted({update["booking_id"] for update in updates})
+    if not booking_ids:
+        return {}
+    owners = dict(db.execute(
+        text("SELECT id, user_id FROM bookings WHERE id IN :booking_ids")
+        .bindparams(bindparam("booking_ids", expanding=True)),
+        {"booking_ids": booking_ids}
+    ).fetchall())
+    tags_by_user: Dict[int, List[str]] = {}
+    for update in updates:
+        user_id = owners.get(update["booking_id"])
+        if user_id is not None:
+            tags_by_user.setdefault(user_id, []).append(update["baggage_tag"])
+    return tags_by_user
+
+
+async def notify_flight_baggage(flight_id: int, target: str, location: Optional[str],
+                                tags_by_user: Dict[int, List[str]]):
+    """One request to notification-service for the whole flight, one email per passenger"""
+    try:
+        async with httpx.AsyncClient() as client:
+            await client.post(
+                f"{NOTIFICATION_SERVICE_URL}/notify-baggage-batch",
+                json={
+                    "flight_id": flight_id,
+                    "status": target,
+                    "location": location,
+                    "passengers": [
+                        {"user_id": user_id, "baggage_tags": tags}
+                        for user_id, tags in tags_by_user.items()
+                    ]
+                },
+                timeout=30.0
+            )
+    except Exception as e:
+        print(f"Failed to send flight baggage notifications: {e}")
+
+
+def stream_flight_manifest(db: Session, flight_id: int) -> Iterator[dict]:
+    """Yield the bags of a flight through a server-side cursor, then the totals of the same pass"""
+    connection = db.connection().execution_options(yield_per=BAGGAGE_MANIFEST_FETCH_SIZE)
+    rows = connection.execute(
+        text("""
+            SELECT b.baggage_tag, b.booking_id, bk.seat_number, b.weight, b.status, b.location, b.last_event_at
+            FROM baggage b
+            JOIN bookings bk ON bk.id = b.booking_id
+            WHERE bk.flight_id = :flight_id
+            ORDER BY b.booking_id, b.id
+        """).columns(last_event_at=DateTime),
+        {"flight_id": flight_id}
+    )
+    
+    by_status: Dict[str, dict] = {}
+    for row in rows:
+        weight = float(row.weight) if row.weight is not None else None
+        totals = by_status.setdefault(row.status, {"bags": 0, "weight": 0.0})
+        totals["bags"] += 1
+        totals["weight"] += weight or 0.0
+        yield {
+            "type": "bag",
+            "baggage_tag": row.baggage_tag,
+            "booking_id": row.booking_id,
+            "seat_number": row.seat_number,
+            "weight": weight,
+            "status": row.status,
+            "location": row.location,
+            "last_event_at": row.last_event_at.isoformat() if row.last_event_at else None
+        }
+    
+    for totals in by_status.values():
+        totals["weight"] = round(totals["weight"], 2)
+    yield {
+        "type": "totals",
+        "flight_id": flight_id,
+        "bags": sum(totals["bags"] for totals in by_status.values()),
+        "weight": round(sum(totals["weight"] for totals in by_status.values()), 2),
+        "by_status": by_status
+    }
+
+
+def manifest_csv_lines(records: Iterator[dict]) -> Iterator[str]:
+    """Bag rows under a header, then a blank line and a status,bags,weight totals section"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    def flush() -> str:
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+    
+    writer.writerow(MANIFEST_COLUMNS)
+    yield flush()
+    for record in records:
+        if record["type"] == "bag":
+            writer.writerow([record[column] if record[column] is not None else "" for column in MANIFEST_COLUMNS])
+            yield flush()
+            continue
+        writer.writerow([])
+        writer.writerow(("status", "bags", "weight"))
+        for status_name, totals in record["by_status"].items():
+            writer.writerow((status_name, totals["bags"], totals["weight"]))
+        writer.writerow(("total", record["bags"], record["weight"]))
+        yield flush()
+
+
+# Baggage labels
+# 4x6" термоэтикетка: 203 dpi для ZPL, 288x432 pt для PDF
+ZPL_LABEL = "\n".join([
+    "^XA^CI28^PW812^LL1218",
+    "^FO40,40^A0N,70,70^FH^FD{destination}^FS",
+    "^FO40,130^A0N,45,45^FH^FD{flight_number}  {departure}^FS",
+    "^FO40,200^A0N,32,32^FH^FD{passenger}^FS",
+    "^FO40,250^A0N,32,32^FH^FDBooking {booking_id}  {weight}^FS",
+    "^FO60,340^BY4^BCN,300,N,N,N^FH^FD{baggage_tag}^FS",
+    "^FO40,700^A0N,90,90^FH^FD{baggage_tag}^FS",
+    "^XZ",
+    "",
+])
+PDF_LABEL_PAGE = "\n".join([
+    "BT /F2 36 Tf 20 380 Td ({destination}) Tj ET",
+    "BT /F2 18 Tf 20 350 Td ({flight_number}  {departure}) Tj ET",
+    "BT /F1 12 Tf 20 326 Td ({passenger}) Tj ET",
+    "BT /F1 12 Tf 20 309 Td (Booking {booking_id}  {weight}) Tj ET",
+    "{barcode}",
+    "BT /F2 30 Tf 20 50 Td ({baggage_tag}) Tj ET",
+])
+PDF_LABEL_SIZE = (288, 432)
+
+# Ширины штрихов и пробелов символов Code 128 (значения 0-105), затем стоп-символ
+CODE128_PATTERNS = (
+    "212222", "222122", "222221", "121223", "121322", "131222", "122213", "122312", "132212", "221213",
+    "221312", "231212", "112232", "122132", "122231", "113222", "123122", "123221", "223211", "221132",
+    "221231", "213212", "223112", "312131", "311222", "321122", "321221", "312212", "322112", "322211",
+    "212123", "212321", "232121", "111323", "131123", "131321", "112313", "132113", "132311", "211313",
+    "231113", "231311", "112133", "112331", "132131", "113123", "113321", "133121", "313121", "211331",
+    "231131", "213113", "213311", "213131", "311123", "311321", "331121", "312113", "312311", "332111",
+    "314111", "221411", "431111", "111224", "111422", "121124", "121421", "141122", "141221", "112214",
+    "112412", "122114", "122411", "142112", "142211", "241211", "221114", "413111", "241112", "134111",
+    "111242", "121142", "121241", "114212", "124112", "124211", "411212", "421112", "421211", "212141",
+    "214121", "412121", "111143", "111341", "131141", "114113", "114311", "411113", "411311", "113141",
+    "114131", "311141", "411131", "211412", "211214", "211232",
+)
+CODE128_STOP = "2331112"
+CODE128_START_B = 104
+
+
+def zpl_text(value: str) -> bytes:
+    """Field data for ^FH: ZPL command prefixes (^ ~), the hex indicator (_) and
+    control characters as _XX escapes"""
+    return "".join(
+        "".join(f"_{byte:02X}" for byte in ch.encode())
+        if ch in "^~_" or unicodedata.category(ch) == "Cc" else ch
+        for ch in value
+    ).encode()
+
+
+class LabelTemplate:
+    """Template split once into literal chunks and {field} slots; rendering only joins bytes"""
+
+    def __init__(self, source: str, escape: Callable[[str], bytes]):
+        self.escape = escape
+        self.parts = [
+            (literal.encode(), field)
+            for literal, field, _, _ in string.Formatter().parse(source)
+        ]
+
+    def render(self, fields: dict) -> bytes:
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                value = fields[field]
+                out.append(value if isinstance(value, bytes) else self.escape(value))
+        return b"".join(out)
+
+
+LABEL_TEMPLATES = {
+    "zpl": LabelTemplate(ZPL_LABEL, zpl_text),
+    "pdf": LabelTemplate(PDF_LABEL_PAGE, pdf_text),
+}
+
+
+def code128_modules(value: str) -> str:
+    """Bar/space widths of value in Code 128 set B, with start, check and stop symbols"""
+    codes = [CODE128_START_B] + [ord(ch) - 32 for ch in value]
+    check = (codes[0] + sum(i * code for i, code in enumerate(codes[1:], start=1))) % 103
+    return "".join(CODE128_PATTERNS[code] for code in codes + [check]) + CODE128_STOP
+
+
+def pdf_barcode(value: str, x: float = 20, y: float = 100, height: float = 180) -> bytes:
+    """PDF fill operators drawing value as a Code 128 barcode"""
+    widths = code128_modules(value)
+    module = min(2.0, (PDF_LABEL_SIZE[0] - 2 * x) / sum(int(w) for w in widths))
+    rects = []
+    for i, width in enumerate(widths):
+        width = int(width) * module
+        if i % 2 == 0:
+            rects.append(b"%.2f %.2f %.2f %.2f re" % (x, y, width, height))
+        x += width
+    return b"0 g\n" + b"\n".join(rects) + b"\nf"
+
+
+def label_fields(row) -> dict:
+    departure = row.departure_time.strftime("%d%b").upper() if row.departure_time else ""
+    return {
+        "baggage_tag": row.baggage_tag,
+        "destination": (row.destination or "").upper()[:16],
+        "flight_number": row.flight_number or "",
+        "departure": departure,
+        "passenger": f"{(row.last_name or '').upper()}/{(row.first_name or '').upper()}",
+        "booking_id": str(row.booking_id),
+        "weight": f"{float(row.weight):.1f} kg" if row.weight else "",
+    }
+
+
+class LabelCache:
+    """LRU cache of rendered labels keyed by (format, tag).
+    
+    An entry is reused only while the label fields (passenger, flight,
+    weight) are unchanged, so no invalidation is needed.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, label_format: str, fields: dict) -> bytes:
+        key = (label_format, fields["baggage_tag"])
+        snapshot = tuple(fields.values())
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == snapshot:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        if label_format == "pdf":
+            fields = dict(fields, barcode=pdf_barcode(fields["baggage_tag"]))
+        rendered = LABEL_TEMPLATES[label_format].render(fields)
+        self._entries[key] = (snapshot, rendered)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return rendered
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+label_cache = LabelCache(LABEL_CACHE_MAX_ENTRIES)
+
+
+def build_labels_pdf(pages: List[bytes]) -> bytes:
+    """Multi-page PDF with one label content stream per page"""
+    width, height = PDF_LABEL_SIZE
+    first_page = 5
+    kids = b" ".join(b"%d 0 R" % (first_page + 2 * i) for i in range(len(pages)))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(pages)),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+    ]
+    for i, stream in enumerate(pages):
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %d 0 R >>"
+            % (width, height, first_page + 2 * i + 1)
+        )
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+    return write_pdf(objects)
+
+
+def load_label_rows(db: Session, booking_id: Optional[int], tags: Optional[List[str]]) -> list:
+    """Label data of a booking's bags or of the given tags (one query)"""
+    if booking_id is not None:
+        condition, params = "b.booking_id = :booking_id", {"booking_id": booking_id}
+    else:
+        condition, params = "b.baggage_tag IN :tags", {"tags": tags}
+    statement = text(f"""
+        SELECT b.baggage_tag, b.weight, b.booking_id, u.first_name, u.last_name,
+               f.flight_number, f.destination, f.departure_time
+        FROM baggage b
+        LEFT JOIN bookings bk ON bk.id = b.booking_id
+        LEFT JOIN users u ON u.id = bk.user_id
+        LEFT JOIN flights f ON f.id = bk.flight_id
+        WHERE {condition}
+        ORDER BY b.id
+    """).columns(departure_time=DateTime)
+    if tags is not None and booking_id is None:
+        statement = statement.bindparams(bindparam("tags", expanding=True))
+    return db.execute(statement, params).fetchall()
 
 
 # Routes
+@app.post("/baggage/labels")
+async def render_baggage_labels(
+    label_request: LabelRequest,
+    admin_info: dict = Depends(verify_admin),
+    db: Session = Depends(get_db)
+):
+    """Printer-ready labels for a booking or a list of tags, as ZPL or a multi-page PDF"""
+    if label_request.format not in LABEL_TEMPLATES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Format must be zpl or pdf"
+        )
+    if (label_request.booking_id is None) == (not label_request.tags):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Specify either booking_id or tags"
+        )
+    if label_request.tags and len(label_request.tags) > BAGGAGE_LABEL_MAX_TAGS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {BAGGAGE_LABEL_MAX_TAGS} tags per request"
+        )
+    
+    rows = load_label_rows(db, label_request.booking_id, label_request.tags)
+    if label_request.tags:
+        missing = sorted(set(label_request.tags) - {row.baggage_tag for row in rows})
+        if missing:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Baggage not found: {', '.join(missing)}"
+            )
+    if not rows:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No baggage for this booking"
+        )
+    
+    labels = [label_cache.render(label_request.format, label_fields(row)) for row in rows]
+    if label_request.format == "pdf":
+        return Response(
+            content=build_labels_pdf(labels),
+            media_type="application/pdf",
+            headers={"Content-Disposition": 'attachment; filename="baggage-labels.pdf"'}
+        )
+    return Response(
+        content=b"".join(labels),
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="baggage-labels.zpl"'}
+    )
+
+
+@app.get("/flights/{flight_id}/baggage/totals", response_model=FlightBaggageTotalsResponse)
+async def get_flight_baggage_totals(
+    flight_id: int,
+    admin_info: dict = Depends(verify_admin),
+    db: Session = Depends(get_db)
+):
+    """Bag count and weight of a flight by status, from the maintained totals"""
+    by_status = get_flight_totals(db, flight_id)
+    return FlightBaggageTotalsResponse(
+        flight_id=flight_id,
+        bags=sum(totals.bags for totals in by_status.values()),
+        weight=round(sum(totals.weight for totals in by_status.values()), 2),
+        by_status=by_status
+    )
+
+
+@app.get("/flights/{flight_id}/baggage/manifest")
+async def get_flight_manifest(
+    flight_id: int,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    admin_info: dict = Depends(verify_admin),
+    db: Session = Depends(get_db)
+):
+    """Stream the baggage manifest of a flight as NDJSON or CSV, totals last"""
+    records = stream_flight_manifest(db, flight_id)
+    if format == "csv":
+        return StreamingResponse(
+            manifest_csv_lines(records),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="manifest-flight-{flight_id}.csv"'}
+        )
+    return StreamingResponse(
+        (json.dumps(record) + "\n" for record in records),
+        media_type="application/x-ndjson"
+    )
+
+
+@app.post("/flights/{flight_id}/baggage/status", response_model=FlightBaggageTransitionResponse)
+async def transition_flight(
+    flight_id: int,
+    transition: FlightBaggageTransition,
+    background_tasks: BackgroundTasks,
+    admin_info: dict = Depends(verify_admin),
+    db: Session = Depends(get_db)
+):
+    """Move all bags on a flight to a new status, e.g. loaded or unloaded"""
+    if transition.status not in BAGGAGE_TRANSITIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown baggage status: {transition.status}"
+        )
+    
+    result = transition_flight_baggage(db, flight_id, transition.status, transition.location)
+    for update in result["updates"]:
+        baggage_broker.publish(update)
+    tags_by_user = group_tags_by_passenger(db, result["updates"])
+    if tags_by_user:
+        background_tasks.add_task(notify_flight_baggage, flight_id, transition.status, transition.location, tags_by_user)
+    
+    return FlightBaggageTransitionResponse(
+        flight_id=flight_id,
+        status=transition.status,
+        transitioned=len(result["updates"]),
+        remaining=result["remaining"],
+        notified_passengers=len(tags_by_user)
+    )
+
+
+async def read_scan_body(request: Request) -> bytes:
+    """Request body, refused with 413 as soon as it exceeds BAGGAGE_SCAN_MAX_BYTES"""
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"At most {BAGGAGE_SCAN_MAX_BYTES} bytes per request"
+    )
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > BAGGAGE_SCAN_MAX_BYTES:
+        raise too_large
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > BAGGAGE_SCAN_MAX_BYTES:
+            raise too_large
+    return bytes(body)
+
+
+@app.post("/baggage/scans", response_model=ScanIngestResponse, dependencies=[Depends(verify_scanner)])
+async def ingest_scans(request: Request, db: Session = Depends(get_db)):
+    """Apply a batch of scanner events sent as JSON lines or packed binary records.
+    
+    Parsing and the database work run in a worker thread so a bulk batch
+    does not hold up the event loop and the baggage streams.
+    """
+    body = await read_scan_body(request)
+    rejected: List[ScanRejection] = []
+    if request.headers.get("content-type", "").startswith("application/octet-stream"):
+        try:
+            events = await asyncio.to_thread(parse_scan_records, body, rejected)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    else:
+        events = await asyncio.to_thread(parse_scan_lines, body, datetime.utcnow(), rejected)
+    received = len(events) + len(rejected)
+    if received > BAGGAGE_SCAN_MAX_EVENTS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {BAGGAGE_SCAN_MAX_EVENTS} events per request"
+        )
+    
+    result = await asyncio.to_thread(ingest_scan_events, db, events, rejected)
+    for update in result["updates"]:
+        baggage_broker.publish(update)
+    rejected.sort(key=lambda r: r.index)
+    return ScanIngestResponse(received=received, applied=result["applied"], stale=result["stale"], rejected=rejected)
+
+
 @app.post("/baggage", response_model=BaggageResponse, status_code=status.HTTP_201_CREATED)
 async def create_baggage(
     baggage_data: BaggageCreate,
@@ -148,32 +1510,39 @@ async def create_baggage(
     user_id = user_info["user_id"]
     
     # Check if booking exists and belongs to user
-    if not check_booking_ownership(db, baggage_data.booking_id, user_id):
+    booking = check_booking_ownership(db, baggage_data.booking_id, user_id)
+    if booking is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Booking not found or does not belong to you"
         )
     
-    # Generate unique baggage tag
-    baggage_tag = generate_baggage_tag()
-    
-    # Check if tag is unique (very unlikely but check anyway)
-    existing = db.query(Baggage).filter(Baggage.baggage_tag == baggage_tag).first()
-    while existing:
-        baggage_tag = generate_baggage_tag()
-        existing = db.query(Baggage).filter(Baggage.baggage_tag == baggage_tag).first()
-    
-    # Create baggage record
-    new_baggage = Baggage(
-        booking_id=baggage_data.booking_id,
-        baggage_tag=baggage_tag,
-        weight=baggage_data.weight,
-        status="checked_in",
-        location="Airport Check-in"
-    )
-    db.add(new_baggage)
+    # Allocated tags never repeat; a conflict is only possible with an old
+    # randomly generated tag, in which case the next serial is taken
+    for _ in range(BAGGAGE_TAG_MAX_ATTEMPTS):
+        new_baggage = Baggage(
+            booking_id=baggage_data.booking_id,
+            baggage_tag=generate_baggage_tag(db),
+            weight=baggage_data.weight,
+            status="checked_in",
+            location="Airport Check-in"
+        )
+        db.add(new_baggage)
+        try:
+            db.flush()
+            break
+        except IntegrityError:
+            db.rollback()
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Could not allocate a baggage tag"
+        )
+    record_baggage_event(db, new_baggage, "checkin")
+    add_flight_totals(db, [(booking.flight_id, None, new_baggage.status, new_baggage.weight)])
     db.commit()
     db.refresh(new_baggage)
+    baggage_broker.publish(baggage_update_message(new_baggage))
     
     return BaggageResponse(
         id=new_baggage.id,
@@ -186,6 +1555,25 @@ async def create_baggage(
     )
 
 
+@app.get("/baggage/search", response_model=List[BaggageSearchResult])
+async def search_lost_baggage(
+    tag: Optional[str] = None,
+    name: Optional[str] = None,
+    flight: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    admin_info: dict = Depends(verify_admin),
+    db: Session = Depends(get_db)
+):
+    """Fuzzy lost-and-found lookup by partial or misread tag and passenger name"""
+    if not tag and not name:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Specify tag or name"
+        )
+    
+    return search_baggage(db, tag or None, name or None, flight or None, limit)
+
+
 @app.get("/baggage/status/{baggage_tag}", response_model=BaggageStatusResponse)
 async def get_baggage_status(
     baggage_tag: str,
@@ -195,7 +1583,7 @@ async def get_baggage_status(
     """Get baggage status by tag"""
     user_id = user_info["user_id"]
     
-    baggage = db.query(Baggage).filter(Baggage.baggage_tag == baggage_tag).first()
+    baggage = find_baggage(db, "b.baggage_tag = :baggage_tag", {"baggage_tag": baggage_tag})
     if not baggage:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -203,7 +1591,7 @@ async def get_baggage_status(
         )
     
     # Check if booking belongs to user
-    if not check_booking_ownership(db, baggage.booking_id, user_id):
+    if baggage.owner_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You don't have access to this baggage"
@@ -217,6 +1605,92 @@ async def get_baggage_status(
     )
 
 
+@app.get("/baggage/stream")
+async def stream_baggage(
+    tag: Optional[str] = None,
+    booking_id: Optional[int] = None,
+    user_info: dict = Depends(verify_token),
+    db: Session = Depends(get_db)
+):
+    """Server-sent events with status changes of one bag or of every bag on a booking"""
+    user_id = user_info["user_id"]
+    
+    if (tag is None) == (booking_id is None):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Specify either tag or booking_id"
+        )
+    if tag is not None:
+        baggage = find_baggage(db, "b.baggage_tag = :baggage_tag", {"baggage_tag": tag})
+        if not baggage:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Baggage not found"
+            )
+        rows = [baggage]
+        keys = [f"tag:{tag}"]
+    else:
+        rows = find_booking_baggage(db, booking_id)
+        keys = [f"booking:{booking_id}"]
+    if not rows or rows[0].owner_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN if tag is not None else status.HTTP_404_NOT_FOUND,
+            detail="You don't have access to this baggage"
+        )
+    snapshot = [baggage_update_message(row) for row in rows if row.id is not None]
+    # Соединение с БД возвращается в пул до начала потока
+    db.close()
+    
+    if baggage_broker.subscriber_count() >= BAGGAGE_STREAM_MAX_SUBSCRIBERS:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many tracking connections, try again later"
+        )
+    queue = baggage_broker.subscribe(keys)
+    return StreamingResponse(
+        baggage_event_stream(queue, snapshot, keys),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/baggage/{baggage_tag}/history", response_model=List[BaggageEventResponse])
+async def get_baggage_history(
+    baggage_tag: str,
+    user_info: dict = Depends(verify_token),
+    db: Session = Depends(get_db)
+):
+    """Every recorded status change of a bag, oldest first"""
+    user_id = user_info["user_id"]
+    
+    baggage = find_baggage(db, "b.baggage_tag = :baggage_tag", {"baggage_tag": baggage_tag})
+    if not baggage:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Baggage not found"
+        )
+    
+    if baggage.owner_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You don't have access to this baggage"
+        )
+    
+    result = db.execute(
+        text("""
+            SELECT status, location, source, occurred_at
+            FROM baggage_events
+            WHERE baggage_tag = :baggage_tag
+            ORDER BY occurred_at, id
+        """).columns(occurred_at=DateTime),
+        {"baggage_tag": baggage_tag}
+    )
+    return [
+        BaggageEventResponse(status=row[0], location=row[1], source=row[2], occurred_at=row[3])
+        for row in result
+    ]
+
+
 @app.get("/baggage/booking/{booking_id}", response_model=List[BaggageResponse])
 async def get_baggage_by_booking(
     booking_id: int,
@@ -226,27 +1700,15 @@ async def get_baggage_by_booking(
     """Get all baggage for a specific booking"""
     user_id = user_info["user_id"]
     
+    rows = find_booking_baggage(db, booking_id)
     # Check if booking belongs to user
-    if not check_booking_ownership(db, booking_id, user_id):
+    if not rows or rows[0].owner_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Booking not found or does not belong to you"
         )
     
-    baggage_list = db.query(Baggage).filter(Baggage.booking_id == booking_id).all()
-    
-    return [
-        BaggageResponse(
-            id=bg.id,
-            booking_id=bg.booking_id,
-            baggage_tag=bg.baggage_tag,
-            weight=float(bg.weight) if bg.weight else None,
-            status=bg.status,
-            location=bg.location,
-            created_at=bg.created_at
-        )
-        for bg in baggage_list
-    ]
+    return [baggage_response(row) for row in rows if row.id is not None]
 
 
 @app.get("/baggage/my", response_model=List[BaggageResponse])
@@ -296,7 +1758,7 @@ async def update_baggage(
     """Update baggage status (admin only in production, but simplified for demo)"""
     user_id = user_info["user_id"]
     
-    baggage = db.query(Baggage).filter(Baggage.id == baggage_id).first()
+    baggage = find_baggage(db, "b.id = :baggage_id", {"baggage_id": baggage_id}, lock=True)
     if not baggage:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -304,58 +1766,68 @@ async def update_baggage(
         )
     
     # Check if booking belongs to user (or could be admin check)
-    if not check_booking_ownership(db, baggage.booking_id, user_id):
+    if baggage.owner_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You don't have permission to update this baggage"
         )
     
-    old_status = baggage.status
-    
     if baggage_update.status:
-        baggage.status = baggage_update.status
-    if baggage_update.location:
-        baggage.location = baggage_update.location
+        check_transition(baggage.status, baggage_update.status)
+    new_status = baggage_update.status or baggage.status
+    new_location = baggage_update.location or baggage.location
+    if new_status == baggage.status and new_location == baggage.location:
+        return baggage_response(baggage)
     
+    now = datetime.utcnow()
+    updated = db.execute(
+        text(f"""
+            UPDATE baggage
+            SET status = :status, location = :location, last_event_at = :now
+            WHERE id = :baggage_id
+            RETURNING {", ".join(BAGGAGE_COLUMNS)}
+        """).columns(created_at=DateTime, last_event_at=DateTime),
+        {"status": new_status, "location": new_location, "now": now, "baggage_id": baggage_id}
+    ).first()
+    insert_baggage_events(db, [
+        {"baggage_id": updated.id, "baggage_tag": updated.baggage_tag,
+         "status": updated.status, "location": updated.location}
+    ], "update", now)
+    add_flight_totals(db, [(baggage.flight_id, baggage.status, updated.status, updated.weight)])
     db.commit()
-    db.refresh(baggage)
+    baggage_broker.publish(baggage_update_message(updated))
     
     # Send email notification if status changed
-    if baggage_update.status and baggage_update.status != old_status:
+    if updated.status != baggage.status:
         try:
-            import httpx
-            # Get user_id from booking
-            from sqlalchemy import text
-            result = db.execute(
-                text("SELECT user_id FROM bookings WHERE id = :booking_id"),
-                {"booking_id": baggage.booking_id}
-            )
-            booking_row = result.fetchone()
-            if booking_row:
-                async with httpx.AsyncClient() as client:
-                    await client.post(
-                        f"{NOTIFICATION_SERVICE_URL}/notify-baggage",
-                        json={
-                            "user_id": booking_row[0],
-                            "baggage_tag": baggage.baggage_tag,
-                            "status": baggage.status,
-                            "location": baggage.location
-                        },
-                        timeout=5.0
-                    )
+            async with httpx.AsyncClient() as client:
+                await client.post(
+                    f"{NOTIFICATION_SERVICE_URL}/notify-baggage",
+                    json={
+                        "user_id": baggage.owner_id,
+                        "baggage_tag": updated.baggage_tag,
+                        "status": updated.status,
+                        "location": updated.location
+                    },
+                    timeout=5.0
+                )
         except Exception as e:
             print(f"Failed to send baggage notification: {e}")
             # Don't fail the update if notification fails
     
-    return BaggageResponse(
-        id=baggage.id,
-        booking_id=baggage.booking_id,
-        baggage_tag=baggage.baggage_tag,
-        weight=float(baggage.weight) if baggage.weight else None,
-        status=baggage.status,
-        location=baggage.location,
-        created_at=baggage.created_at
-    )
+    return baggage_response(updated)
+
+
+@app.get("/metrics", dependencies=[Depends(verify_internal)])
+async def get_metrics():
+    return {
+        "stream": {
+            "subscribers": baggage_broker.subscriber_count(),
+            "published": baggage_broker.published,
+            "dropped": baggage_broker.dropped,
+        },
+        "labels": label_cache.stats()
+    }
 
 
 @app.get("/health")
@@ -1,15 +1,21 @@
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 import sys
 import os
 from jose import jwt
+import itertools
+import json
+from unittest.mock import AsyncMock, patch
 
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# Add repository root to path (shared helpers)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
+import main
 from main import app, get_db, Base, generate_baggage_tag, check_booking_ownership
 
 # Create in-memory SQLite database for testing
@@ -37,8 +43,11 @@ def db():
         # Drop tables first to avoid conflicts
         db.execute(text("DROP TABLE IF EXISTS baggage"))
         db.execute(text("DROP TABLE IF EXISTS bookings"))
+        db.execute(text("DROP TABLE IF EXISTS users"))
         
         # Create test tables
+        db.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, is_admin INTEGER DEFAULT 0)"))
+        db.execute(text("INSERT INTO users (id, first_name, last_name, is_admin) VALUES (99, 'Admin', 'User', 1)"))
         db.execute(text("""
             CREATE TABLE bookings (
                 id INTEGER PRIMARY KEY,
@@ -56,7 +65,8 @@ def db():
                 weight REAL,
                 status TEXT,
                 location TEXT,
-                created_at TIMESTAMP
+                created_at TIMESTAMP,
+                last_event_at TIMESTAMP
             )
         """))
         db.commit()
@@ -84,6 +94,9 @@ def client(db):
             pass
     
     app.dependency_overrides[get_db] = override_get_db
+    # В SQLite нет последовательностей: блоки номеров выдаются счетчиком
+    blocks = itertools.count(0, main.BAGGAGE_TAG_BLOCK_SIZE)
+    main.tag_allocator = main.TagAllocator(main.BAGGAGE_TAG_BLOCK_SIZE, lambda db: next(blocks))
     with TestClient(app) as test_client:
         yield test_client
     app.dependency_overrides.clear()
@@ -109,16 +122,100 @@ def test_booking(db):
     return {"id": 1, "user_id": 1}
 
 
+@pytest.fixture
+def admin_token():
+    """Create an admin JWT token"""
+    return jwt.encode({"sub": "99", "is_admin": True}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+
+@pytest.fixture
+def flight_bags(db):
+    """Bags on flight 7 (two bookings) and flight 8"""
+    db.execute(text("DELETE FROM bookings"))
+    db.execute(text("""
+        INSERT INTO bookings (id, user_id, flight_id, seat_number, status) VALUES
+        (1, 1, 7, 'A1', 'confirmed'), (2, 2, 7, 'A2', 'confirmed'), (3, 3, 8, 'B1', 'confirmed')
+    """))
+    db.execute(text("""
+        INSERT INTO baggage (id, booking_id, baggage_tag, weight, status, location, created_at) VALUES
+        (1, 1, 'TAG000001', 20.5, 'checked_in', 'Check-in', datetime('now')),
+        (2, 1, 'TAG000002', 8, 'checked_in', 'Check-in', datetime('now')),
+        (3, 2, 'TAG000003', 23, 'delivered', 'Belt 1', datetime('now')),
+        (4, 3, 'TAG000004', 15, 'checked_in', 'Check-in', datetime('now'))
+    """))
+    main.rebuild_flight_totals(db)
+    db.commit()
+
+
+@pytest.fixture
+def passengers(db, flight_bags):
+    """Passengers and flights of flight_bags"""
+    db.execute(text("DROP TABLE IF EXISTS flights"))
+    db.execute(text("""
+        CREATE TABLE flights (
+            id INTEGER PRIMARY KEY,
+            flight_number TEXT,
+            destination TEXT,
+            departure_time TIMESTAMP
+        )
+    """))
+    db.execute(text("""
+        INSERT INTO users (id, first_name, last_name) VALUES
+        (1, 'Ion', 'Popescu'), (2, 'Maria', 'Ionescu'), (3, 'Иван', 'Петров')
+    """))
+    db.execute(text("""
+        INSERT INTO flights (id, flight_number, destination, departure_time) VALUES
+        (7, 'RO203', 'London', '2026-11-05 08:30:00'), (8, 'RO405', 'Paris', '2026-11-06 10:00:00')
+    """))
+    db.commit()
+    yield
+    db.execute(text("DROP TABLE flights"))
+    db.commit()
+
+
 class TestBaggageTagGeneration:
     """Test baggage tag generation"""
     
-    def test_generate_baggage_tag(self):
+    def test_generate_baggage_tag(self, client, db):
         """Test baggage tag generation"""
-        tag = generate_baggage_tag()
+        tag = generate_baggage_tag(db)
         assert tag is not None
         assert len(tag) == 9  # 3 letters + 6 numbers
         assert tag[:3].isalpha()
         assert tag[3:].isdigit()
+        assert main.is_valid_baggage_tag(tag)
+    
+    def test_tags_unique_and_checked(self):
+        """Test that serials map to distinct tags that detect typos"""
+        tags = [main.encode_baggage_tag(serial) for serial in range(0, 26 ** 3 * 10 ** 5, 99991)]
+        assert len(set(tags)) == len(tags)
+        assert main.encode_baggage_tag(100000) == "AAB000003"
+        for tag in tags[:200]:
+            assert main.is_valid_baggage_tag(tag)
+            # Любая одиночная замена цифры и перестановка соседних цифр ловятся
+            for i in range(3, 9):
+                for digit in "0123456789":
+                    if digit != tag[i]:
+                        assert not main.is_valid_baggage_tag(tag[:i] + digit + tag[i + 1:])
+            for i in range(3, 8):
+                swapped = tag[:i] + tag[i + 1] + tag[i] + tag[i + 2:]
+                if swapped != tag and {tag[i], tag[i + 1]} != {"0", "9"}:
+                    assert not main.is_valid_baggage_tag(swapped)
+        with pytest.raises(ValueError):
+            main.encode_baggage_tag(26 ** 3 * 10 ** 5)
+    
+    def test_allocator_reserves_blocks(self, db):
+        """Test that the database is touched once per block"""
+        reserved = []
+        
+        def reserve(session):
+            reserved.append(len(reserved) * 10)
+            return reserved[-1]
+        
+        allocator = main.TagAllocator(10, reserve)
+        serials = [allocator.allocate(db) for _ in range(25)]
+        assert serials == list(range(25))
+        assert len(reserved) == 3
 
 
 class TestBaggageCreation:
@@ -142,6 +239,22 @@ class TestBaggageCreation:
         assert data["status"] == "checked_in"
         assert "baggage_tag" in data
     
+    def test_create_baggage_skips_taken_tag(self, client, test_booking, test_token, db):
+        """Test that an old random tag equal to the allocated one is skipped"""
+        db.execute(text("""
+            INSERT INTO baggage (id, booking_id, baggage_tag, status, location, created_at)
+            VALUES (1, 1, :tag, 'checked_in', 'Airport Check-in', datetime('now'))
+        """), {"tag": main.encode_baggage_tag(0)})
+        db.commit()
+        
+        response = client.post(
+            "/baggage",
+            json={"booking_id": 1, "weight": 10},
+            headers={"Authorization": f"Bearer {test_token}"}
+        )
+        assert response.status_code == 201
+        assert response.json()["baggage_tag"] == main.encode_baggage_tag(1)
+    
     def test_create_baggage_wrong_booking(self, client, test_token):
         """Test creating baggage for non-existent booking"""
         baggage_data = {
@@ -194,6 +307,40 @@ class TestBaggageQueries:
         baggage_list = response.json()
         assert len(baggage_list) == 1
     
+    def test_reads_are_single_queries(self, client, test_booking, test_token, db):
+        """Bag, owner and flight come from one joined statement"""
+        db.execute(text("""
+            INSERT INTO baggage (id, booking_id, baggage_tag, status, location, created_at)
+            VALUES (1, 1, 'ABC123456', 'checked_in', 'Airport Check-in', datetime('now'))
+        """))
+        db.execute(text("INSERT INTO bookings (id, user_id, flight_id, seat_number, status) VALUES (2, 1, 1, 'A2', 'confirmed')"))
+        db.commit()
+        
+        statements = []
+        
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            headers = {"Authorization": f"Bearer {test_token}"}
+            assert client.get("/baggage/status/ABC123456", headers=headers).status_code == 200
+            assert len(statements) == 1
+            
+            statements.clear()
+            assert len(client.get("/baggage/booking/1", headers=headers).json()) == 1
+            assert client.get("/baggage/booking/2", headers=headers).json() == []
+            assert len(statements) == 2
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+    
+    def test_get_baggage_by_foreign_booking(self, client, test_booking, db):
+        other_token = jwt.encode({"sub": "2"}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+        response = client.get("/baggage/booking/1", headers={"Authorization": f"Bearer {other_token}"})
+        assert response.status_code == 404
+        response = client.get("/baggage/booking/99", headers={"Authorization": f"Bearer {other_token}"})
+        assert response.status_code == 404
+    
     def test_get_my_baggage(self, client, test_booking, test_token, db):
         """Test getting all user's baggage"""
         # Create baggage
@@ -237,6 +384,559 @@ class TestBaggageUpdate:
         data = response.json()
         assert data["status"] == "in_transit"
         assert data["location"] == "In transit"
+    
+    def test_update_baggage_invalid_transition(self, client, test_booking, test_token, db):
+        """Delivered baggage cannot go back to loaded"""
+        db.execute(text("""
+            INSERT INTO baggage (id, booking_id, baggage_tag, status, location, created_at)
+            VALUES (1, 1, 'ABC123456', 'delivered', 'Belt 3', datetime('now'))
+        """))
+        db.commit()
+        
+        response = client.put(
+            "/baggage/1",
+            json={"status": "loaded"},
+            headers={"Authorization": f"Bearer {test_token}"}
+        )
+        assert response.status_code == 400
+        assert "delivered" in response.json()["detail"]
+        
+        # Смена только локации без смены статуса разрешена
+        response = client.put(
+            "/baggage/1",
+            json={"status": "delivered", "location": "Lost and found desk"},
+            headers={"Authorization": f"Bearer {test_token}"}
+        )
+        assert response.status_code == 200
+
+
+class TestFlightTransition:
+    """Test flight-level bulk status transitions"""
+    
+    def test_load_flight(self, client, db, flight_bags, admin_token):
+        """Only bags of the flight that may be loaded are moved, one notification per flight"""
+        with patch("main.httpx.AsyncClient") as mock_client:
+            post = AsyncMock()
+            mock_client.return_value.__aenter__.return_value.post = post
+            response = client.post(
+                "/flights/7/baggage/status",
+                json={"status": "loaded", "location": "Aircraft hold"},
+                headers={"Authorization": f"Bearer {admin_token}"}
+            )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["transitioned"] == 2
+        assert data["remaining"] == {"delivered": 1}
+        assert data["notified_passengers"] == 1
+        
+        rows = db.execute(text("SELECT id, status, location FROM baggage ORDER BY id")).fetchall()
+        assert [tuple(row) for row in rows] == [
+            (1, "loaded", "Aircraft hold"),
+            (2, "loaded", "Aircraft hold"),
+            (3, "delivered", "Belt 1"),
+            (4, "checked_in", "Check-in"),
+        ]
+        events = db.execute(text("SELECT baggage_tag, source FROM baggage_events ORDER BY baggage_tag")).fetchall()
+        assert [tuple(row) for row in events] == [("TAG000001", "flight"), ("TAG000002", "flight")]
+        
+        assert post.call_count == 1
+        payload = post.call_args.kwargs["json"]
+        assert payload["flight_id"] == 7
+        assert payload["passengers"] == [{"user_id": 1, "baggage_tags": ["TAG000001", "TAG000002"]}]
+    
+    def test_flight_transition_requires_admin(self, client, flight_bags, test_token):
+        response = client.post(
+            "/flights/7/baggage/status",
+            json={"status": "loaded"},
+            headers={"Authorization": f"Bearer {test_token}"}
+        )
+        assert response.status_code == 403
+    
+    def test_unknown_status(self, client, flight_bags, admin_token):
+        response = client.post(
+            "/flights/7/baggage/status",
+            json={"status": "teleported"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 400
+
+
+class TestFlightTotals:
+    """Test incrementally maintained per-flight totals"""
+    
+    def get_totals(self, client, admin_token, flight_id=7):
+        response = client.get(
+            f"/flights/{flight_id}/baggage/totals",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        return response.json()
+    
+    def test_totals_follow_changes(self, client, db, flight_bags, admin_token):
+        """Check-in, manual update, scan and flight transition all move the totals"""
+        assert self.get_totals(client, admin_token) == {
+            "flight_id": 7,
+            "bags": 3,
+            "weight": 51.5,
+            "by_status": {"checked_in": {"bags": 2, "weight": 28.5}, "delivered": {"bags": 1, "weight": 23.0}}
+        }
+        
+        user_token = jwt.encode({"sub": "2"}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+        response = client.post(
+            "/baggage",
+            json={"booking_id": 2, "weight": 10.25},
+            headers={"Authorization": f"Bearer {user_token}"}
+        )
+        assert response.status_code == 201
+        new_id = response.json()["id"]
+        new_tag = response.json()["baggage_tag"]
+        
+        response = client.put(
+            f"/baggage/{new_id}",
+            json={"status": "in_transit"},
+            headers={"Authorization": f"Bearer {user_token}"}
+        )
+        assert response.status_code == 200
+        response = client.post(
+            "/baggage/scans",
+            content=json.dumps({"tag": new_tag, "status": "loaded", "scanned_at": "2030-01-01T10:00:00"}),
+            headers={"X-Scanner-Key": main.SCANNER_API_KEY}
+        )
+        assert response.json()["applied"] == 1
+        
+        totals = self.get_totals(client, admin_token)
+        assert totals["bags"] == 4
+        assert totals["weight"] == 61.75
+        assert totals["by_status"] == {
+            "checked_in": {"bags": 2, "weight": 28.5},
+            "delivered": {"bags": 1, "weight": 23.0},
+            "loaded": {"bags": 1, "weight": 10.25},
+        }
+        
+        with patch("main.httpx.AsyncClient"):
+            response = client.post(
+                "/flights/7/baggage/status",
+                json={"status": "loaded"},
+                headers={"Authorization": f"Bearer {admin_token}"}
+            )
+        assert response.json()["remaining"] == {"delivered": 1}
+        assert self.get_totals(client, admin_token)["by_status"] == {
+            "delivered": {"bags": 1, "weight": 23.0},
+            "loaded": {"bags": 3, "weight": 38.75},
+        }
+        # Другие рейсы не затронуты
+        assert self.get_totals(client, admin_token, flight_id=8)["by_status"] == {
+            "checked_in": {"bags": 1, "weight": 15.0}
+        }
+    
+    def test_rebuild_repairs_drift(self, client, db, flight_bags, admin_token):
+        db.execute(text("UPDATE flight_baggage_totals SET bags = 40 WHERE flight_id = 7"))
+        db.execute(text("INSERT INTO flight_baggage_totals (flight_id, status, bags, weight) VALUES (9, 'lost', 1, 5)"))
+        db.commit()
+        
+        main.rebuild_flight_totals(db, [7, 9])
+        db.commit()
+        totals = self.get_totals(client, admin_token)
+        assert totals["bags"] == 3
+        assert totals["weight"] == 51.5
+        assert self.get_totals(client, admin_token, flight_id=9)["bags"] == 0
+
+
+class TestBaggageSearch:
+    """Test fuzzy lost-and-found search"""
+    
+    def search(self, client, admin_token, **params):
+        response = client.get("/baggage/search", params=params, headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 200
+        return response.json()
+    
+    def test_trigram_similarity(self):
+        assert main.trigram_similarity("TAG000001", "tag000001") == 1.0
+        assert main.trigram_similarity("word", "two words") == pytest.approx(4 / 11)  # как similarity() в pg_trgm
+        assert main.trigram_similarity("abc", None) == 0.0
+    
+    def test_search_by_misread_tag(self, client, passengers, admin_token):
+        results = self.search(client, admin_token, tag="TAG00004")
+        assert results[0]["baggage_tag"] == "TAG000004"
+        assert results[0]["passenger_name"] == "Иван Петров"
+        assert results[0]["flight_number"] == "RO405"
+        assert [r["score"] for r in results] == sorted((r["score"] for r in results), reverse=True)
+    
+    def test_search_by_name_and_flight(self, client, passengers, admin_token):
+        results = self.search(client, admin_token, name="Popesku", flight="RO203")
+        assert {r["baggage_tag"] for r in results} == {"TAG000001", "TAG000002"}
+        assert self.search(client, admin_token, name="Zzyzx Qwerty") == []
+    
+    def test_search_requires_query(self, client, passengers, admin_token, test_token):
+        response = client.get("/baggage/search?flight=RO203", headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 400
+        response = client.get("/baggage/search?tag=TAG", headers={"Authorization": f"Bearer {test_token}"})
+        assert response.status_code == 403
+
+
+class TestBaggageLabels:
+    """Test batch label rendering"""
+    
+    @pytest.fixture(autouse=True)
+    def empty_cache(self):
+        main.label_cache = main.LabelCache(main.LABEL_CACHE_MAX_ENTRIES)
+    
+    def post_labels(self, client, admin_token, **body):
+        return client.post("/baggage/labels", json=body, headers={"Authorization": f"Bearer {admin_token}"})
+    
+    def test_code128_symbols(self):
+        """Every symbol is 11 modules wide with an even number of bar modules"""
+        assert len(set(main.CODE128_PATTERNS)) == 106
+        for pattern in main.CODE128_PATTERNS:
+            assert sum(int(w) for w in pattern) == 11
+            assert sum(int(w) for w in pattern[::2]) % 2 == 0
+        # START B, "A" (33), контрольный символ (104 + 33) % 103 = 34, STOP
+        assert main.code128_modules("A") == "211214" + "111323" + "131123" + "2331112"
+    
+    def test_zpl_for_booking(self, client, passengers, admin_token):
+        response = self.post_labels(client, admin_token, booking_id=1)
+        assert response.status_code == 200
+        zpl = response.text
+        assert zpl.count("^XA") == 2
+        assert "^FDTAG000001^FS" in zpl and "^FDTAG000002^FS" in zpl
+        assert "^FDLONDON^FS" in zpl
+        assert "^FDRO203  05NOV^FS" in zpl
+        assert "^FDPOPESCU/ION^FS" in zpl
+        assert "^FDBooking 1  20.5 kg^FS" in zpl
+    
+    def test_pdf_for_tags(self, client, passengers, admin_token):
+        response = self.post_labels(client, admin_token, tags=["TAG000004", "TAG000003"], format="pdf")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/pdf"
+        pdf = response.content
+        assert pdf.startswith(b"%PDF-1.4") and pdf.rstrip().endswith(b"%%EOF")
+        assert b"/Count 2" in pdf
+        assert b"(PETROV/IVAN)" in pdf
+        assert b"(TAG000003)" in pdf and b"re\n" in pdf
+    
+    def test_zpl_text_escapes(self):
+        """Test that ZPL prefixes and control characters cannot break out of a field"""
+        assert main.zpl_text("A^XZ~B_\nC") == b"A_5EXZ_7EB_5F_0AC"
+    
+    def test_labels_cached_per_tag(self, client, passengers, admin_token, db):
+        self.post_labels(client, admin_token, booking_id=1)
+        self.post_labels(client, admin_token, tags=["TAG000001"])
+        assert main.label_cache.stats()["hits"] == 1
+        assert main.label_cache.stats()["misses"] == 2
+        
+        # Изменившиеся данные бирки перерисовываются
+        db.execute(text("UPDATE users SET last_name = 'Popa' WHERE id = 1"))
+        db.commit()
+        response = self.post_labels(client, admin_token, tags=["TAG000001"])
+        assert "^FDPOPA/ION^FS" in response.text
+        assert main.label_cache.stats()["misses"] == 3
+    
+    def test_label_errors(self, client, passengers, admin_token, test_token):
+        assert self.post_labels(client, admin_token, tags=["TAG000001", "NOPE"]).status_code == 404
+        assert self.post_labels(client, admin_token, booking_id=1, tags=["TAG000001"]).status_code == 400
+        assert self.post_labels(client, admin_token, booking_id=1, format="png").status_code == 400
+        assert self.post_labels(client, test_token, booking_id=1).status_code == 403
+
+
+class TestFlightManifest:
+    """Test the streaming flight manifest"""
+    
+    def test_manifest_ndjson(self, client, flight_bags, admin_token):
+        response = client.get("/flights/7/baggage/manifest", headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        records = [json.loads(line) for line in response.text.splitlines()]
+        assert [r["baggage_tag"] for r in records[:-1]] == ["TAG000001", "TAG000002", "TAG000003"]
+        assert records[0]["seat_number"] == "A1"
+        assert records[-1] == {
+            "type": "totals",
+            "flight_id": 7,
+            "bags": 3,
+            "weight": 51.5,
+            "by_status": {"checked_in": {"bags": 2, "weight": 28.5}, "delivered": {"bags": 1, "weight": 23.0}}
+        }
+    
+    def test_manifest_csv(self, client, flight_bags, admin_token):
+        response = client.get(
+            "/flights/7/baggage/manifest?format=csv",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        lines = response.text.splitlines()
+        assert lines[0] == "baggage_tag,booking_id,seat_number,weight,status,location,last_event_at"
+        assert lines[1] == "TAG000001,1,A1,20.5,checked_in,Check-in,"
+        assert lines[4:] == ["", "status,bags,weight", "checked_in,2,28.5", "delivered,1,23.0", "total,3,51.5"]
+    
+    def test_manifest_access(self, client, flight_bags, admin_token, test_token):
+        response = client.get("/flights/7/baggage/manifest", headers={"Authorization": f"Bearer {test_token}"})
+        assert response.status_code == 403
+        response = client.get(
+            "/flights/7/baggage/manifest?format=xml",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 422
+
+
+class TestScanIngestion:
+    """Test bulk scanner event ingestion"""
+    
+    @pytest.fixture
+    def bags(self, db, test_booking):
+        tags = [main.encode_baggage_tag(serial) for serial in range(3)]
+        for i, tag in enumerate(tags):
+            db.execute(text("""
+                INSERT INTO baggage (id, booking_id, baggage_tag, status, location, created_at)
+                VALUES (:id, 1, :tag, 'checked_in', 'Airport Check-in', datetime('now'))
+            """), {"id": i + 1, "tag": tag})
+        db.commit()
+        return tags
+    
+    def post_scans(self, client, body, content_type="application/x-ndjson", key=None):
+        return client.post("/baggage/scans", content=body, headers={
+            "Content-Type": content_type,
+            "X-Scanner-Key": key or main.SCANNER_API_KEY
+        })
+    
+    def test_ingest_json_lines(self, client, db, bags):
+        """Test that valid events are applied and the rest are reported"""
+        events = [
+            {"tag": bags[0], "status": "in_transit", "location": "Belt 1", "scanned_at": "2026-05-01T10:00:00"},
+            {"tag": bags[0], "status": "loaded", "location": "Gate 5", "scanned_at": "2026-05-01T10:05:00"},
+            {"tag": bags[1], "status": "in_transit", "scanned_at": "2026-05-01T10:00:00+02:00"},
+            {"tag": "AAA000014", "status": "loaded"},
+            {"tag": bags[2], "status": "teleported"},
+            {"tag": main.encode_baggage_tag(500), "status": "loaded"},
+        ]
+        body = "\n".join(json.dumps(event) for event in events) + "\nnot json\n"
+        response = self.post_scans(client, body)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["received"] == 7
+        assert data["applied"] == 2
+        assert data["stale"] == 1
+        assert [(r["index"], r["reason"]) for r in data["rejected"]] == [
+            (3, "invalid_tag"), (4, "invalid_status"), (5, "unknown_tag"), (6, "malformed")
+        ]
+        
+        rows = dict(db.execute(text("SELECT baggage_tag, status || '@' || COALESCE(location, '') FROM baggage")).fetchall())
+        assert rows[bags[0]] == "loaded@Gate 5"
+        assert rows[bags[1]] == "in_transit@Airport Check-in"
+        assert rows[bags[2]] == "checked_in@Airport Check-in"
+        
+        # Запоздавший скан из прошлого не откатывает статус
+        response = self.post_scans(client, json.dumps(
+            {"tag": bags[0], "status": "in_transit", "scanned_at": "2026-05-01T09:00:00"}
+        ))
+        assert response.json()["applied"] == 0
+        assert response.json()["stale"] == 1
+    
+    def test_ingest_binary_records(self, client, db, bags):
+        """Test the packed binary format, with tags matched case-insensitively"""
+        body = b""
+        for tag, code, location in [(bags[0].lower(), 2, "Gate 5"), (bags[1], 4, ""), (bags[2], 99, "")]:
+            raw = location.encode()
+            body += main.SCAN_RECORD.pack(tag.encode(), code, 1777777777, len(raw)) + raw
+        response = self.post_scans(client, body, "application/octet-stream")
+        assert response.status_code == 200
+        assert response.json()["applied"] == 2
+        assert response.json()["rejected"] == [{"index": 2, "tag": None, "reason": "invalid_status"}]
+        assert db.execute(text("SELECT status FROM baggage WHERE id = 2")).scalar() == "delivered"
+        
+        response = self.post_scans(client, body[:-3], "application/octet-stream")
+        assert response.status_code == 400
+    
+    def test_scans_recorded_in_history(self, client, db, bags, test_token):
+        """Test that every scan is appended once, including superseded ones"""
+        body = "\n".join(json.dumps(event) for event in [
+            {"tag": bags[0], "status": "in_transit", "location": "Belt 1", "scanned_at": "2026-05-01T10:00:00"},
+            {"tag": bags[0], "status": "loaded", "location": "Gate 5", "scanned_at": "2026-05-01T10:05:00"},
+        ])
+        self.post_scans(client, body)
+        self.post_scans(client, body)
+        
+        response = client.get(f"/baggage/{bags[0]}/history", headers={"Authorization": f"Bearer {test_token}"})
+        assert response.status_code == 200
+        assert [(e["status"], e["location"], e["source"]) for e in response.json()] == [
+            ("in_transit", "Belt 1", "scan"),
+            ("loaded", "Gate 5", "scan"),
+        ]
+    
+    def test_duplicates_in_batch_recorded_once(self, client, db, bags):
+        """Test that a scan repeated within one batch is appended once"""
+        event = json.dumps({"tag": bags[0], "status": "loaded", "location": "Gate 5", "scanned_at": "2026-05-01T10:05:00"})
+        self.post_scans(client, f"{event}\n{event}")
+        
+        count = db.execute(text("SELECT COUNT(*) FROM baggage_events WHERE baggage_tag = :tag"), {"tag": bags[0]}).scalar()
+        assert count == 1
+    
+    def test_legacy_tags_accepted(self, client, db, bags):
+        """Test that an existing tag with a wrong check digit is still applied"""
+        legacy_tag = bags[0][:8] + str((int(bags[0][8]) + 1) % 10)
+        db.execute(text("""
+            INSERT INTO baggage (id, booking_id, baggage_tag, status, location, created_at)
+            VALUES (10, 1, :tag, 'checked_in', 'Airport Check-in', datetime('now'))
+        """), {"tag": legacy_tag})
+        db.commit()
+        
+        response = self.post_scans(client, json.dumps({"tag": legacy_tag, "status": "loaded"}))
+        assert response.json()["applied"] == 1
+        assert response.json()["rejected"] == []
+    
+    def test_ingest_body_size_limit(self, client, bags):
+        """Test that an oversized body is refused before it is parsed"""
+        with patch.object(main, "BAGGAGE_SCAN_MAX_BYTES", 100):
+            response = self.post_scans(client, json.dumps({"tag": bags[0], "status": "loaded"}) * 5)
+        assert response.status_code == 413
+    
+    def test_ingest_requires_scanner_key(self, client, bags):
+        """Test that scans without the scanner key are refused"""
+        response = self.post_scans(client, json.dumps({"tag": bags[0], "status": "loaded"}), key="wrong")
+        assert response.status_code == 401
+
+
+class TestBaggageHistory:
+    """Test the append-only event history"""
+    
+    def test_history_follows_changes(self, client, test_booking, test_token):
+        """Test that check-in and updates are appended in order"""
+        headers = {"Authorization": f"Bearer {test_token}"}
+        created = client.post("/baggage", json={"booking_id": 1, "weight": 20}, headers=headers).json()
+        client.put(f"/baggage/{created['id']}", json={"status": "in_transit", "location": "Belt 3"}, headers=headers)
+        # Повтор того же статуса не добавляет событие
+        client.put(f"/baggage/{created['id']}", json={"status": "in_transit"}, headers=headers)
+        client.put(f"/baggage/{created['id']}", json={"location": "Aircraft"}, headers=headers)
+        
+        response = client.get(f"/baggage/{created['baggage_tag']}/history", headers=headers)
+        assert response.status_code == 200
+        assert [(e["status"], e["location"], e["source"]) for e in response.json()] == [
+            ("checked_in", "Airport Check-in", "checkin"),
+            ("in_transit", "Belt 3", "update"),
+            ("in_transit", "Aircraft", "update"),
+        ]
+    
+    def test_history_of_foreign_bag(self, client, test_booking, test_token, db):
+        """Test that another passenger's history is not returned"""
+        db.execute(text("INSERT INTO bookings (id, user_id, flight_id, seat_number, status) VALUES (2, 2, 1, 'B1', 'confirmed')"))
+        db.execute(text("""
+            INSERT INTO baggage (id, booking_id, baggage_tag, status, location, created_at)
+            VALUES (1, 2, 'ABC123456', 'checked_in', 'Airport Check-in', datetime('now'))
+        """))
+        db.commit()
+        
+        response = client.get("/baggage/ABC123456/history", headers={"Authorization": f"Bearer {test_token}"})
+        assert response.status_code == 403
+        response = client.get("/baggage/ZZZ999992/history", headers={"Authorization": f"Bearer {test_token}"})
+        assert response.status_code == 404
+    
+    def test_month_start(self):
+        """Test partition month boundaries"""
+        from datetime import date
+        assert main.month_start(date(2026, 11, 15), 2) == date(2027, 1, 1)
+        assert main.month_start(date(2026, 1, 31), -1) == date(2025, 12, 1)
+
+
+class TestBaggageStream:
+    """Test push updates through the in-process broker"""
+    
+    async def test_stream_snapshot_then_updates(self):
+        """Test that a subscriber gets the snapshot, its updates and keepalives"""
+        keys = ["tag:AAA000004"]
+        queue = main.baggage_broker.subscribe(keys)
+        stream = main.baggage_event_stream(queue, [{"baggage_tag": "AAA000004", "status": "checked_in"}], keys)
+        
+        assert (await stream.__anext__()).startswith("event: snapshot\n")
+        main.baggage_broker.publish({"baggage_tag": "AAA000012", "booking_id": 7, "status": "loaded"})
+        main.baggage_broker.publish({"baggage_tag": "AAA000004", "booking_id": 7, "status": "loaded"})
+        message = await stream.__anext__()
+        assert message.startswith("event: status\n")
+        assert json.loads(message.split("data: ")[1])["baggage_tag"] == "AAA000004"
+        
+        main.BAGGAGE_STREAM_KEEPALIVE_SECONDS, keepalive = 0.01, main.BAGGAGE_STREAM_KEEPALIVE_SECONDS
+        try:
+            assert await stream.__anext__() == ": keepalive\n\n"
+        finally:
+            main.BAGGAGE_STREAM_KEEPALIVE_SECONDS = keepalive
+        await stream.aclose()
+        assert main.baggage_broker.subscriber_count() == 0
+    
+    def test_slow_subscriber_drops_oldest(self):
+        """Test that publishing never blocks on a full queue"""
+        broker = main.BaggageBroker(queue_size=2)
+        queue = broker.subscribe(["booking:1"])
+        for i in range(3):
+            broker.publish({"baggage_tag": f"T{i}", "booking_id": 1})
+        assert [queue.get_nowait()["baggage_tag"] for _ in range(2)] == ["T1", "T2"]
+        assert broker.dropped == 1
+    
+    def test_update_is_published(self, client, test_booking, test_token):
+        """Test that check-in and status changes reach booking subscribers"""
+        keys = ["booking:1"]
+        queue = main.baggage_broker.subscribe(keys)
+        try:
+            headers = {"Authorization": f"Bearer {test_token}"}
+            created = client.post("/baggage", json={"booking_id": 1, "weight": 20}, headers=headers).json()
+            client.put(f"/baggage/{created['id']}", json={"status": "loaded"}, headers=headers)
+            updates = [queue.get_nowait() for _ in range(queue.qsize())]
+            assert [(u["baggage_tag"], u["status"]) for u in updates] == [
+                (created["baggage_tag"], "checked_in"),
+                (created["baggage_tag"], "loaded"),
+            ]
+        finally:
+            main.baggage_broker.unsubscribe(queue, keys)
+    
+    def test_stream_access(self, client, test_booking, test_token, db):
+        """Test that streams are only opened for the owner's bags"""
+        headers = {"Authorization": f"Bearer {test_token}"}
+        db.execute(text("INSERT INTO bookings (id, user_id, flight_id, seat_number, status) VALUES (2, 2, 1, 'B1', 'confirmed')"))
+        db.execute(text("""
+            INSERT INTO baggage (id, booking_id, baggage_tag, status, location, created_at)
+            VALUES (1, 2, 'ABC123456', 'checked_in', 'Airport Check-in', datetime('now'))
+        """))
+        db.commit()
+        
+        assert client.get("/baggage/stream", headers=headers).status_code == 400
+        assert client.get("/baggage/stream", params={"tag": "ABC123456", "booking_id": 1}, headers=headers).status_code == 400
+        assert client.get("/baggage/stream", params={"tag": "ABC123456"}, headers=headers).status_code == 403
+        assert client.get("/baggage/stream", params={"tag": "ZZZ999992"}, headers=headers).status_code == 404
+        assert client.get("/baggage/stream", params={"booking_id": 2}, headers=headers).status_code == 404
+        assert main.baggage_broker.subscriber_count() == 0
+    
+    def test_metrics_require_internal_key(self, client):
+        """Test that stream and ingest metrics are only served to internal callers"""
+        assert client.get("/metrics").status_code == 401
+        
+        response = client.get("/metrics", headers={"X-Internal-Key": main.INTERNAL_API_KEY})
+        assert response.status_code == 200
+        assert "stream" in response.json()
+
+
+class TestJWKSVerification:
+    """Test local token verification against a cached JWKS"""
+    
+    def test_rs256_token_verified_locally(self, client, test_booking, monkeypatch):
+        """Test that an RS256 token is verified with the cached public key"""
+        import main
+        from jose import jwk
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        pem = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode()
+        public_key = {**jwk.construct(pem, "RS256").public_key().to_dict(), "kid": "k1"}
+        monkeypatch.setattr(main.token_verifier, "algorithm", "RS256")
+        monkeypatch.setattr(main.token_verifier, "keys", {"k1": public_key})
+        monkeypatch.setattr(main.token_verifier, "fetched_at", float("inf"))
+        
+        token = jwt.encode({"sub": "1"}, pem, algorithm="RS256", headers={"kid": "k1"})
+        response = client.get("/baggage/my", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        
+        unknown = jwt.encode({"sub": "1"}, pem, algorithm="RS256", headers={"kid": "k2"})
+        response = client.get("/baggage/my", headers={"Authorization": f"Bearer {unknown}"})
+        assert response.status_code == 401
 
 
 class TestHealthCheck:
@@ -14,6 +14,8 @@ import os
 import httpx
 import traceback
 
+from shared.jwks import TokenVerifier
+
 app = FastAPI(title="Booking Service", version="1.0.0")
 
 # CORS configuration - должно быть ПЕРВЫМ middleware
@@ -82,6 +84,8 @@ AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth-service:8000")
 NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "http://notification-service:8000")
 JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-jwt-key-change-in-production")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWKS_URL = os.getenv("JWKS_URL", f"{AUTH_SERVICE_URL}/.well-known/jwks.json")
+token_verifier = TokenVerifier(JWT_ALGORITHM, JWT_SECRET, JWKS_URL)
 
 
 # Database Models
@@ -135,6 +139,11 @@ class BookingWithFlight(BookingResponse):
 
 
 # Helper functions
+@app.on_event("startup")
+async def load_jwks():
+    await token_verifier.load()
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -157,7 +166,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         
         print(f"Verifying token: {token[:20]}...")  # Логируем первые 20 символов для отладки
         
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = await token_verifier.decode(token)
         user_id_raw = payload.get("sub")
         
         if user_id_raw is None:
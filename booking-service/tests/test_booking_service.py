@@ -10,6 +10,8 @@ from datetime import datetime, timedelta
 
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# Add repository root to path (shared helpers)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
 from main import app, get_db, Base, verify_token
 from jose import jwt
@@ -1,7 +1,13 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useTranslation } from 'react-i18next';
 import { baggageAPI, bookingAPI, paymentAPI } from '../services/api';
 
+// Формат бирки baggage-service: 3 буквы + 6 цифр. Контрольную цифру здесь не проверяем:
+// у бирок, выданных до ее введения, она случайная, и такие бирки должен найти сервер
+export function isValidBaggageTag(tag) {
+  return /^[A-Z]{3}[0-9]{6}$/.test(tag);
+}
+
 function BaggageStatus() {
   const { t } = useTranslation();
   const [baggageTag, setBaggageTag] = useState('');
@@ -13,12 +19,31 @@ function BaggageStatus() {
   const [showAddForm, setShowAddForm] = useState(false);
   const [selectedBooking, setSelectedBooking] = useState('');
   const [baggageWeight, setBaggageWeight] = useState('');
+  const unwatchRef = useRef(null);
 
   useEffect(() => {
     loadMyBaggage();
     loadBookings();
+    return () => unwatchRef.current && unwatchRef.current();
   }, []);
 
+  // Статус найденной бирки обновляется сервером (SSE), без повторных запросов
+  const watchTag = (tag) => {
+    if (unwatchRef.current) {
+      unwatchRef.current();
+    }
+    unwatchRef.current = baggageAPI.watchBaggage({ tag }, (event, data) => {
+      if (event === 'status') {
+        setStatus((current) => (current && current.baggage_tag === data.baggage_tag
+          ? { ...current, status: data.status, location: data.location }
+          : current));
+        setMyBaggage((items) => items.map((item) => (item.baggage_tag === data.baggage_tag
+          ? { ...item, status: data.status, location: data.location }
+          : item)));
+      }
+    });
+  };
+
   const loadBookings = async () => {
     try {
       const response = await bookingAPI.getBookings();
@@ -62,12 +87,18 @@ function BaggageStatus() {
       setError(t('baggage.enterTag'));
       return;
     }
+    if (!isValidBaggageTag(baggageTag)) {
+      setError(t('baggage.invalidTag'));
+      setStatus(null);
+      return;
+    }
 
     try {
       setLoading(true);
       setError('');
       const response = await baggageAPI.getBaggageStatus(baggageTag);
       setStatus(response.data);
+      watchTag(response.data.baggage_tag);
     } catch (err) {
       setError(err.response?.data?.detail || t('baggage.noBaggage'));
       setStatus(null);
@@ -137,6 +168,12 @@ function BaggageStatus() {
               </button>
             </form>
 
+            {error && !showAddForm && (
+              <div className="mt-6 p-4 bg-red-50 border-l-4 border-red-500 rounded-lg">
+                <p className="text-red-800 font-semibold">{error}</p>
+              </div>
+            )}
+
             {status && (
               <div className="mt-10 p-10 bg-white rounded-3xl border-2 border-gray-200 shadow-xl">
                 <h4 className="text-3xl font-black text-black mb-8">{t('baggage.status')}</h4>
@@ -3,6 +3,10 @@ import { useTranslation } from 'react-i18next';
 import { bookingAPI, paymentAPI } from '../services/api';
 import { useNavigate } from 'react-router-dom';
 
+// Опрос статуса платежа: до минуты с интервалом 1.5 с
+const PAYMENT_POLL_INTERVAL_MS = 1500;
+const PAYMENT_POLL_ATTEMPTS = 40;
+
 function Flights() {
   const { t } = useTranslation();
   const navigate = useNavigate();
@@ -18,6 +22,7 @@ function Flights() {
   const [loadingSeats, setLoadingSeats] = useState(false);
   const [bookingLoading, setBookingLoading] = useState(false);
   const [paymentLoading, setPaymentLoading] = useState(false);
+  const [paymentProcessing, setPaymentProcessing] = useState(false);
   const [success, setSuccess] = useState('');
   const [createdBooking, setCreatedBooking] = useState(null);
   const [bookingFlightPrice, setBookingFlightPrice] = useState(0);
@@ -192,6 +197,19 @@ function Flights() {
     return null;
   };
 
+  const waitForPayment = async (bookingId) => {
+    // Опрашиваем статус платежа, пока шлюз не вернёт окончательный ответ
+    for (let attempt = 0; attempt < PAYMENT_POLL_ATTEMPTS; attempt++) {
+      await new Promise(resolve => setTimeout(resolve, PAYMENT_POLL_INTERVAL_MS));
+      const response = await paymentAPI.getPaymentByBooking(bookingId);
+      const status = response.data?.status;
+      if (status === 'completed' || status === 'failed') {
+        return status;
+      }
+    }
+    return 'pending';
+  };
+
   const handlePayment = async (e) => {
     e.preventDefault();
     if (!createdBooking) return;
@@ -207,9 +225,6 @@ function Flights() {
       setPaymentLoading(true);
       setError('');
       
-      // Для учебных целей просто симулируем задержку обработки
-      await new Promise(resolve => setTimeout(resolve, 1500));
-      
       await paymentAPI.createPayment({
         booking_id: createdBooking.id,
         amount: bookingFlightPrice || 0,
@@ -217,7 +232,17 @@ function Flights() {
         currency: 'MDL'
       });
       
-      setSuccess(t('payment.paymentSuccess'));
+      // Платёж создаётся в статусе pending, ждём решения шлюза
+      setPaymentProcessing(true);
+      const status = await waitForPayment(createdBooking.id);
+      setPaymentProcessing(false);
+      
+      if (status === 'failed') {
+        setError(t('payment.paymentDeclined'));
+        return;
+      }
+      
+      setSuccess(status === 'completed' ? t('payment.paymentSuccess') : t('payment.stillProcessing'));
       setShowPayment(false);
       setCreatedBooking(null);
       setBookingFlightPrice(0);
@@ -229,6 +254,7 @@ function Flights() {
       }, 2000);
     } catch (err) {
       console.error('Payment error:', err);
+      setPaymentProcessing(false);
       setError(err.response?.data?.detail || t('payment.paymentError'));
     } finally {
       setPaymentLoading(false);
@@ -558,7 +584,7 @@ function Flights() {
                     disabled={paymentLoading}
                     className="flex-1 btn-primary text-lg py-6 font-black disabled:bg-gray-300 disabled:cursor-not-allowed"
                   >
-                    {paymentLoading ? t('common.loading') : t('bookings.payNow')}
+                    {paymentProcessing ? t('payment.processing') : paymentLoading ? t('common.loading') : t('bookings.payNow')}
                   </button>
                   <button
                     type="button"
@@ -31,13 +31,22 @@ function MyBookings() {
 
   const loadPayments = async () => {
     try {
-      const response = await paymentAPI.getPayments();
       const paymentsMap = {};
-      response.data.forEach(payment => {
-        if (payment.status === 'completed') {
-          paymentsMap[payment.booking_id] = payment;
+      let cursor = null;
+      do {
+        const params = { limit: 200 };
+        if (cursor) {
+          params.cursor = cursor;
         }
-      });
+        const response = await paymentAPI.getPayments(params);
+        // Платежи идут от новых к старым, для брони берём последний
+        response.data.forEach(payment => {
+          if (!paymentsMap[payment.booking_id]) {
+            paymentsMap[payment.booking_id] = payment;
+          }
+        });
+        cursor = response.headers['x-next-cursor'];
+      } while (cursor);
       setPayments(paymentsMap);
     } catch (err) {
       console.error('Error loading payments:', err);
@@ -46,7 +55,7 @@ function MyBookings() {
 
   const handleViewReceipt = (bookingId) => {
     const payment = payments[bookingId];
-    if (payment) {
+    if (payment && payment.status === 'completed') {
       navigate(`/receipt/${payment.payment_id}`);
     }
   };
@@ -133,6 +142,16 @@ function MyBookings() {
                         }`}>
                           {booking.status === 'confirmed' ? t('bookings.confirmed') : t('bookings.cancelled')}
                         </span>
+                        {payments[booking.id]?.status === 'pending' && (
+                          <span className="px-5 py-2 rounded-full text-sm font-bold bg-yellow-100 text-yellow-800">
+                            {t('bookings.paymentProcessing')}
+                          </span>
+                        )}
+                        {payments[booking.id]?.status === 'failed' && (
+                          <span className="px-5 py-2 rounded-full text-sm font-bold bg-red-100 text-red-800">
+                            {t('bookings.paymentFailed')}
+                          </span>
+                        )}
                       </div>
                       
                       <div className="grid grid-cols-1 md:grid-cols-3 gap-6">
@@ -163,7 +182,7 @@ function MyBookings() {
                     <div className="flex flex-col gap-4">
                       {booking.status === 'confirmed' && (
                         <>
-                          {payments[booking.id] && (
+                          {payments[booking.id]?.status === 'completed' && (
                             <button
                               onClick={() => handleViewReceipt(booking.id)}
                               className="px-8 py-4 bg-blue-500 hover:bg-blue-600 text-white font-black rounded-full transition-colors shadow-lg hover:shadow-xl whitespace-nowrap"
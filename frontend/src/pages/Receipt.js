@@ -42,6 +42,20 @@ function Receipt() {
     window.print();
   };
 
+  const handleDownloadPdf = async () => {
+    try {
+      const response = await paymentAPI.getReceiptPdf(paymentId);
+      const url = window.URL.createObjectURL(response.data);
+      const link = document.createElement('a');
+      link.href = url;
+      link.download = `receipt-${paymentId}.pdf`;
+      link.click();
+      window.URL.revokeObjectURL(url);
+    } catch (err) {
+      console.error('Error downloading receipt PDF:', err);
+    }
+  };
+
   if (loading) {
     return (
       <div className="min-h-screen bg-white flex items-center justify-center">
@@ -85,6 +99,12 @@ function Receipt() {
             >
               {t('receipt.print')}
             </button>
+            <button
+              onClick={handleDownloadPdf}
+              className="ml-4 px-8 py-4 bg-black hover:bg-gray-800 text-white font-black rounded-full transition-colors shadow-lg hover:shadow-xl"
+            >
+              {t('receipt.downloadPdf')}
+            </button>
             <button
               onClick={() => navigate('/bookings')}
               className="ml-4 px-8 py-4 bg-white hover:bg-gray-50 text-black font-black rounded-full border-2 border-black transition-colors shadow-lg"
@@ -42,6 +42,43 @@ export const baggageAPI = {
   getBaggageStatus: (tag) => api.get(`${BAGGAGE_SERVICE}/baggage/status/${tag}`),
   getBaggageByBooking: (bookingId) => api.get(`${BAGGAGE_SERVICE}/baggage/booking/${bookingId}`),
   getMyBaggage: () => api.get(`${BAGGAGE_SERVICE}/baggage/my`),
+  // Подписка на смены статуса (SSE): fetch вместо EventSource, чтобы передать токен в заголовке.
+  // Возвращает функцию отписки
+  watchBaggage: (params, onEvent) => {
+    const controller = new AbortController();
+    const query = new URLSearchParams(params).toString();
+    fetch(`${BAGGAGE_SERVICE}/baggage/stream?${query}`, {
+      headers: { Authorization: `Bearer ${localStorage.getItem('token')}` },
+      signal: controller.signal,
+    }).then(async (response) => {
+      if (!response.ok) {
+        return;
+      }
+      const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+      let buffer = '';
+      for (;;) {
+        const { value, done } = await reader.read();
+        if (done) {
+          break;
+        }
+        buffer += value;
+        const messages = buffer.split('\n\n');
+        buffer = messages.pop();
+        messages.forEach((message) => {
+          const event = message.match(/^event: (.*)$/m);
+          const data = message.match(/^data: (.*)$/m);
+          if (event && data) {
+            onEvent(event[1], JSON.parse(data[1]));
+          }
+        });
+      }
+    }).catch((err) => {
+      if (err.name !== 'AbortError') {
+        console.error('Baggage stream error:', err);
+      }
+    });
+    return () => controller.abort();
+  },
 };
 
 // Admin API
@@ -63,10 +100,11 @@ export const adminAPI = {
 // Payment API
 export const paymentAPI = {
   createPayment: (data) => api.post(`${PAYMENT_SERVICE}/payments`, data),
-  getPayments: () => api.get(`${PAYMENT_SERVICE}/payments`),
+  getPayments: (params) => api.get(`${PAYMENT_SERVICE}/payments`, { params }),
   getPayment: (paymentId) => api.get(`${PAYMENT_SERVICE}/payments/${paymentId}`),
   getPaymentByBooking: (bookingId) => api.get(`${PAYMENT_SERVICE}/payments/booking/${bookingId}`),
   getReceipt: (paymentId) => api.get(`${PAYMENT_SERVICE}/payments/${paymentId}/receipt`),
+  getReceiptPdf: (paymentId) => api.get(`${PAYMENT_SERVICE}/payments/${paymentId}/receipt.pdf`, { responseType: 'blob' }),
   refundPayment: (paymentId, data) => api.post(`${PAYMENT_SERVICE}/payments/${paymentId}/refund`, data),
 };
 
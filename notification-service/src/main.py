@@ -1,16 +1,19 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, status, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import List, Optional
 import os
+import httpx
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from jose import JWTError, jwt
 
+from shared.jwks import TokenVerifier
+
 app = FastAPI(title="Notification Service", version="1.0.0")
 
 # CORS configuration
@@ -29,8 +32,11 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Security
 security = HTTPBearer()
+AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth-service:8000")
 JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-jwt-key-change-in-production")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWKS_URL = os.getenv("JWKS_URL", f"{AUTH_SERVICE_URL}/.well-known/jwks.json")
+token_verifier = TokenVerifier(JWT_ALGORITHM, JWT_SECRET, JWKS_URL)
 
 # SMTP Configuration
 SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
@@ -65,6 +71,18 @@ class BaggageNotification(BaseModel):
     location: Optional[str] = None
 
 
+class PassengerBaggageNotification(BaseModel):
+    user_id: int
+    baggage_tags: List[str]
+
+
+class FlightBaggageNotification(BaseModel):
+    flight_id: int
+    status: str
+    location: Optional[str] = None
+    passengers: List[PassengerBaggageNotification]
+
+
 class PaymentNotification(BaseModel):
     user_id: int
     payment_id: str
@@ -78,6 +96,11 @@ class PaymentNotification(BaseModel):
 
 
 # Helper functions
+@app.on_event("startup")
+async def load_jwks():
+    await token_verifier.load()
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -90,7 +113,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
     """Verify JWT token"""
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = await token_verifier.decode(token)
         user_id = payload.get("sub")
         if user_id is None:
             raise HTTPException(
@@ -105,6 +128,18 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         )
 
 
+def build_email_message(to_email: str, subject: str, body: str, html: Optional[str] = None) -> MIMEMultipart:
+    """Plain text email with an optional HTML alternative"""
+    msg = MIMEMultipart('alternative')
+    msg['From'] = SMTP_FROM_EMAIL
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain', 'utf-8'))
+    if html:
+        msg.attach(MIMEText(html, 'html', 'utf-8'))
+    return msg
+
+
 def send_email(to_email: str, subject: str, body: str, html: Optional[str] = None) -> bool:
     """Send email via SMTP with improved error handling"""
     # Check if SMTP is configured
@@ -124,19 +159,7 @@ def send_email(to_email: str, subject: str, body: str, html: Optional[str] = Non
             print(f"[EMAIL ERROR] SMTP_PASSWORD is empty")
             return False
         
-        # Create email message
-        msg = MIMEMultipart('alternative')
-        msg['From'] = SMTP_FROM_EMAIL
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        # Add both plain text and HTML versions
-        part1 = MIMEText(body, 'plain', 'utf-8')
-        msg.attach(part1)
-        
-        if html:
-            part2 = MIMEText(html, 'html', 'utf-8')
-            msg.attach(part2)
+        msg = build_email_message(to_email, subject, body, html)
         
         # Connect to SMTP server and send email
         print(f"[EMAIL] Attempting to send email to {to_email} via {SMTP_HOST}:{SMTP_PORT}")
@@ -176,6 +199,30 @@ def send_email(to_email: str, subject: str, body: str, html: Optional[str] = Non
         return False
 
 
+def send_emails(emails: List[dict]) -> int:
+    """Send a batch of emails over one SMTP connection; returns how many were sent"""
+    if not SMTP_USER or not SMTP_PASSWORD:
+        return sum(send_email(**email) for email in emails)
+    
+    sent = 0
+    try:
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=10) as server:
+            if os.getenv("SMTP_DEBUG", "false").lower() == "true":
+                server.set_debuglevel(1)
+            server.starttls()
+            server.login(SMTP_USER, SMTP_PASSWORD)
+            for email in emails:
+                try:
+                    server.send_message(build_email_message(**email))
+                    sent += 1
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as e:
+                    print(f"[EMAIL ERROR] Could not send email to {email['to_email']}: {e}")
+    except Exception as e:
+        print(f"[EMAIL ERROR] Batch aborted after {sent} of {len(emails)} emails: {type(e).__name__}: {e}")
+    print(f"[EMAIL] Sent {sent} of {len(emails)} emails")
+    return sent
+
+
 # Routes
 @app.post("/send-email")
 async def send_email_endpoint(
@@ -438,6 +485,81 @@ async def notify_baggage_status(
     return {"message": "Baggage notification sent", "to": email}
 
 
+@app.post("/notify-baggage-batch")
+async def notify_baggage_batch(
+    notification: FlightBaggageNotification,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db)
+):
+    """Queue one baggage status email per passenger for a flight-wide change (internal service endpoint).
+    
+    The emails go out after the response, from the threadpool, over one SMTP connection.
+    """
+    from sqlalchemy import text, bindparam
+    
+    if not notification.passengers:
+        return {"message": "No users to notify", "count": 0}
+    
+    # Получатели и рейс одним запросом на весь пакет
+    tags_by_user = {p.user_id: p.baggage_tags for p in notification.passengers}
+    result = db.execute(
+        text("""
+            SELECT u.id, u.email, u.first_name, f.flight_number
+            FROM users u
+            LEFT JOIN flights f ON f.id = :flight_id
+            WHERE u.id IN :user_ids
+        """).bindparams(bindparam("user_ids", expanding=True)),
+        {"flight_id": notification.flight_id, "user_ids": list(tags_by_user)}
+    )
+    
+    status_ru = {
+        "in_transit": "В пути",
+        "loaded": "Загружен в самолет",
+        "unloaded": "Выгружен из самолета",
+        "delivered": "Доставлен",
+        "lost": "Утерян"
+    }.get(notification.status, notification.status)
+    
+    emails = []
+    for user_id, email, first_name, flight_number in result:
+        tags = tags_by_user[user_id]
+        flight = f" рейса {flight_number}" if flight_number else ""
+        subject = f"Обновление статуса багажа{flight}"
+        body = f"""
+Здравствуйте, {first_name}!
+
+Статус вашего багажа{flight} обновлен.
+
+Детали:
+- Номера бирок: {', '.join(tags)}
+- Статус: {status_ru}
+- Местоположение: {notification.location or 'Не указано'}
+
+С уважением,
+Команда Airline
+"""
+        html = f"""
+    <html>
+      <body>
+        <h2>Обновление статуса багажа</h2>
+        <p>Здравствуйте, <strong>{first_name}</strong>!</p>
+        <p>Статус вашего багажа{flight} обновлен.</p>
+        <h3>Детали:</h3>
+        <ul>
+          <li>Номера бирок: <strong>{', '.join(tags)}</strong></li>
+          <li>Статус: <strong>{status_ru}</strong></li>
+          <li>Местоположение: <strong>{notification.location or 'Не указано'}</strong></li>
+        </ul>
+        <p>С уважением,<br>Команда Airline</p>
+      </body>
+    </html>
+    """
+        emails.append({"to_email": email, "subject": subject, "body": body, "html": html})
+    
+    background_tasks.add_task(send_emails, emails)
+    return {"message": "Baggage notifications queued", "count": len(emails)}
+
+
 @app.post("/notify-payment")
 async def notify_payment_completed(
     notification: PaymentNotification,
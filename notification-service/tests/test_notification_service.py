@@ -10,8 +10,10 @@ from jose import jwt
 
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# Add repository root to path (shared helpers)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
-from main import app, get_db, send_email
+from main import app, get_db, send_email, send_emails
 
 # Create in-memory SQLite database for testing
 SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
@@ -186,6 +188,40 @@ class TestNotificationEndpoints:
             )
             assert response.status_code == 200
     
+    def test_notify_baggage_batch(self, client, test_user, db):
+        """Test one email per passenger for a flight-wide baggage change"""
+        db.execute(text("INSERT INTO users (id, email, first_name, last_name) VALUES (2, 'two@example.com', 'Two', 'User')"))
+        db.execute(text("INSERT INTO flights (id, flight_number, origin, destination) VALUES (1, 'FL001', 'Paris', 'London')"))
+        db.commit()
+        with patch('main.send_email', return_value=True) as send, \
+                patch('main.SMTP_USER', ''):
+            response = client.post("/notify-baggage-batch", json={
+                "flight_id": 1,
+                "status": "loaded",
+                "passengers": [
+                    {"user_id": 1, "baggage_tags": ["AAA000004", "AAA000012"]},
+                    {"user_id": 2, "baggage_tags": ["AAA000020"]}
+                ]
+            })
+        assert response.status_code == 200
+        assert response.json()["count"] == 2
+        assert send.call_count == 2
+        emails = {call.kwargs["to_email"]: call.kwargs for call in send.call_args_list}
+        assert "AAA000004, AAA000012" in emails["test@example.com"]["body"]
+        assert "FL001" in emails["two@example.com"]["subject"]
+    
+    def test_baggage_batch_reuses_smtp_connection(self):
+        """Test that a batch is sent over a single SMTP connection"""
+        emails = [
+            {"to_email": f"user{i}@example.com", "subject": "Baggage", "body": "Loaded", "html": None}
+            for i in range(3)
+        ]
+        with patch('main.SMTP_USER', 'user'), patch('main.SMTP_PASSWORD', 'secret'), \
+                patch('main.smtplib.SMTP') as smtp:
+            assert send_emails(emails) == 3
+        assert smtp.call_count == 1
+        assert smtp.return_value.__enter__.return_value.send_message.call_count == 3
+    
     def test_notify_payment(self, client, test_user):
         """Test payment notification"""
         with patch('main.send_email', return_value=True):
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк пропускной способности конвейера расчетов против симулятора шлюза
+Использование: python benchmarks/bench_settlement.py [--payments 2000] [--workers 64]
+                   [--latency-ms 1000 3000] [--batch-size 200]
+
+Таблица payments создается во временной базе SQLite, так что замер
+показывает конвейер и шлюз, а не конкретную СУБД.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from main import SettlementJob, SettlementPipeline, SimulatedGateway
+
+
+def prepare_database(count: int):
+    engine = create_engine(f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE payments (
+                id INTEGER PRIMARY KEY,
+                payment_id VARCHAR(100) UNIQUE,
+                status VARCHAR(20),
+                completed_at TIMESTAMP
+            )
+        """))
+        conn.execute(
+            text("INSERT INTO payments (payment_id, status) VALUES (:payment_id, 'pending')"),
+            [{"payment_id": f"BENCH-{i}"} for i in range(count)]
+        )
+    return engine
+
+
+async def run(args):
+    engine = prepare_database(args.payments)
+    pipeline = SettlementPipeline(
+        gateway=SimulatedGateway(args.latency_ms[0], args.latency_ms[1], args.failure_rate, seed=42),
+        session_factory=sessionmaker(bind=engine),
+        workers=args.workers,
+        batch_size=args.batch_size,
+        flush_interval=args.flush_interval,
+    )
+    await pipeline.start()
+    start = time.perf_counter()
+    for i in range(args.payments):
+        pipeline.submit(SettlementJob(
+            payment_id=f"BENCH-{i}", booking_id=i, user_id=1,
+            amount=100.0, currency="USD", payment_method="card"
+        ))
+    await pipeline.join()
+    elapsed = time.perf_counter() - start
+    await pipeline.stop()
+
+    with engine.connect() as conn:
+        pending = conn.execute(text("SELECT COUNT(*) FROM payments WHERE status = 'pending'")).scalar()
+
+    mean_latency = max(sum(args.latency_ms) / 2, 0.001) / 1000
+    print(f"Платежей:            {args.payments}")
+    print(f"Воркеров:            {args.workers}, батч {args.batch_size}")
+    print(f"Задержка шлюза:      {args.latency_ms[0]:.0f}-{args.latency_ms[1]:.0f} мс")
+    print(f"Время:               {elapsed:.2f} с")
+    print(f"Пропускная способн.: {args.payments / elapsed:.1f} платежей/с "
+          f"(предел при такой задержке {args.workers / mean_latency:.1f}/с)")
+    print(f"Завершено/отказов:   {pipeline.settled}/{pipeline.failed}, осталось pending: {pending}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера расчетов платежей")
+    parser.add_argument("--payments", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--latency-ms", type=float, nargs=2, default=[1000, 3000])
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--flush-interval", type=float, default=0.2)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
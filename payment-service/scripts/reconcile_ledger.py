@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Сверка платежей с бронированиями: отчет о расхождениях в формате NDJSON
+Использование: python scripts/reconcile_ledger.py [--output report.ndjson]
+                   [--from-booking 1] [--to-booking 1000000] [--unpaid-grace-minutes 60]
+
+Бронирования и платежи читаются двумя серверными курсорами, отсортированными
+по booking_id, и сливаются за один проход в постоянной памяти, поэтому
+сверка годится для десятков миллионов строк. Та же логика отдает отчет
+через GET /admin/reconciliation. Базу задает DATABASE_URL.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from main import SessionLocal, RECONCILIATION_UNPAID_GRACE_MINUTES, stream_ledger_discrepancies
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Сверка платежей с бронированиями")
+    parser.add_argument("--output", help="Файл отчета (по умолчанию - stdout)")
+    parser.add_argument("--from-booking", type=int, help="Первый booking_id диапазона")
+    parser.add_argument("--to-booking", type=int, help="Последний booking_id диапазона")
+    parser.add_argument("--unpaid-grace-minutes", type=int, default=RECONCILIATION_UNPAID_GRACE_MINUTES,
+                        help="Сколько минут неоплаченное бронирование не считается расхождением")
+    args = parser.parse_args()
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    db = SessionLocal()
+    start = time.perf_counter()
+    counts = {}
+    try:
+        for discrepancy in stream_ledger_discrepancies(db, args.from_booking, args.to_booking,
+                                                       args.unpaid_grace_minutes):
+            out.write(json.dumps(discrepancy) + "\n")
+            counts[discrepancy["type"]] = counts.get(discrepancy["type"], 0) + 1
+    except Exception as e:
+        print(f"✗ Ошибка сверки: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        db.close()
+        if out is not sys.stdout:
+            out.close()
+
+    summary = ", ".join(f"{kind}: {count}" for kind, count in sorted(counts.items())) or "расхождений нет"
+    print(f"✓ Сверка за {time.perf_counter() - start:.1f} с - {summary}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_cli()
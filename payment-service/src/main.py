@@ -1,17 +1,35 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Response, Header, BackgroundTasks, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Numeric, Boolean
+from sqlalchemy import create_engine, Column, Integer, String, Date, DateTime, ForeignKey, Numeric, Boolean, Index, text, bindparam
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from jose import JWTError, jwt
-from datetime import datetime
-from pydantic import BaseModel
-from typing import List, Optional
+from datetime import date, datetime, timedelta
+from pydantic import BaseModel, ValidationError
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import abc
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
 import os
+import zipfile
 import httpx
+import random
+import time
 import uuid
 
+from shared.jwks import TokenVerifier
+from shared.pdf import pdf_text, write_pdf
+
 app = FastAPI(title="Payment Service", version="1.0.0")
 
 # CORS configuration
@@ -21,6 +39,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Database setup
@@ -42,13 +61,82 @@ BOOKING_SERVICE_URL = os.getenv("BOOKING_SERVICE_URL", "http://booking-service:8
 NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "http://notification-service:8000")
 JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-jwt-key-change-in-production")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWKS_URL = os.getenv("JWKS_URL", f"{AUTH_SERVICE_URL}/.well-known/jwks.json")
+INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "your-internal-api-key-change-in-production")
+token_verifier = TokenVerifier(JWT_ALGORITHM, JWT_SECRET, JWKS_URL)
+
+# Payment gateway: POST /payments only records a pending payment, the
+# authorization happens in a background settlement pipeline
+PAYMENT_GATEWAY = os.getenv("PAYMENT_GATEWAY", "simulator")
+GATEWAY_SIM_LATENCY_MS_MIN = float(os.getenv("GATEWAY_SIM_LATENCY_MS_MIN", "1000"))
+GATEWAY_SIM_LATENCY_MS_MAX = float(os.getenv("GATEWAY_SIM_LATENCY_MS_MAX", "3000"))
+GATEWAY_SIM_FAILURE_RATE = float(os.getenv("GATEWAY_SIM_FAILURE_RATE", "0.0"))
+SETTLEMENT_WORKERS = int(os.getenv("SETTLEMENT_WORKERS", "64"))
+SETTLEMENT_BATCH_SIZE = int(os.getenv("SETTLEMENT_BATCH_SIZE", "200"))
+SETTLEMENT_FLUSH_INTERVAL_SECONDS = float(os.getenv("SETTLEMENT_FLUSH_INTERVAL_SECONDS", "0.2"))
+# Очередь ограничена: при отставании шлюза submit() ждет свободного места
+SETTLEMENT_QUEUE_SIZE = int(os.getenv("SETTLEMENT_QUEUE_SIZE", "10000"))
+# Gateway callbacks: X-Gateway-Signature is "t=<unix time>,v1=<hex HMAC-SHA256 of '<t>.<body>'>"
+GATEWAY_WEBHOOK_SECRET = os.getenv("GATEWAY_WEBHOOK_SECRET", "your-gateway-webhook-secret-change-in-production")
+GATEWAY_WEBHOOK_TOLERANCE_SECONDS = int(os.getenv("GATEWAY_WEBHOOK_TOLERANCE_SECONDS", "300"))
+GATEWAY_WEBHOOK_MAX_EVENTS = int(os.getenv("GATEWAY_WEBHOOK_MAX_EVENTS", "1000"))
+# Rendered receipts of settled payments are kept in memory, keyed by payment_id
+RECEIPT_CACHE_MAX_ENTRIES = int(os.getenv("RECEIPT_CACHE_MAX_ENTRIES", "10000"))
+RECEIPT_CACHEABLE_STATUSES = ("completed", "refunded")
+# Квитанция содержит контакты пользователя, которые можно изменить, поэтому
+# даже возвращенный платеж браузер кеширует недолго и затем перепроверяет по ETag
+RECEIPT_MAX_AGE_SECONDS = int(os.getenv("RECEIPT_MAX_AGE_SECONDS", "300"))
+# PDF-квитанции рендерятся в пуле процессов и хранятся на диске под хешем содержимого;
+# при изменении верстки поднимите RECEIPT_PDF_TEMPLATE_VERSION
+RECEIPT_PDF_DIR = os.getenv("RECEIPT_PDF_DIR", "/tmp/receipt_pdfs")
+RECEIPT_PDF_WORKERS = int(os.getenv("RECEIPT_PDF_WORKERS", str(os.cpu_count() or 2)))
+RECEIPT_PDF_TEMPLATE_VERSION = "1"
+RECEIPT_EXPORT_BATCH_SIZE = 50
+# Курсы валют: файл (или фид FX_RATES_URL) загружается в неизменяемый снимок в памяти,
+# который целиком подменяется при обновлении; flights.price хранится в FX_BASE_CURRENCY
+FX_BASE_CURRENCY = os.getenv("FX_BASE_CURRENCY", "USD")
+FX_RATES_FILE = os.getenv("FX_RATES_FILE", os.path.join(os.path.dirname(__file__), "fx_rates.json"))
+FX_RATES_URL = os.getenv("FX_RATES_URL", "")
+FX_REFRESH_INTERVAL_SECONDS = int(os.getenv("FX_REFRESH_INTERVAL_SECONDS", "300"))
+# Антифрод: скоринг по скоростным счетчикам (попытки и суммы по пользователю, карте, IP)
+# в памяти процесса; история платежей из БД не читается
+FRAUD_SCREENING_ENABLED = os.getenv("FRAUD_SCREENING_ENABLED", "true").lower() == "true"
+FRAUD_REVIEW_SCORE = int(os.getenv("FRAUD_REVIEW_SCORE", "50"))
+FRAUD_BLOCK_SCORE = int(os.getenv("FRAUD_BLOCK_SCORE", "100"))
+FRAUD_DAILY_AMOUNT_LIMIT = float(os.getenv("FRAUD_DAILY_AMOUNT_LIMIT", "10000"))
+FRAUD_MAX_TRACKED_KEYS = int(os.getenv("FRAUD_MAX_TRACKED_KEYS", "100000"))
+# Сверка платежей с бронированиями: обе стороны читаются серверными курсорами
+# пачками по RECONCILIATION_FETCH_SIZE строк и сливаются по booking_id
+RECONCILIATION_FETCH_SIZE = int(os.getenv("RECONCILIATION_FETCH_SIZE", "5000"))
+RECONCILIATION_UNPAID_GRACE_MINUTES = int(os.getenv("RECONCILIATION_UNPAID_GRACE_MINUTES", "60"))
+# Пул процессов для PDF создается при старте и закрывается при остановке сервиса
+pdf_pool: Optional[ProcessPoolExecutor] = None
 
 
 # Database Models
+# Все поля истории платежей (GET /payments) для index-only scan, см. init.sql
+PAYMENT_HISTORY_INCLUDE = [
+    "booking_id", "payment_id", "amount", "currency", "payment_method", "status", "completed_at", "refund_id"
+]
+
+
 class Payment(Base):
     __tablename__ = "payments"
     # Указываем, что таблица уже существует или будет создана
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # Не больше одного активного (ожидающего или завершенного) платежа на бронирование (см. init.sql)
+        Index(
+            "idx_payments_booking_active", "booking_id", unique=True,
+            postgresql_where=text("status IN ('pending', 'completed')"),
+            sqlite_where=text("status IN ('pending', 'completed')")
+        ),
+        # История платежей пользователя: keyset-пагинация по (user_id, created_at, id) (см. init.sql)
+        Index(
+            "idx_payments_user_created", "user_id", "created_at", "id",
+            postgresql_include=PAYMENT_HISTORY_INCLUDE
+        ),
+        {'extend_existing': True},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     # Foreign key уже существует в базе данных, поэтому не указываем его в модели
@@ -62,6 +150,34 @@ class Payment(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
     refund_id = Column(String(100), nullable=True)
+    refunded_at = Column(DateTime, nullable=True)
+
+
+class RevenueDaily(Base):
+    __tablename__ = "revenue_daily"
+    __table_args__ = {'extend_existing': True}
+    
+    # Дневные агрегаты выручки; обновляются в той же транзакции, что и переход статуса платежа
+    day = Column(Date, primary_key=True)
+    origin = Column(String(100), primary_key=True)
+    destination = Column(String(100), primary_key=True)
+    currency = Column(String(3), primary_key=True)
+    payment_method = Column(String(50), primary_key=True)
+    payments_count = Column(Integer, nullable=False, default=0)
+    gross_amount = Column(Numeric(14, 2), nullable=False, default=0)
+    refunds_count = Column(Integer, nullable=False, default=0)
+    refunded_amount = Column(Numeric(14, 2), nullable=False, default=0)
+
+
+class GatewayWebhookEvent(Base):
+    __tablename__ = "gateway_webhook_events"
+    __table_args__ = {'extend_existing': True}
+    
+    # Гейтвеи доставляют события "как минимум один раз", event_id отсекает повторы
+    event_id = Column(String(100), primary_key=True)
+    payment_id = Column(String(100), nullable=False)
+    status = Column(String(20), nullable=False)
+    received_at = Column(DateTime, default=datetime.utcnow)
 
 
 # Pydantic Models
@@ -70,6 +186,7 @@ class PaymentCreate(BaseModel):
     payment_method: str
     amount: float
     currency: Optional[str] = "USD"
+    card_fingerprint: Optional[str] = None
 
 
 class PaymentResponse(BaseModel):
@@ -89,6 +206,13 @@ class PaymentResponse(BaseModel):
         from_attributes = True
 
 
+class FxRatesResponse(BaseModel):
+    base: str
+    as_of: Optional[str] = None
+    loaded_at: datetime
+    rates: Dict[str, float]
+
+
 class RefundRequest(BaseModel):
     payment_id: str
     reason: Optional[str] = None
@@ -102,7 +226,304 @@ class RefundResponse(BaseModel):
     message: str
 
 
+class BulkRefundStatus(BaseModel):
+    flight_id: int
+    status: str  # running, completed, failed
+    total: int = 0
+    refunded: int = 0
+    cancelled: int = 0
+    amount: float = 0.0
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+class RevenueRow(BaseModel):
+    day: Optional[date] = None
+    origin: Optional[str] = None
+    destination: Optional[str] = None
+    currency: Optional[str] = None
+    payment_method: Optional[str] = None
+    payments_count: int
+    gross_amount: float
+    refunds_count: int
+    refunded_amount: float
+    net_amount: float
+
+
+class GatewayEvent(BaseModel):
+    event_id: str
+    payment_id: str
+    status: str  # completed, failed
+    occurred_at: Optional[datetime] = None
+
+
+class WebhookResponse(BaseModel):
+    received: int
+    duplicates: int
+    applied: int
+
+
+class ReceiptCacheEntry:
+    __slots__ = ("body", "etag", "user_id", "status")
+
+    def __init__(self, body: bytes, etag: str, user_id: int, status: str):
+        self.body = body
+        self.etag = etag
+        self.user_id = user_id
+        self.status = status
+
+
+class ReceiptCache:
+    """LRU cache of rendered receipts keyed by payment_id.
+    
+    Only settled payments are stored. An entry is dropped when its payment
+    is refunded or its user's contact details change, so entries need no TTL.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, ReceiptCacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+
+    def get(self, payment_id: str) -> Optional[ReceiptCacheEntry]:
+        entry = self._entries.get(payment_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(payment_id)
+        self.hits += 1
+        return entry
+
+    @staticmethod
+    def render(receipt: dict, user_id: int) -> ReceiptCacheEntry:
+        body = json.dumps(receipt, separators=(",", ":")).encode()
+        return ReceiptCacheEntry(
+            body=body,
+            etag='"' + hashlib.sha256(body).hexdigest() + '"',
+            user_id=user_id,
+            status=receipt["payment"]["status"]
+        )
+
+    def put(self, payment_id: str, entry: ReceiptCacheEntry):
+        if entry.status not in RECEIPT_CACHEABLE_STATUSES:
+            return
+        self._entries[payment_id] = entry
+        self._entries.move_to_end(payment_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, payment_id: str):
+        if self._entries.pop(payment_id, None) is not None:
+            self.invalidations += 1
+
+    def invalidate_user(self, user_id: int):
+        for payment_id in [pid for pid, entry in self._entries.items() if entry.user_id == user_id]:
+            self.invalidate(payment_id)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+        }
+
+
+receipt_cache = ReceiptCache(RECEIPT_CACHE_MAX_ENTRIES)
+
+
+class RingCounter:
+    """Sliding-window sum over a ring of fixed-width time buckets.
+    
+    A bucket is reused once its slot comes round again, so memory is fixed
+    at two small arrays per counter whatever the request rate.
+    """
+    __slots__ = ("width", "stamps", "values")
+
+    def __init__(self, buckets: int, width: float):
+        self.width = width
+        self.stamps = array("q", [-1]) * buckets
+        self.values = array("d", [0.0]) * buckets
+
+    def add(self, now: float, value: float):
+        slot = int(now // self.width)
+        i = slot % len(self.stamps)
+        if self.stamps[i] != slot:
+            self.stamps[i] = slot
+            self.values[i] = 0.0
+        self.values[i] += value
+
+    def total(self, now: float) -> float:
+        oldest = int(now // self.width) - len(self.stamps)
+        return sum(value for stamp, value in zip(self.stamps, self.values) if stamp > oldest)
+
+
+# Окно -> (число корзин, ширина корзины в секундах)
+FRAUD_WINDOWS = {
+    "minute": (60, 1.0),
+    "hour": (60, 60.0),
+    "day": (24, 3600.0),
+}
+
+
+@dataclass(frozen=True)
+class FraudRule:
+    name: str
+    dimension: str  # user, card, ip
+    metric: str  # attempts, amount
+    window: str
+    threshold: float
+    score: int
+
+
+FRAUD_RULES = [
+    FraudRule("user_attempts_per_minute", "user", "attempts", "minute", 5, 60),
+    FraudRule("user_attempts_per_hour", "user", "attempts", "hour", 20, 50),
+    FraudRule("card_attempts_per_minute", "card", "attempts", "minute", 3, 60),
+    FraudRule("ip_attempts_per_minute", "ip", "attempts", "minute", 20, 100),
+    FraudRule("user_amount_per_day", "user", "amount", "day", FRAUD_DAILY_AMOUNT_LIMIT, 50),
+    FraudRule("card_amount_per_day", "card", "amount", "day", FRAUD_DAILY_AMOUNT_LIMIT, 60),
+]
+
+
+class VelocityCounters:
+    """Ring counters for one dimension, keyed by user id, card fingerprint or IP.
+    
+    Keys are kept in LRU order and the least recently seen ones are dropped
+    past max_keys, which bounds memory under a flood of new IPs or cards.
+    """
+
+    def __init__(self, counters: List[tuple], max_keys: int):
+        self.counters = counters
+        self.max_keys = max_keys
+        self._keys: "OrderedDict[str, Dict[tuple, RingCounter]]" = OrderedDict()
+
+    def record(self, key: str, now: float, amount: float) -> Dict[tuple, float]:
+        """Count one attempt of amount and return the window totals including it"""
+        rings = self._keys.get(key)
+        if rings is None:
+            rings = {
+                (metric, window): RingCounter(*FRAUD_WINDOWS[window])
+                for metric, window in self.counters
+            }
+            self._keys[key] = rings
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        else:
+            self._keys.move_to_end(key)
+        totals = {}
+        for (metric, window), ring in rings.items():
+            ring.add(now, 1.0 if metric == "attempts" else amount)
+            totals[(metric, window)] = ring.total(now)
+        return totals
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def clear(self):
+        self._keys.clear()
+
+
+@dataclass
+class FraudDecision:
+    decision: str  # allow, review, block
+    score: int
+    rules: List[str]
+
+
+class FraudEngine:
+    """Rule-based pre-authorization scoring over in-memory velocity counters.
+    
+    Each rule adds its score when a counter, including the current attempt,
+    exceeds the threshold. Every attempt is counted, declined ones too, so
+    a blocked card keeps being blocked while it retries.
+    """
+
+    def __init__(self, rules: List[FraudRule], review_score: int, block_score: int,
+                 max_keys: int, latency_samples: int = 1024):
+        self.rules = rules
+        self.review_score = review_score
+        self.block_score = block_score
+        self.dimensions = {}
+        for dimension in ("user", "card", "ip"):
+            counters = sorted({(rule.metric, rule.window) for rule in rules if rule.dimension == dimension})
+            if counters:
+                self.dimensions[dimension] = VelocityCounters(counters, max_keys)
+        self.decisions = {"allow": 0, "review": 0, "block": 0}
+        self.rule_hits = {rule.name: 0 for rule in rules}
+        # Задержки скоринга (мкс) в кольцевом буфере последних latency_samples вызовов
+        self._latencies = array("d", [0.0]) * latency_samples
+        self._latency_count = 0
+
+    def score(self, amount: float, user_id=None, card: Optional[str] = None,
+              ip: Optional[str] = None, now: Optional[float] = None) -> FraudDecision:
+        started = time.perf_counter()
+        now = time.time() if now is None else now
+        totals = {}
+        for dimension, key in (("user", user_id), ("card", card), ("ip", ip)):
+            if key is not None and dimension in self.dimensions:
+                totals[dimension] = self.dimensions[dimension].record(str(key), now, amount)
+
+        score = 0
+        fired = []
+        for rule in self.rules:
+            counters = totals.get(rule.dimension)
+            if counters is not None and counters[(rule.metric, rule.window)] > rule.threshold:
+                score += rule.score
+                fired.append(rule.name)
+                self.rule_hits[rule.name] += 1
+
+        if score >= self.block_score:
+            decision = "block"
+        elif score >= self.review_score:
+            decision = "review"
+        else:
+            decision = "allow"
+        self.decisions[decision] += 1
+        self._latencies[self._latency_count % len(self._latencies)] = (time.perf_counter() - started) * 1e6
+        self._latency_count += 1
+        return FraudDecision(decision=decision, score=score, rules=fired)
+
+    def reset(self):
+        for counters in self.dimensions.values():
+            counters.clear()
+        self.decisions = dict.fromkeys(self.decisions, 0)
+        self.rule_hits = dict.fromkeys(self.rule_hits, 0)
+        self._latency_count = 0
+
+    def stats(self) -> dict:
+        samples = sorted(self._latencies[:min(self._latency_count, len(self._latencies))])
+
+        def percentile(q: float) -> float:
+            return round(samples[min(int(len(samples) * q), len(samples) - 1)], 2) if samples else 0.0
+
+        return {
+            "decisions": dict(self.decisions),
+            "rule_hits": dict(self.rule_hits),
+            "tracked_keys": {dimension: len(counters) for dimension, counters in self.dimensions.items()},
+            "latency_us": {"p50": percentile(0.5), "p99": percentile(0.99), "max": percentile(1.0)},
+        }
+
+
+fraud_engine = FraudEngine(FRAUD_RULES, FRAUD_REVIEW_SCORE, FRAUD_BLOCK_SCORE, FRAUD_MAX_TRACKED_KEYS)
+
+
 # Helper functions
+@app.on_event("startup")
+async def load_jwks():
+    await token_verifier.load()
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -115,7 +536,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
     """Verify JWT token and return user info"""
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = await token_verifier.decode(token)
         user_id_raw = payload.get("sub")
         if user_id_raw is None:
             raise HTTPException(
@@ -139,6 +560,32 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         )
 
 
+def is_admin_user(db: Session, user_id: int) -> bool:
+    """Admin rights from users: the token claim outlives a revocation"""
+    return bool(db.execute(
+        text("SELECT is_admin FROM users WHERE id = :user_id"),
+        {"user_id": user_id}
+    ).scalar())
+
+
+def verify_internal(x_internal_key: Optional[str] = Header(None)):
+    if x_internal_key is None or not hmac.compare_digest(x_internal_key, INTERNAL_API_KEY):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid internal key"
+        )
+
+
+async def verify_admin(user_info: dict = Depends(verify_token), db: Session = Depends(get_db)) -> dict:
+    """Require admin rights in users"""
+    if not is_admin_user(db, user_info["user_id"]):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return user_info
+
+
 def check_booking_ownership(db: Session, booking_id: int, user_id: int) -> bool:
     """Check if booking belongs to user"""
     from sqlalchemy import text
@@ -150,167 +597,1290 @@ def check_booking_ownership(db: Session, booking_id: int, user_id: int) -> bool:
     return row and row[0] == user_id
 
 
-def get_booking_price(db: Session, booking_id: int) -> Optional[float]:
-    """Get booking price from flight"""
-    from sqlalchemy import text
+def load_payment_context(db: Session, booking_id: int):
+    """Load booking owner, flight price/route and active payment in one query"""
     result = db.execute(
         text("""
-            SELECT f.price 
-            FROM flights f
-            JOIN bookings b ON f.id = b.flight_id
+            SELECT b.user_id, f.price, f.flight_number, f.origin, f.destination,
+                   (
+                       SELECT p.status FROM payments p
+                       WHERE p.booking_id = b.id AND p.status IN ('pending', 'completed')
+                       LIMIT 1
+                   ) AS active_status
+            FROM bookings b
+            LEFT JOIN flights f ON f.id = b.flight_id
             WHERE b.id = :booking_id
         """),
         {"booking_id": booking_id}
     )
-    row = result.fetchone()
-    return float(row[0]) if row and row[0] else None
+    return result.fetchone()
+
+
+def encode_payment_cursor(created_at: datetime, payment_pk: int) -> str:
+    raw = json.dumps([created_at.isoformat(), payment_pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_payment_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, payment_pk = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(payment_pk)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
+def payment_row_to_dict(row) -> dict:
+    """Same shape as PaymentResponse, built without the ORM or pydantic"""
+    return {
+        "id": row.id,
+        "booking_id": row.booking_id,
+        "user_id": row.user_id,
+        "payment_id": row.payment_id,
+        "amount": float(row.amount),
+        "currency": row.currency,
+        "payment_method": row.payment_method,
+        "status": row.status,
+        "created_at": row.created_at.isoformat(),
+        "completed_at": row.completed_at.isoformat() if row.completed_at else None,
+        "refund_id": row.refund_id
+    }
+
+
+@dataclass(frozen=True)
+class FxSnapshot:
+    """Immutable set of rates from FX_BASE_CURRENCY to every known currency"""
+    rates: Dict[str, float]
+    as_of: Optional[str]
+    loaded_at: datetime
+    source_mtime: float = 0.0
+
+    def convert(self, amount: float, currency: str) -> Optional[float]:
+        rate = self.rates.get(currency)
+        return None if rate is None else round(amount * rate, 2)
+
+
+def parse_fx_rates(data: dict, source_mtime: float = 0.0) -> FxSnapshot:
+    """Validate a rate document and precompute cross rates from FX_BASE_CURRENCY.
+    
+    The document may be quoted in any base: {"base": "USD", "rates": {"EUR": 0.92, ...}}.
+    """
+    quoted = {str(currency).upper(): float(rate) for currency, rate in data["rates"].items()}
+    quoted[str(data["base"]).upper()] = 1.0
+    if any(rate <= 0 for rate in quoted.values()):
+        raise ValueError("FX rates must be positive")
+    if FX_BASE_CURRENCY not in quoted:
+        raise ValueError(f"FX rates have no {FX_BASE_CURRENCY} quote")
+    base_rate = quoted[FX_BASE_CURRENCY]
+    return FxSnapshot(
+        rates={currency: rate / base_rate for currency, rate in quoted.items()},
+        as_of=data.get("as_of"),
+        loaded_at=datetime.utcnow(),
+        source_mtime=source_mtime
+    )
+
+
+def read_fx_rates_file(path: str) -> FxSnapshot:
+    mtime = os.path.getmtime(path)
+    with open(path) as f:
+        return parse_fx_rates(json.load(f), source_mtime=mtime)
+
+
+def initial_fx_snapshot() -> FxSnapshot:
+    try:
+        return read_fx_rates_file(FX_RATES_FILE)
+    except Exception as e:
+        print(f"Failed to load FX rates from {FX_RATES_FILE}: {e}")
+        # Без курсов принимаем только оплату в валюте цены
+        return FxSnapshot(rates={FX_BASE_CURRENCY: 1.0}, as_of=None, loaded_at=datetime.utcnow())
+
+
+fx_snapshot = initial_fx_snapshot()
+
+
+async def refresh_fx_rates() -> bool:
+    """Load rates from the feed or the file (if it changed) and swap the snapshot.
+    
+    A bad document is rejected and the previous snapshot stays in place.
+    """
+    global fx_snapshot
+    if FX_RATES_URL:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(FX_RATES_URL, timeout=10.0)
+            response.raise_for_status()
+        snapshot = parse_fx_rates(response.json())
+    else:
+        if os.path.getmtime(FX_RATES_FILE) == fx_snapshot.source_mtime:
+            return False
+        snapshot = await asyncio.to_thread(read_fx_rates_file, FX_RATES_FILE)
+    fx_snapshot = snapshot
+    return True
+
+
+async def fx_refresher():
+    while True:
+        await asyncio.sleep(FX_REFRESH_INTERVAL_SECONDS)
+        try:
+            if await refresh_fx_rates():
+                print(f"FX rates refreshed (as of {fx_snapshot.as_of})")
+        except Exception as e:
+            print(f"Failed to refresh FX rates: {e}")
+
+
+def load_receipts(db: Session, payment_ids: List[str]) -> Dict[str, tuple]:
+    """Payment, booking, flight and passenger rows for receipts in one query"""
+    result = db.execute(
+        text("""
+            SELECT p.payment_id, p.user_id, p.amount, p.currency, p.payment_method, p.status,
+                   p.created_at, p.completed_at,
+                   b.id AS booking_id, b.seat_number, b.booking_date,
+                   f.flight_number, f.origin, f.destination,
+                   f.departure_time, f.arrival_time, f.price,
+                   u.first_name, u.last_name, u.email, u.phone
+            FROM payments p
+            LEFT JOIN bookings b ON b.id = p.booking_id
+            LEFT JOIN flights f ON f.id = b.flight_id
+            LEFT JOIN users u ON u.id = b.user_id
+            WHERE p.payment_id IN :payment_ids
+        """)
+        .bindparams(bindparam("payment_ids", expanding=True))
+        .columns(
+            created_at=DateTime, completed_at=DateTime, booking_date=DateTime,
+            departure_time=DateTime, arrival_time=DateTime
+        ),
+        {"payment_ids": payment_ids}
+    )
+    return {row.payment_id: row for row in result}
+
+
+def build_receipt(row) -> dict:
+    return {
+        "payment": {
+            "payment_id": row.payment_id,
+            "amount": float(row.amount),
+            "currency": row.currency,
+            "payment_method": row.payment_method,
+            "status": row.status,
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+            "completed_at": row.completed_at.isoformat() if row.completed_at else None
+        },
+        "booking": {
+            "id": row.booking_id,
+            "seat_number": row.seat_number,
+            "booking_date": row.booking_date.isoformat() if row.booking_date else None
+        },
+        "flight": {
+            "flight_number": row.flight_number,
+            "origin": row.origin,
+            "destination": row.destination,
+            "departure_time": row.departure_time.isoformat() if row.departure_time else None,
+            "arrival_time": row.arrival_time.isoformat() if row.arrival_time else None,
+            "price": float(row.price) if row.price else 0.0
+        },
+        "user": {
+            "first_name": row.first_name,
+            "last_name": row.last_name,
+            "email": row.email,
+            "phone": row.phone
+        }
+    }
+
+
+def warm_receipt_cache(db: Session, payment_ids: List[str]):
+    """Render receipts of just-settled payments so the first view is a cache hit"""
+    for payment_id, row in load_receipts(db, payment_ids).items():
+        if row.booking_id is not None:
+            receipt_cache.put(payment_id, ReceiptCache.render(build_receipt(row), row.user_id))
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    # Слабые валидаторы (W/) не подходят для строгого ETag квитанции
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def get_receipt_entry(db: Session, payment_id: str, user_id: int) -> ReceiptCacheEntry:
+    """Rendered receipt of the user's payment, from the cache when possible"""
+    entry = receipt_cache.get(payment_id)
+    if entry is None:
+        row = load_receipts(db, [payment_id]).get(payment_id)
+        if row and row.user_id == user_id:
+            if row.booking_id is None:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Booking not found"
+                )
+            entry = ReceiptCache.render(build_receipt(row), row.user_id)
+            receipt_cache.put(payment_id, entry)
+    
+    if entry is None or entry.user_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Payment not found"
+        )
+    return entry
+
+
+def receipt_cache_control(entry: ReceiptCacheEntry) -> str:
+    # Завершенная квитанция сменится при возврате, поэтому браузер перепроверяет ее
+    # по ETag сразу; возвращенную держит RECEIPT_MAX_AGE_SECONDS, затем тоже по ETag
+    if entry.status == "refunded":
+        return f"private, max-age={RECEIPT_MAX_AGE_SECONDS}, must-revalidate"
+    return "private, no-cache"
+
+
+# Receipt PDFs
+def render_receipt_pdf(body: bytes) -> bytes:
+    """Render a receipt (serialized as in ReceiptCache) into a one-page PDF.
+    
+    Runs in pdf_pool worker processes. The output depends only on the input,
+    so identical receipts produce identical files.
+    """
+    receipt = json.loads(body)
+    payment, booking, flight, user = receipt["payment"], receipt["booking"], receipt["flight"], receipt["user"]
+    sections = [
+        ("Payment", [
+            ("Payment ID", payment["payment_id"]),
+            ("Amount", f"{payment['amount']:.2f} {payment['currency']}"),
+            ("Method", payment["payment_method"]),
+            ("Status", payment["status"]),
+            ("Created", payment["created_at"]),
+            ("Completed", payment["completed_at"]),
+        ]),
+        ("Flight", [
+            ("Flight", flight["flight_number"]),
+            ("Route", f"{flight['origin']} - {flight['destination']}"),
+            ("Departure", flight["departure_time"]),
+            ("Arrival", flight["arrival_time"]),
+        ]),
+        ("Booking", [
+            ("Booking ID", booking["id"]),
+            ("Seat", booking["seat_number"]),
+            ("Booked", booking["booking_date"]),
+        ]),
+        ("Passenger", [
+            ("Name", f"{user['first_name']} {user['last_name']}"),
+            ("Email", user["email"]),
+            ("Phone", user["phone"]),
+        ]),
+    ]
+    
+    content = [b"BT /F2 22 Tf 50 780 Td (Payment receipt) Tj ET"]
+    y = 740
+    for title, fields in sections:
+        content.append(b"BT /F2 13 Tf 50 %d Td (%s) Tj ET" % (y, pdf_text(title)))
+        y -= 20
+        for label, value in fields:
+            content.append(b"BT /F1 11 Tf 60 %d Td (%s) Tj ET" % (y, pdf_text(label)))
+            content.append(b"BT /F1 11 Tf 180 %d Td (%s) Tj ET" % (y, pdf_text(value)))
+            y -= 16
+        y -= 12
+    stream = b"\n".join(content)
+    
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+        b"/Resources << /Font << /F1 4 0 R /F2 5 0 R >> >> /Contents 6 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream),
+    ]
+    return write_pdf(objects)
+
+
+def receipt_pdf_digest(entry: ReceiptCacheEntry) -> str:
+    return hashlib.sha256(f"{RECEIPT_PDF_TEMPLATE_VERSION}:".encode() + entry.body).hexdigest()
+
+
+def read_cached_pdf(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_cached_pdf(path: str, pdf: bytes):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(pdf)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Failed to cache receipt PDF: {e}")
+
+
+async def get_receipt_pdf(entry: ReceiptCacheEntry) -> bytes:
+    """PDF from the content-addressed disk cache, rendered in pdf_pool on a miss"""
+    digest = receipt_pdf_digest(entry)
+    path = os.path.join(RECEIPT_PDF_DIR, digest[:2], f"{digest}.pdf")
+    pdf = await asyncio.to_thread(read_cached_pdf, path)
+    if pdf is not None:
+        return pdf
+    
+    pdf = await asyncio.get_running_loop().run_in_executor(pdf_pool, render_receipt_pdf, entry.body)
+    await asyncio.to_thread(write_cached_pdf, path, pdf)
+    return pdf
+
+
+@app.on_event("startup")
+async def start_pdf_pool():
+    global pdf_pool
+    pdf_pool = ProcessPoolExecutor(max_workers=RECEIPT_PDF_WORKERS)
+
+
+@app.on_event("shutdown")
+async def stop_pdf_pool():
+    if pdf_pool:
+        pdf_pool.shutdown(wait=True, cancel_futures=True)
+
+
+class ZipStream:
+    """Write-only sink for zipfile that hands out what was written so far"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def write_receipts_zip(archive: zipfile.ZipFile, receipts: List[tuple]):
+    for payment_id, pdf in receipts:
+        archive.writestr(f"receipt-{payment_id}.pdf", pdf)
+
+
+async def stream_receipts_zip(db: Session, payment_ids: List[str]):
+    """Zip receipts batch by batch so the archive never sits in memory whole.
+    
+    Queries and compression run in a worker thread to keep the event loop free.
+    """
+    sink = ZipStream()
+    archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED)
+    try:
+        for i in range(0, len(payment_ids), RECEIPT_EXPORT_BATCH_SIZE):
+            rows = await asyncio.to_thread(load_receipts, db, payment_ids[i:i + RECEIPT_EXPORT_BATCH_SIZE])
+            entries = [
+                (payment_id, ReceiptCache.render(build_receipt(row), row.user_id))
+                for payment_id, row in rows.items() if row.booking_id is not None
+            ]
+            pdfs = await asyncio.gather(*(get_receipt_pdf(entry) for _, entry in entries))
+            await asyncio.to_thread(write_receipts_zip, archive, [
+                (payment_id, pdf) for (payment_id, _), pdf in zip(entries, pdfs)
+            ])
+            yield sink.drain()
+    finally:
+        archive.close()
+    yield sink.drain()
+
+
+# Payment gateway
+@dataclass
+class SettlementJob:
+    payment_id: str
+    booking_id: int
+    user_id: int
+    amount: float
+    currency: str
+    payment_method: str
+    flight_number: Optional[str] = None
+    origin: Optional[str] = None
+    destination: Optional[str] = None
+
+
+@dataclass
+class GatewayResult:
+    approved: bool
+    reference: Optional[str] = None
+    error: Optional[str] = None
+
+
+class PaymentGateway(abc.ABC):
+    """Adapter interface for payment gateways.
+    
+    payment_id is passed as the idempotency key, so re-submitting a payment
+    after a restart must not charge the customer twice.
+    """
+
+    @abc.abstractmethod
+    async def authorize(self, job: SettlementJob) -> GatewayResult:
+        ...
+
+
+class SimulatedGateway(PaymentGateway):
+    """Local gateway simulator with configurable latency and failure rate"""
+
+    def __init__(self, latency_ms_min: float = 0.0, latency_ms_max: float = 0.0,
+                 failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency_ms_min = latency_ms_min
+        self.latency_ms_max = max(latency_ms_min, latency_ms_max)
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+
+    async def authorize(self, job: SettlementJob) -> GatewayResult:
+        await asyncio.sleep(self._random.uniform(self.latency_ms_min, self.latency_ms_max) / 1000)
+        if self._random.random() < self.failure_rate:
+            return GatewayResult(approved=False, error="Declined by simulator")
+        return GatewayResult(approved=True, reference=f"SIM-{uuid.uuid4().hex[:12].upper()}")
+
+
+PAYMENT_GATEWAYS = {
+    "simulator": lambda: SimulatedGateway(
+        GATEWAY_SIM_LATENCY_MS_MIN, GATEWAY_SIM_LATENCY_MS_MAX, GATEWAY_SIM_FAILURE_RATE
+    ),
+}
+
+
+REVENUE_DIMENSIONS = {
+    "day": ["day"],
+    "route": ["origin", "destination"],
+    "currency": ["currency"],
+    "payment_method": ["payment_method"],
+}
+
+
+def record_revenue(db: Session, payment_ids: List[str], event: str):
+    """Add completed or refunded payments to the daily rollup (caller commits).
+    
+    Call it in the transaction that makes the status transition, once per
+    payment, so the rollup never drifts from the payments table.
+    """
+    if not payment_ids:
+        return
+    if event == "completed":
+        day, counts = "p.completed_at", "COUNT(*), SUM(p.amount), 0, 0"
+    else:
+        day, counts = "p.refunded_at", "0, 0, COUNT(*), SUM(p.amount)"
+    db.execute(
+        text(f"""
+            INSERT INTO revenue_daily (day, origin, destination, currency, payment_method,
+                                       payments_count, gross_amount, refunds_count, refunded_amount)
+            SELECT DATE({day}), COALESCE(f.origin, 'unknown'), COALESCE(f.destination, 'unknown'),
+                   p.currency, p.payment_method, {counts}
+            FROM payments p
+            LEFT JOIN bookings b ON b.id = p.booking_id
+            LEFT JOIN flights f ON f.id = b.flight_id
+            WHERE p.payment_id IN :payment_ids
+            GROUP BY 1, 2, 3, 4, 5
+            ON CONFLICT (day, origin, destination, currency, payment_method) DO UPDATE SET
+                payments_count = revenue_daily.payments_count + excluded.payments_count,
+                gross_amount = revenue_daily.gross_amount + excluded.gross_amount,
+                refunds_count = revenue_daily.refunds_count + excluded.refunds_count,
+                refunded_amount = revenue_daily.refunded_amount + excluded.refunded_amount
+        """).bindparams(bindparam("payment_ids", expanding=True)),
+        {"payment_ids": payment_ids}
+    )
+
+
+def apply_settlements(db: Session, settlements: List[dict]) -> List[str]:
+    """Move pending payments to their settled status in one statement.
+    
+    Returns payment_ids that were actually updated (still pending).
+    """
+    if db.bind.dialect.name == "postgresql":
+        values = []
+        params = {}
+        for i, row in enumerate(settlements):
+            values.append(f"(:payment_id_{i}, :status_{i}, CAST(:completed_at_{i} AS TIMESTAMP))")
+            params[f"payment_id_{i}"] = row["payment_id"]
+            params[f"status_{i}"] = row["status"]
+            params[f"completed_at_{i}"] = row["completed_at"]
+        result = db.execute(
+            text(f"""
+                UPDATE payments p
+                SET status = v.status, completed_at = v.completed_at
+                FROM (VALUES {', '.join(values)}) AS v(payment_id, status, completed_at)
+                WHERE p.payment_id = v.payment_id AND p.status = 'pending'
+                RETURNING p.payment_id
+            """),
+            params
+        )
+        updated = [row[0] for row in result]
+    else:
+        pending = db.execute(
+            text("SELECT payment_id FROM payments WHERE payment_id IN :payment_ids AND status = 'pending'")
+            .bindparams(bindparam("payment_ids", expanding=True)),
+            {"payment_ids": [row["payment_id"] for row in settlements]}
+        )
+        updated = [row[0] for row in pending]
+        db.execute(
+            text("""
+                UPDATE payments SET status = :status, completed_at = :completed_at
+                WHERE payment_id = :payment_id AND status = 'pending'
+            """),
+            settlements
+        )
+    statuses = {row["payment_id"]: row["status"] for row in settlements}
+    record_revenue(db, [payment_id for payment_id in updated if statuses[payment_id] == "completed"], "completed")
+    refund_cancelled_settlements(db, [row for row in settlements if row["status"] == "completed"])
+    db.commit()
+    return updated
+
+
+def refund_cancelled_settlements(db: Session, settlements: List[dict]):
+    """Refund approvals that arrived for payments cancelled in the meantime (caller commits).
+    
+    A flight refund cancels pending payments while their authorization may
+    already be at the gateway. The money was taken, so such a payment is
+    recorded as completed and refunded at once instead of being dropped.
+    """
+    if not settlements:
+        return
+    cancelled = [
+        row[0] for row in db.execute(
+            text("SELECT payment_id FROM payments WHERE payment_id IN :payment_ids AND status = 'cancelled'")
+            .bindparams(bindparam("payment_ids", expanding=True)),
+            {"payment_ids": [row["payment_id"] for row in settlements]}
+        )
+    ]
+    if not cancelled:
+        return
+    db.execute(
+        text("""
+            UPDATE payments SET status = 'completed', completed_at = :completed_at
+            WHERE payment_id = :payment_id AND status = 'cancelled'
+        """),
+        [row for row in settlements if row["payment_id"] in cancelled]
+    )
+    record_revenue(db, cancelled, "completed")
+    apply_refunds(db, [
+        {"payment_id": payment_id, "refund_id": f"REF-{uuid.uuid4().hex[:12].upper()}"}
+        for payment_id in cancelled
+    ])
+    print(f"Refunded {len(cancelled)} payment(s) approved after cancellation: {', '.join(cancelled)}")
+
+
+def apply_refunds(db: Session, refunds: List[dict]) -> List[str]:
+    """Mark completed payments refunded in one statement (caller commits).
+    
+    Returns payment_ids that were actually updated (still completed).
+    """
+    refunded_at = datetime.utcnow()
+    if db.bind.dialect.name == "postgresql":
+        values = []
+        params = {"refunded_at": refunded_at}
+        for i, row in enumerate(refunds):
+            values.append(f"(:payment_id_{i}, :refund_id_{i})")
+            params[f"payment_id_{i}"] = row["payment_id"]
+            params[f"refund_id_{i}"] = row["refund_id"]
+        result = db.execute(
+            text(f"""
+                UPDATE payments p
+                SET status = 'refunded', refund_id = v.refund_id, refunded_at = :refunded_at
+                FROM (VALUES {', '.join(values)}) AS v(payment_id, refund_id)
+                WHERE p.payment_id = v.payment_id AND p.status = 'completed'
+                RETURNING p.payment_id
+            """),
+            params
+        )
+        updated = [row[0] for row in result]
+    else:
+        completed = db.execute(
+            text("SELECT payment_id FROM payments WHERE payment_id IN :payment_ids AND status = 'completed'")
+            .bindparams(bindparam("payment_ids", expanding=True)),
+            {"payment_ids": [row["payment_id"] for row in refunds]}
+        )
+        updated = [row[0] for row in completed]
+        db.execute(
+            text("""
+                UPDATE payments SET status = 'refunded', refund_id = :refund_id, refunded_at = :refunded_at
+                WHERE payment_id = :payment_id AND status = 'completed'
+            """),
+            [{**row, "refunded_at": refunded_at} for row in refunds]
+        )
+    record_revenue(db, updated, "refunded")
+    return updated
+
+
+def refund_flight_payments(db: Session, progress: BulkRefundStatus):
+    """Refund every completed payment of a flight in a single transaction.
+    
+    Pending payments of the flight are cancelled so the settlement pipeline
+    no longer completes them; one the gateway approves anyway is refunded
+    by refund_cancelled_settlements(). Refunds are applied in batches of
+    SETTLEMENT_BATCH_SIZE so progress can be polled; nothing is visible to
+    other sessions until the final commit.
+    """
+    progress.cancelled = db.execute(
+        text("""
+            UPDATE payments SET status = 'cancelled'
+            WHERE status = 'pending'
+              AND booking_id IN (SELECT id FROM bookings WHERE flight_id = :flight_id)
+        """),
+        {"flight_id": progress.flight_id}
+    ).rowcount
+    lock = " FOR UPDATE OF p" if db.bind.dialect.name == "postgresql" else ""
+    payments = db.execute(
+        text(f"""
+            SELECT p.payment_id, p.amount
+            FROM payments p
+            JOIN bookings b ON b.id = p.booking_id
+            WHERE b.flight_id = :flight_id AND p.status = 'completed'
+            {lock}
+        """),
+        {"flight_id": progress.flight_id}
+    ).fetchall()
+    progress.total = len(payments)
+    amounts = {row[0]: float(row[1]) for row in payments}
+    
+    refunded = []
+    for i in range(0, len(payments), SETTLEMENT_BATCH_SIZE):
+        batch = [
+            {"payment_id": row[0], "refund_id": f"REF-{uuid.uuid4().hex[:12].upper()}"}
+            for row in payments[i:i + SETTLEMENT_BATCH_SIZE]
+        ]
+        updated = apply_refunds(db, batch)
+        refunded.extend(updated)
+        progress.refunded += len(updated)
+        progress.amount = round(progress.amount + sum(amounts[payment_id] for payment_id in updated), 2)
+    db.commit()
+    
+    for payment_id in refunded:
+        receipt_cache.invalidate(payment_id)
+
+
+# Прогресс массовых возвратов по рейсам (последний запуск на рейс)
+bulk_refunds: Dict[int, BulkRefundStatus] = {}
+
+
+def ledger_discrepancy(kind: str, booking_id: int, booking_status: Optional[str], payments: list) -> dict:
+    return {
+        "type": kind,
+        "booking_id": booking_id,
+        "booking_status": booking_status,
+        "payments": [{"payment_id": p.payment_id, "status": p.status} for p in payments],
+    }
+
+
+def check_booking_payments(booking, payments: list, unpaid_before: datetime) -> Iterator[dict]:
+    """Discrepancies for one booking and all of its payments"""
+    completed = [p for p in payments if p.status == "completed"]
+    refunded = [p for p in payments if p.status == "refunded"]
+    if booking.status == "confirmed":
+        if len(completed) > 1:
+            yield ledger_discrepancy("duplicate_payment", booking.id, booking.status, completed)
+        elif not completed and not refunded and not any(p.status == "pending" for p in payments) \
+                and booking.booking_date is not None and booking.booking_date < unpaid_before:
+            yield ledger_discrepancy("unpaid_booking", booking.id, booking.status, payments)
+    elif completed:
+        yield ledger_discrepancy("payment_not_refunded", booking.id, booking.status, completed)
+    if refunded and booking.status != "cancelled":
+        yield ledger_discrepancy("refund_without_cancellation", booking.id, booking.status, refunded)
+
+
+def reconcile_ledger(bookings: Iterable, payments: Iterable, unpaid_before: datetime) -> Iterator[dict]:
+    """Merge-join bookings and payments, both sorted by booking id.
+    
+    Only the payments of the current booking are held in memory, so the
+    join runs in constant memory however large the tables are.
+    """
+    payments = iter(payments)
+    current = next(payments, None)
+    for booking in bookings:
+        while current is not None and current.booking_id < booking.id:
+            yield ledger_discrepancy("payment_without_booking", current.booking_id, None, [current])
+            current = next(payments, None)
+        group = []
+        while current is not None and current.booking_id == booking.id:
+            group.append(current)
+            current = next(payments, None)
+        yield from check_booking_payments(booking, group, unpaid_before)
+    while current is not None:
+        yield ledger_discrepancy("payment_without_booking", current.booking_id, None, [current])
+        current = next(payments, None)
+
+
+def stream_ledger_discrepancies(db: Session, booking_id_from: Optional[int] = None,
+                                booking_id_to: Optional[int] = None,
+                                unpaid_grace_minutes: int = RECONCILIATION_UNPAID_GRACE_MINUTES) -> Iterator[dict]:
+    """Reconcile bookings and payments with two server-side cursors.
+    
+    On PostgreSQL both cursors read one REPEATABLE READ snapshot, so writes
+    made during a long run do not show up as discrepancies.
+    """
+    if db.bind.dialect.name == "postgresql":
+        connection = db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    else:
+        connection = db.connection()
+    connection = connection.execution_options(yield_per=RECONCILIATION_FETCH_SIZE)
+
+    booking_conditions = ["id IS NOT NULL"]
+    payment_conditions = ["booking_id IS NOT NULL"]
+    params = {}
+    for bound, op, value in (("booking_id_from", ">=", booking_id_from), ("booking_id_to", "<=", booking_id_to)):
+        if value is not None:
+            booking_conditions.append(f"id {op} :{bound}")
+            payment_conditions.append(f"booking_id {op} :{bound}")
+            params[bound] = value
+
+    bookings = connection.execute(
+        text(f"""
+            SELECT id, status, booking_date FROM bookings
+            WHERE {' AND '.join(booking_conditions)}
+            ORDER BY id
+        """).columns(booking_date=DateTime),
+        params
+    )
+    payments = connection.execute(
+        text(f"""
+            SELECT booking_id, payment_id, status FROM payments
+            WHERE {' AND '.join(payment_conditions)}
+            ORDER BY booking_id, id
+        """),
+        params
+    )
+    unpaid_before = datetime.utcnow() - timedelta(minutes=unpaid_grace_minutes)
+    try:
+        yield from reconcile_ledger(bookings, payments, unpaid_before)
+    finally:
+        bookings.close()
+        payments.close()
+        db.rollback()
+
+
+class SettlementPipeline:
+    """Settles pending payments off the request path.
+    
+    Worker coroutines call the gateway concurrently; their results are
+    buffered and written back by apply_settlements() in batches of up to
+    batch_size or every flush_interval seconds. A batch whose write fails
+    stays buffered and is retried on the next flush.
+    """
+
+    def __init__(self, gateway: PaymentGateway, session_factory: Callable[[], Session],
+                 workers: int, batch_size: int, flush_interval: float,
+                 on_completed: Optional[Callable] = None, queue_size: int = 0):
+        self.gateway = gateway
+        self.session_factory = session_factory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_completed = on_completed
+        self.queue_size = queue_size
+        self.settled = 0
+        self.failed = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._results: List[tuple] = []
+        self._tasks: List[asyncio.Task] = []
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._flush_lock = asyncio.Lock()
+        self._batch_ready = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._flusher()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    async def submit(self, job: SettlementJob):
+        """Queue a job, waiting while the queue is full"""
+        await self._queue.put(job)
+
+    async def join(self):
+        """Wait until every submitted job is settled and written"""
+        await self._queue.join()
+        await self.flush()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                try:
+                    result = await self.gateway.authorize(job)
+                except Exception as e:
+                    print(f"Gateway error for {job.payment_id}: {e}")
+                    result = GatewayResult(approved=False, error=str(e))
+                self._results.append((job, result))
+                if len(self._results) >= self.batch_size:
+                    self._batch_ready.set()
+            finally:
+                self._queue.task_done()
+
+    async def _flusher(self):
+        while True:
+            # asyncio.wait, not wait_for: wait_for can swallow the cancel from stop()
+            # when it races with the timeout, and the flusher would never exit
+            ready = asyncio.ensure_future(self._batch_ready.wait())
+            try:
+                await asyncio.wait({ready}, timeout=self.flush_interval)
+            finally:
+                ready.cancel()
+            self._batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Failed to write payment settlements: {e}")
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._results:
+                batch, self._results = self._results[:self.batch_size], self._results[self.batch_size:]
+                now = datetime.utcnow()
+                settlements = [
+                    {
+                        "payment_id": job.payment_id,
+                        "status": "completed" if result.approved else "failed",
+                        "completed_at": now if result.approved else None
+                    }
+                    for job, result in batch
+                ]
+                try:
+                    updated = set(await asyncio.to_thread(self._write, settlements))
+                except Exception:
+                    # Результаты шлюза не теряем: пачка вернется в буфер до следующей попытки
+                    self._results = batch + self._results
+                    raise
+                completed = [job for job, result in batch if result.approved and job.payment_id in updated]
+                self.settled += len(completed)
+                self.failed += len(updated) - len(completed)
+                if completed and self.on_completed:
+                    await self.on_completed(completed)
+
+    def _write(self, settlements: List[dict]) -> List[str]:
+        db = self.session_factory()
+        try:
+            return apply_settlements(db, settlements)
+        finally:
+            db.close()
+
+
+async def notify_payments_completed(jobs: List[SettlementJob]):
+    """Send payment confirmation emails (don't fail settlement if they fail)"""
+    try:
+        async with httpx.AsyncClient() as client:
+            await asyncio.gather(*(
+                client.post(
+                    f"{NOTIFICATION_SERVICE_URL}/notify-payment",
+                    json={
+                        "user_id": job.user_id,
+                        "payment_id": job.payment_id,
+                        "amount": float(job.amount),
+                        "currency": job.currency,
+                        "payment_method": job.payment_method,
+                        "booking_id": job.booking_id,
+                        "flight_number": job.flight_number,
+                        "origin": job.origin,
+                        "destination": job.destination
+                    },
+                    timeout=5.0
+                )
+                for job in jobs
+            ), return_exceptions=True)
+    except Exception as e:
+        print(f"Failed to send payment notifications: {e}")
+
+
+def _warm_receipts(payment_ids: List[str]):
+    db = SessionLocal()
+    try:
+        warm_receipt_cache(db, payment_ids)
+    finally:
+        db.close()
+
+
+async def on_payments_completed(jobs: List[SettlementJob]):
+    """Cache receipts and send confirmation emails for completed payments"""
+    try:
+        await asyncio.to_thread(_warm_receipts, [job.payment_id for job in jobs])
+    except Exception as e:
+        print(f"Failed to cache receipts: {e}")
+    await notify_payments_completed(jobs)
+
+
+settlement_pipeline = SettlementPipeline(
+    gateway=PAYMENT_GATEWAYS[PAYMENT_GATEWAY](),
+    session_factory=SessionLocal,
+    workers=SETTLEMENT_WORKERS,
+    batch_size=SETTLEMENT_BATCH_SIZE,
+    flush_interval=SETTLEMENT_FLUSH_INTERVAL_SECONDS,
+    on_completed=on_payments_completed,
+    queue_size=SETTLEMENT_QUEUE_SIZE,
+)
+
+
+def load_settlement_jobs(db: Session, payment_ids: Optional[List[str]] = None) -> List[SettlementJob]:
+    """Jobs for the given payments, or for every pending payment left over from a previous run"""
+    query = """
+        SELECT p.payment_id, p.booking_id, p.user_id, p.amount, p.currency, p.payment_method,
+               f.flight_number, f.origin, f.destination
+        FROM payments p
+        LEFT JOIN bookings b ON b.id = p.booking_id
+        LEFT JOIN flights f ON f.id = b.flight_id
+    """
+    if payment_ids is None:
+        result = db.execute(text(query + " WHERE p.status = 'pending'"))
+    else:
+        result = db.execute(
+            text(query + " WHERE p.payment_id IN :payment_ids")
+            .bindparams(bindparam("payment_ids", expanding=True)),
+            {"payment_ids": payment_ids}
+        )
+    return [
+        SettlementJob(
+            payment_id=row[0], booking_id=row[1], user_id=row[2], amount=float(row[3]),
+            currency=row[4], payment_method=row[5],
+            flight_number=row[6], origin=row[7], destination=row[8]
+        )
+        for row in result
+    ]
+
+
+@app.on_event("startup")
+async def start_settlement():
+    await settlement_pipeline.start()
+    try:
+        db = settlement_pipeline.session_factory()
+        try:
+            for job in load_settlement_jobs(db):
+                await settlement_pipeline.submit(job)
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"Note: could not resume pending payments: {e}")
+
+
+@app.on_event("shutdown")
+async def stop_settlement():
+    await settlement_pipeline.stop()
+
+
+fx_refresh_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def start_fx_refresh():
+    global fx_refresh_task
+    try:
+        await refresh_fx_rates()
+    except Exception as e:
+        print(f"Failed to load FX rates: {e}")
+    fx_refresh_task = asyncio.create_task(fx_refresher())
+
+
+@app.on_event("shutdown")
+async def stop_fx_refresh():
+    if fx_refresh_task:
+        fx_refresh_task.cancel()
+
+
+def verify_webhook_signature(body: bytes, signature_header: Optional[str]) -> bool:
+    """Check the gateway HMAC signature and reject stale (replayed) deliveries"""
+    if not signature_header:
+        return False
+    parts = dict(part.split("=", 1) for part in signature_header.split(",") if "=" in part)
+    try:
+        timestamp = int(parts.get("t", ""))
+    except ValueError:
+        return False
+    if abs(time.time() - timestamp) > GATEWAY_WEBHOOK_TOLERANCE_SECONDS:
+        return False
+    expected = hmac.new(
+        GATEWAY_WEBHOOK_SECRET.encode(), f"{timestamp}.".encode() + body, hashlib.sha256
+    ).hexdigest()
+    return hmac.compare_digest(expected, parts.get("v1", ""))
+
+
+def parse_webhook_events(body: bytes) -> List[GatewayEvent]:
+    """Accept a single event, a JSON array or an {"events": [...]} batch"""
+    payload = json.loads(body)
+    if isinstance(payload, dict) and "events" in payload:
+        payload = payload["events"]
+    if not isinstance(payload, list):
+        payload = [payload]
+    return [GatewayEvent(**event) for event in payload]
+
+
+def record_webhook_events(db: Session, events: List[GatewayEvent]) -> set:
+    """Insert event ids in one statement; returns the ids not seen before"""
+    values = []
+    params = {}
+    now = datetime.utcnow()
+    for i, event in enumerate(events):
+        values.append(f"(:event_id_{i}, :payment_id_{i}, :status_{i}, :received_at_{i})")
+        params[f"event_id_{i}"] = event.event_id
+        params[f"payment_id_{i}"] = event.payment_id
+        params[f"status_{i}"] = event.status
+        params[f"received_at_{i}"] = now
+    result = db.execute(
+        text(f"""
+            INSERT INTO gateway_webhook_events (event_id, payment_id, status, received_at)
+            VALUES {', '.join(values)}
+            ON CONFLICT (event_id) DO NOTHING
+            RETURNING event_id
+        """),
+        params
+    )
+    return {row[0] for row in result}
 
 
 # Routes
+@app.post("/webhooks/gateway", response_model=WebhookResponse)
+async def gateway_webhook(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    x_gateway_signature: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """Apply payment status callbacks from the gateway (single event or batch)"""
+    body = await request.body()
+    if not verify_webhook_signature(body, x_gateway_signature):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid webhook signature"
+        )
+    
+    try:
+        events = parse_webhook_events(body)
+    except (ValueError, TypeError, ValidationError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid webhook payload"
+        )
+    if len(events) > GATEWAY_WEBHOOK_MAX_EVENTS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Too many events in one delivery (max {GATEWAY_WEBHOOK_MAX_EVENTS})"
+        )
+    invalid = [event.event_id for event in events if event.status not in ("completed", "failed")]
+    if invalid:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unsupported status in events: {', '.join(invalid)}"
+        )
+    
+    # Повторы внутри одной пачки отбрасываем сразу, остальные - по таблице событий
+    first_seen = {}
+    for event in events:
+        first_seen.setdefault(event.event_id, event)
+    unique_events = list(first_seen.values())
+    new_ids = record_webhook_events(db, unique_events) if unique_events else set()
+    
+    # Для одного платежа побеждает последнее событие в пачке
+    now = datetime.utcnow()
+    settlements = {
+        event.payment_id: {
+            "payment_id": event.payment_id,
+            "status": event.status,
+            "completed_at": (event.occurred_at or now) if event.status == "completed" else None
+        }
+        for event in unique_events if event.event_id in new_ids
+    }
+    updated = apply_settlements(db, list(settlements.values())) if settlements else []
+    db.commit()
+    
+    completed = [payment_id for payment_id in updated if settlements[payment_id]["status"] == "completed"]
+    if completed and settlement_pipeline.on_completed:
+        background_tasks.add_task(settlement_pipeline.on_completed, load_settlement_jobs(db, completed))
+    
+    return WebhookResponse(
+        received=len(events),
+        duplicates=len(events) - len(new_ids),
+        applied=len(updated)
+    )
+
+
 @app.post("/payments", response_model=PaymentResponse, status_code=status.HTTP_201_CREATED)
 async def create_payment(
     payment_data: PaymentCreate,
+    request: Request,
     user_info: dict = Depends(verify_token),
     db: Session = Depends(get_db)
 ):
     """Create a payment for a booking"""
     user_id = user_info["user_id"]
     
+    context = load_payment_context(db, payment_data.booking_id)
+    
     # Check if booking exists and belongs to user
-    if not check_booking_ownership(db, payment_data.booking_id, user_id):
+    if not context or context.user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Booking not found or does not belong to you"
         )
     
     # Check if payment already exists for this booking
-    from sqlalchemy import text
-    existing = db.execute(
-        text("SELECT id FROM payments WHERE booking_id = :booking_id AND status = 'completed'"),
-        {"booking_id": payment_data.booking_id}
-    ).fetchone()
-    
-    if existing:
+    if context.active_status == "completed":
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Payment already completed for this booking"
         )
+    if context.active_status == "pending":
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Payment already in progress for this booking"
+        )
     
     # Get booking price
-    booking_price = get_booking_price(db, payment_data.booking_id)
+    booking_price = float(context.price) if context.price else None
     if not booking_price:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Flight price not found"
         )
     
+    # Convert the price (stored in FX_BASE_CURRENCY) into the payment currency
+    currency = (payment_data.currency or FX_BASE_CURRENCY).upper()
+    expected_amount = fx_snapshot.convert(booking_price, currency)
+    if expected_amount is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unsupported currency: {currency}"
+        )
+    
     # Validate amount
-    if abs(payment_data.amount - booking_price) > 0.01:
+    if abs(payment_data.amount - expected_amount) > 0.01:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Amount mismatch. Expected: {booking_price}, Got: {payment_data.amount}"
+            detail=f"Amount mismatch. Expected: {expected_amount} {currency}, Got: {payment_data.amount}"
+        )
+    
+    # Fraud screening; amounts are counted in the price currency
+    if FRAUD_SCREENING_ENABLED:
+        screening = fraud_engine.score(
+            booking_price,
+            user_id=user_id,
+            card=payment_data.card_fingerprint,
+            ip=request.client.host if request.client else None
         )
+        if screening.decision == "block":
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Payment declined by fraud screening"
+            )
+        if screening.decision == "review":
+            print(f"Fraud review for user {user_id}: score {screening.score}, rules {', '.join(screening.rules)}")
     
     # Generate payment ID
     payment_id = f"PAY-{uuid.uuid4().hex[:12].upper()}"
     
-    # Create payment record
-    new_payment = Payment(
+    # The payment is recorded as pending and authorized by the settlement
+    # pipeline; the partial unique index rejects a concurrent second payment
+    created_at = datetime.utcnow()
+    try:
+        new_payment_id = db.execute(
+            text("""
+                INSERT INTO payments (booking_id, user_id, payment_id, amount, currency,
+                                      payment_method, status, created_at)
+                VALUES (:booking_id, :user_id, :payment_id, :amount, :currency,
+                        :payment_method, 'pending', :created_at)
+                RETURNING id
+            """),
+            {
+                "booking_id": payment_data.booking_id,
+                "user_id": user_id,
+                "payment_id": payment_id,
+                "amount": payment_data.amount,
+                "currency": currency,
+                "payment_method": payment_data.payment_method,
+                "created_at": created_at
+            }
+        ).scalar_one()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Payment already in progress for this booking"
+        )
+    
+    await settlement_pipeline.submit(SettlementJob(
+        payment_id=payment_id,
         booking_id=payment_data.booking_id,
         user_id=user_id,
-        payment_id=payment_id,
         amount=payment_data.amount,
-        currency=payment_data.currency,
+        currency=currency,
         payment_method=payment_data.payment_method,
-        status="pending"
-    )
-    db.add(new_payment)
-    db.commit()
-    db.refresh(new_payment)
-    
-    # Simulate payment processing (in production, integrate with payment gateway)
-    # For demo purposes, auto-complete payment
-    new_payment.status = "completed"
-    new_payment.completed_at = datetime.utcnow()
-    db.commit()
-    db.refresh(new_payment)
-    
-    # Get flight information for notification
-    from sqlalchemy import text
-    flight_result = db.execute(
-        text("""
-            SELECT f.flight_number, f.origin, f.destination
-            FROM flights f
-            JOIN bookings b ON f.id = b.flight_id
-            WHERE b.id = :booking_id
-        """),
-        {"booking_id": payment_data.booking_id}
-    )
-    flight_row = flight_result.fetchone()
-    
-    # Send email notification (async, don't fail if notification fails)
-    try:
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                f"{NOTIFICATION_SERVICE_URL}/notify-payment",
-                json={
-                    "user_id": user_id,
-                    "payment_id": payment_id,
-                    "amount": float(payment_data.amount),
-                    "currency": payment_data.currency,
-                    "payment_method": payment_data.payment_method,
-                    "booking_id": payment_data.booking_id,
-                    "flight_number": flight_row[0] if flight_row else None,
-                    "origin": flight_row[1] if flight_row else None,
-                    "destination": flight_row[2] if flight_row else None
-                },
-                timeout=5.0
-            )
-    except Exception as e:
-        print(f"Failed to send payment notification: {e}")
-        # Don't fail the payment if notification fails
+        flight_number=context.flight_number,
+        origin=context.origin,
+        destination=context.destination
+    ))
     
     return PaymentResponse(
-        id=new_payment.id,
-        booking_id=new_payment.booking_id,
-        user_id=new_payment.user_id,
-        payment_id=new_payment.payment_id,
-        amount=float(new_payment.amount),
-        currency=new_payment.currency,
-        payment_method=new_payment.payment_method,
-        status=new_payment.status,
-        created_at=new_payment.created_at,
-        completed_at=new_payment.completed_at,
-        refund_id=new_payment.refund_id
+        id=new_payment_id,
+        booking_id=payment_data.booking_id,
+        user_id=user_id,
+        payment_id=payment_id,
+        amount=float(payment_data.amount),
+        currency=currency,
+        payment_method=payment_data.payment_method,
+        status="pending",
+        created_at=created_at,
+        completed_at=None,
+        refund_id=None
     )
 
 
 @app.get("/payments", response_model=List[PaymentResponse])
 async def get_my_payments(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    status_filter: Optional[str] = Query(None, alias="status"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
     user_info: dict = Depends(verify_token),
     db: Session = Depends(get_db)
 ):
-    """Get all payments for current user"""
-    user_id = user_info["user_id"]
+    """Get current user's payments, newest first.
     
-    payments = db.query(Payment).filter(Payment.user_id == user_id).order_by(Payment.created_at.desc()).all()
+    Keyset pagination: pass the X-Next-Cursor header of a page as ?cursor=
+    to get the next one; the header is absent on the last page.
+    """
+    conditions = ["user_id = :user_id"]
+    params = {"user_id": user_info["user_id"], "limit": limit + 1}
+    if status_filter is not None:
+        conditions.append("status = :status")
+        params["status"] = status_filter
+    if date_from is not None:
+        conditions.append("created_at >= :date_from")
+        params["date_from"] = datetime.combine(date_from, datetime.min.time())
+    if date_to is not None:
+        conditions.append("created_at < :date_to")
+        params["date_to"] = datetime.combine(date_to + timedelta(days=1), datetime.min.time())
+    if cursor is not None:
+        params["cursor_created_at"], params["cursor_id"] = decode_payment_cursor(cursor)
+        conditions.append("(created_at, id) < (:cursor_created_at, :cursor_id)")
     
-    return [
-        PaymentResponse(
-            id=p.id,
-            booking_id=p.booking_id,
-            user_id=p.user_id,
-            payment_id=p.payment_id,
-            amount=float(p.amount),
-            currency=p.currency,
-            payment_method=p.payment_method,
-            status=p.status,
-            created_at=p.created_at,
-            completed_at=p.completed_at,
-            refund_id=p.refund_id
-        )
-        for p in payments
-    ]
+    rows = db.execute(
+        text(f"""
+            SELECT id, booking_id, user_id, payment_id, amount, currency, payment_method,
+                   status, created_at, completed_at, refund_id
+            FROM payments
+            WHERE {' AND '.join(conditions)}
+            ORDER BY created_at DESC, id DESC
+            LIMIT :limit
+        """).columns(created_at=DateTime, completed_at=DateTime),
+        params
+    ).fetchall()
+    
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = encode_payment_cursor(rows[-1].created_at, rows[-1].id)
+    return JSONResponse(content=[payment_row_to_dict(row) for row in rows], headers=headers)
 
 
 @app.get("/payments/{payment_id}", response_model=PaymentResponse)
@@ -387,8 +1957,12 @@ async def refund_payment(
     # Update payment status
     payment.status = "refunded"
     payment.refund_id = refund_id
+    payment.refunded_at = datetime.utcnow()
+    db.flush()
+    record_revenue(db, [payment.payment_id], "refunded")
     db.commit()
     db.refresh(payment)
+    receipt_cache.invalidate(payment.payment_id)
     
     # In production, integrate with payment gateway to process refund
     # For demo, we just update the status
@@ -441,81 +2015,242 @@ async def get_payment_by_booking(
     )
 
 
-@app.get("/payments/{payment_id}/receipt")
-async def get_receipt(
-    payment_id: str,
-    user_info: dict = Depends(verify_token),
+@app.post("/admin/flights/{flight_id}/refunds", response_model=BulkRefundStatus)
+async def refund_flight(
+    flight_id: int,
+    admin_info: dict = Depends(verify_admin),
     db: Session = Depends(get_db)
 ):
-    """Get receipt data for a payment"""
-    user_id = user_info["user_id"]
+    """Refund completed and cancel pending payments for a cancelled flight"""
+    current = bulk_refunds.get(flight_id)
+    if current and current.status == "running":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Refunds for this flight are already in progress"
+        )
     
-    # Get payment
-    payment = db.query(Payment).filter(
-        Payment.payment_id == payment_id,
-        Payment.user_id == user_id
-    ).first()
+    progress = BulkRefundStatus(flight_id=flight_id, status="running", started_at=datetime.utcnow())
+    bulk_refunds[flight_id] = progress
+    try:
+        # В отдельном потоке, чтобы GET с прогрессом обслуживался во время возврата
+        await asyncio.to_thread(refund_flight_payments, db, progress)
+        progress.status = "completed"
+    except Exception as e:
+        db.rollback()
+        progress.status = "failed"
+        progress.refunded = 0
+        progress.cancelled = 0
+        progress.amount = 0.0
+        progress.error = str(e)
+        print(f"Bulk refund for flight {flight_id} failed: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Bulk refund failed, no payments were refunded"
+        )
+    finally:
+        progress.finished_at = datetime.utcnow()
     
-    if not payment:
+    print(f"Refunded {progress.refunded}/{progress.total} payments for flight {flight_id}")
+    return progress
+
+
+@app.get("/admin/flights/{flight_id}/refunds", response_model=BulkRefundStatus)
+async def get_flight_refund_status(
+    flight_id: int,
+    admin_info: dict = Depends(verify_admin)
+):
+    """Progress of the latest bulk refund for a flight"""
+    progress = bulk_refunds.get(flight_id)
+    if not progress:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="Payment not found"
+            detail="No bulk refund for this flight"
         )
+    return progress
+
+
+@app.get("/admin/revenue", response_model=List[RevenueRow])
+async def get_revenue(
+    date_from: date,
+    date_to: date,
+    group_by: str = "day",
+    currency: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    origin: Optional[str] = None,
+    destination: Optional[str] = None,
+    admin_info: dict = Depends(verify_admin),
+    db: Session = Depends(get_db)
+):
+    """Revenue from the daily rollup, grouped by any of day, route, currency, payment_method.
     
-    # Get booking details
-    from sqlalchemy import text
-    booking_result = db.execute(
-        text("""
-            SELECT b.id, b.seat_number, b.booking_date, b.status,
-                   f.flight_number, f.origin, f.destination, 
-                   f.departure_time, f.arrival_time, f.price,
-                   u.first_name, u.last_name, u.email, u.phone
-            FROM bookings b
-            JOIN flights f ON b.flight_id = f.id
-            JOIN users u ON b.user_id = u.id
-            WHERE b.id = :booking_id
-        """),
-        {"booking_id": payment.booking_id}
-    )
-    booking_row = booking_result.fetchone()
+    Amounts are never summed across currencies: currency is always part of the grouping.
+    """
+    dimensions = [dimension.strip() for dimension in group_by.split(",") if dimension.strip()]
+    unknown = [dimension for dimension in dimensions if dimension not in REVENUE_DIMENSIONS]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown group_by dimensions: {', '.join(unknown)}"
+        )
+    columns = [column for dimension in dimensions for column in REVENUE_DIMENSIONS[dimension]]
+    if "currency" not in columns:
+        columns.append("currency")
+    
+    conditions = ["day >= :date_from", "day <= :date_to"]
+    params = {"date_from": date_from, "date_to": date_to}
+    for column, value in [("currency", currency), ("payment_method", payment_method),
+                          ("origin", origin), ("destination", destination)]:
+        if value is not None:
+            conditions.append(f"{column} = :{column}")
+            params[column] = value
     
-    if not booking_row:
+    grouping = f"GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}" if columns else ""
+    rows = db.execute(
+        text(f"""
+            SELECT {''.join(f'{column}, ' for column in columns)}
+                   COALESCE(SUM(payments_count), 0) AS payments_count,
+                   COALESCE(SUM(gross_amount), 0) AS gross_amount,
+                   COALESCE(SUM(refunds_count), 0) AS refunds_count,
+                   COALESCE(SUM(refunded_amount), 0) AS refunded_amount
+            FROM revenue_daily
+            WHERE {' AND '.join(conditions)}
+            {grouping}
+        """).columns(day=Date),
+        params
+    ).mappings().all()
+    
+    return [
+        RevenueRow(
+            **{column: row[column] for column in columns},
+            payments_count=row["payments_count"],
+            gross_amount=float(row["gross_amount"]),
+            refunds_count=row["refunds_count"],
+            refunded_amount=float(row["refunded_amount"]),
+            net_amount=round(float(row["gross_amount"]) - float(row["refunded_amount"]), 2)
+        )
+        for row in rows
+    ]
+
+
+@app.get("/admin/reconciliation")
+async def reconcile_payments(
+    booking_id_from: Optional[int] = None,
+    booking_id_to: Optional[int] = None,
+    unpaid_grace_minutes: int = Query(RECONCILIATION_UNPAID_GRACE_MINUTES, ge=0),
+    admin_info: dict = Depends(verify_admin),
+    db: Session = Depends(get_db)
+):
+    """Stream booking/payment discrepancies as NDJSON, one object per line"""
+    def lines():
+        for discrepancy in stream_ledger_discrepancies(db, booking_id_from, booking_id_to, unpaid_grace_minutes):
+            yield json.dumps(discrepancy) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/payments/receipts/export")
+async def export_receipts(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    user_id: Optional[int] = None,
+    user_info: dict = Depends(verify_token),
+    db: Session = Depends(get_db)
+):
+    """Download settled payment receipts as a zip of PDFs"""
+    if not is_admin_user(db, user_info["user_id"]):
+        if user_id is not None and user_id != user_info["user_id"]:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Admin access required"
+            )
+        user_id = user_info["user_id"]
+    elif user_id is None and date_from is None and date_to is None:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Booking not found"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Specify user_id or a date range"
         )
     
-    return {
-        "payment": {
-            "payment_id": payment.payment_id,
-            "amount": float(payment.amount),
-            "currency": payment.currency,
-            "payment_method": payment.payment_method,
-            "status": payment.status,
-            "created_at": payment.created_at.isoformat(),
-            "completed_at": payment.completed_at.isoformat() if payment.completed_at else None
-        },
-        "booking": {
-            "id": booking_row[0],
-            "seat_number": booking_row[1],
-            "booking_date": booking_row[2].isoformat() if booking_row[2] else None,
-            "status": booking_row[3]
-        },
-        "flight": {
-            "flight_number": booking_row[4],
-            "origin": booking_row[5],
-            "destination": booking_row[6],
-            "departure_time": booking_row[7].isoformat() if booking_row[7] else None,
-            "arrival_time": booking_row[8].isoformat() if booking_row[8] else None,
-            "price": float(booking_row[9]) if booking_row[9] else 0.0
-        },
-        "user": {
-            "first_name": booking_row[10],
-            "last_name": booking_row[11],
-            "email": booking_row[12],
-            "phone": booking_row[13]
-        }
-    }
+    conditions = ["status IN ('completed', 'refunded')"]
+    params = {}
+    if user_id is not None:
+        conditions.append("user_id = :user_id")
+        params["user_id"] = user_id
+    if date_from is not None:
+        conditions.append("created_at >= :date_from")
+        params["date_from"] = datetime.combine(date_from, datetime.min.time())
+    if date_to is not None:
+        conditions.append("created_at < :date_to")
+        params["date_to"] = datetime.combine(date_to + timedelta(days=1), datetime.min.time())
+    payment_ids = [
+        row[0] for row in db.execute(
+            text(f"SELECT payment_id FROM payments WHERE {' AND '.join(conditions)} ORDER BY created_at"),
+            params
+        )
+    ]
+    
+    return StreamingResponse(
+        stream_receipts_zip(db, payment_ids),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="receipts.zip"'}
+    )
+
+
+@app.get("/payments/{payment_id}/receipt")
+async def get_receipt(
+    payment_id: str,
+    request: Request,
+    user_info: dict = Depends(verify_token),
+    db: Session = Depends(get_db)
+):
+    """Get receipt data for a payment"""
+    entry = get_receipt_entry(db, payment_id, user_info["user_id"])
+    headers = {"ETag": entry.etag, "Cache-Control": receipt_cache_control(entry)}
+    if etag_matches(request, entry.etag):
+        receipt_cache.not_modified += 1
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+@app.get("/payments/{payment_id}/receipt.pdf")
+async def get_receipt_pdf_file(
+    payment_id: str,
+    request: Request,
+    user_info: dict = Depends(verify_token),
+    db: Session = Depends(get_db)
+):
+    """Get the receipt as a PDF"""
+    entry = get_receipt_entry(db, payment_id, user_info["user_id"])
+    etag = '"' + receipt_pdf_digest(entry) + '"'
+    headers = {"ETag": etag, "Cache-Control": receipt_cache_control(entry)}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    headers["Content-Disposition"] = f'inline; filename="receipt-{payment_id}.pdf"'
+    return Response(content=await get_receipt_pdf(entry), media_type="application/pdf", headers=headers)
+
+
+@app.post("/internal/users/{user_id}/receipts/invalidate", status_code=status.HTTP_204_NO_CONTENT,
+          dependencies=[Depends(verify_internal)])
+async def invalidate_user_receipts(user_id: int):
+    """Drop a user's cached receipts (internal service endpoint, called after profile edits)"""
+    receipt_cache.invalidate_user(user_id)
+    return None
+
+
+@app.get("/metrics", dependencies=[Depends(verify_internal)])
+async def get_metrics():
+    return {"receipt_cache": receipt_cache.stats(), "fraud": fraud_engine.stats()}
+
+
+@app.get("/fx-rates", response_model=FxRatesResponse)
+async def get_fx_rates():
+    """Current conversion rates from the flight price currency"""
+    snapshot = fx_snapshot
+    return FxRatesResponse(
+        base=FX_BASE_CURRENCY,
+        as_of=snapshot.as_of,
+        loaded_at=snapshot.loaded_at,
+        rates=snapshot.rates
+    )
 
 
 @app.get("/health")
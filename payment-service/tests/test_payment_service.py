@@ -7,11 +7,21 @@ from unittest.mock import patch, AsyncMock, MagicMock
 import sys
 import os
 from jose import jwt
+from datetime import date, datetime
+import hashlib
+import hmac
+import io
+import json
+import time
+import zipfile
 
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# Add repository root to path (shared helpers)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
 
-from main import app, get_db, Base
+import main
+from main import app, get_db, Base, SettlementJob, SettlementPipeline, SimulatedGateway, receipt_cache
 
 # Create in-memory SQLite database for testing
 SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
@@ -39,12 +49,25 @@ def db():
         db.execute(text("DROP TABLE IF EXISTS payments"))
         db.execute(text("DROP TABLE IF EXISTS bookings"))
         db.execute(text("DROP TABLE IF EXISTS flights"))
+        db.execute(text("DROP TABLE IF EXISTS users"))
+        db.execute(text("""
+            CREATE TABLE users (
+                id INTEGER PRIMARY KEY,
+                first_name TEXT,
+                last_name TEXT,
+                email TEXT,
+                phone TEXT,
+                is_admin INTEGER DEFAULT 0
+            )
+        """))
+        db.execute(text("INSERT INTO users (id, first_name, last_name, is_admin) VALUES (99, 'Admin', 'User', 1)"))
         db.execute(text("""
             CREATE TABLE bookings (
                 id INTEGER PRIMARY KEY,
                 user_id INTEGER,
                 flight_id INTEGER,
                 seat_number TEXT,
+                booking_date TIMESTAMP,
                 status TEXT
             )
         """))
@@ -54,6 +77,8 @@ def db():
                 flight_number TEXT,
                 origin TEXT,
                 destination TEXT,
+                departure_time TIMESTAMP,
+                arrival_time TIMESTAMP,
                 price REAL
             )
         """))
@@ -69,9 +94,14 @@ def db():
                 status TEXT,
                 created_at TIMESTAMP,
                 completed_at TIMESTAMP,
-                refund_id TEXT
+                refund_id TEXT,
+                refunded_at TIMESTAMP
             )
         """))
+        db.execute(text("""
+            CREATE UNIQUE INDEX idx_payments_booking_active
+            ON payments(booking_id) WHERE status IN ('pending', 'completed')
+        """))
         db.commit()
         yield db
     finally:
@@ -79,6 +109,7 @@ def db():
         db.execute(text("DROP TABLE IF EXISTS payments"))
         db.execute(text("DROP TABLE IF EXISTS bookings"))
         db.execute(text("DROP TABLE IF EXISTS flights"))
+        db.execute(text("DROP TABLE IF EXISTS users"))
         db.commit()
         db.close()
 
@@ -98,6 +129,11 @@ def client(db):
             pass
     
     app.dependency_overrides[get_db] = override_get_db
+    main.settlement_pipeline.session_factory = TestingSessionLocal
+    main.settlement_pipeline.gateway = SimulatedGateway()
+    main.settlement_pipeline.on_completed = None
+    receipt_cache.clear()
+    main.fraud_engine.reset()
     with TestClient(app) as test_client:
         yield test_client
     app.dependency_overrides.clear()
@@ -152,7 +188,7 @@ class TestPaymentCreation:
         data = response.json()
         assert data["booking_id"] == 1
         assert data["amount"] == 299.99
-        assert data["status"] == "completed"
+        assert data["status"] == "pending"
         assert "payment_id" in data
     
     def test_create_payment_wrong_amount(self, client, test_booking_and_flight, test_token):
@@ -171,6 +207,40 @@ class TestPaymentCreation:
         assert response.status_code == 400
         assert "amount" in response.json()["detail"].lower()
     
+    def test_create_payment_in_other_currency(self, client, test_booking_and_flight, test_token):
+        """Test that the amount is validated after FX conversion"""
+        headers = {"Authorization": f"Bearer {test_token}"}
+        expected = round(299.99 * main.fx_snapshot.rates["EUR"], 2)
+        
+        response = client.post("/payments", headers=headers, json={
+            "booking_id": test_booking_and_flight["booking_id"],
+            "payment_method": "card",
+            "amount": 299.99,
+            "currency": "EUR"
+        })
+        assert response.status_code == 400
+        assert f"Expected: {expected} EUR" in response.json()["detail"]
+        
+        response = client.post("/payments", headers=headers, json={
+            "booking_id": test_booking_and_flight["booking_id"],
+            "payment_method": "card",
+            "amount": expected,
+            "currency": "eur"
+        })
+        assert response.status_code == 201
+        assert response.json()["currency"] == "EUR"
+    
+    def test_create_payment_unsupported_currency(self, client, test_booking_and_flight, test_token):
+        """Test that currencies without a rate are rejected"""
+        response = client.post("/payments", headers={"Authorization": f"Bearer {test_token}"}, json={
+            "booking_id": test_booking_and_flight["booking_id"],
+            "payment_method": "card",
+            "amount": 299.99,
+            "currency": "XYZ"
+        })
+        assert response.status_code == 400
+        assert "Unsupported currency" in response.json()["detail"]
+    
     def test_create_payment_duplicate(self, client, test_booking_and_flight, test_token, db):
         """Test creating duplicate payment"""
         # Create first payment
@@ -194,6 +264,189 @@ class TestPaymentCreation:
         )
         assert response.status_code == 400
         assert "already completed" in response.json()["detail"].lower()
+    
+    def test_create_payment_twice(self, client, test_booking_and_flight, test_token, db):
+        """Test that a second payment for a paid booking is rejected"""
+        payment_data = {
+            "booking_id": 1,
+            "payment_method": "card",
+            "amount": 299.99,
+            "currency": "USD"
+        }
+        headers = {"Authorization": f"Bearer {test_token}"}
+        assert client.post("/payments", json=payment_data, headers=headers).status_code == 201
+        response = client.post("/payments", json=payment_data, headers=headers)
+        assert response.status_code == 400
+        count = db.execute(text("SELECT COUNT(*) FROM payments WHERE booking_id = 1")).scalar()
+        assert count == 1
+    
+    def test_active_payment_unique_per_booking(self, db, test_booking_and_flight):
+        """Test the partial unique index that guards concurrent double payments"""
+        from sqlalchemy.exc import IntegrityError
+        insert = text("""
+            INSERT INTO payments (booking_id, user_id, payment_id, amount, currency,
+                                  payment_method, status, created_at)
+            VALUES (1, 1, :payment_id, 299.99, 'USD', 'card', :status, datetime('now'))
+        """)
+        db.execute(insert, {"payment_id": "PAY-A", "status": "pending"})
+        db.execute(insert, {"payment_id": "PAY-B", "status": "failed"})
+        with pytest.raises(IntegrityError):
+            db.execute(insert, {"payment_id": "PAY-C", "status": "completed"})
+        db.rollback()
+
+
+class TestSettlement:
+    """Test the background settlement pipeline"""
+    
+    def _insert_pending(self, db, count):
+        for i in range(count):
+            db.execute(text("""
+                INSERT INTO payments (booking_id, user_id, payment_id, amount, currency,
+                                      payment_method, status, created_at)
+                VALUES (:booking_id, 1, :payment_id, 10, 'USD', 'card', 'pending', datetime('now'))
+            """), {"booking_id": 100 + i, "payment_id": f"PAY-{i}"})
+        db.commit()
+        return [
+            SettlementJob(payment_id=f"PAY-{i}", booking_id=100 + i, user_id=1,
+                          amount=10.0, currency="USD", payment_method="card")
+            for i in range(count)
+        ]
+    
+    async def _settle(self, jobs, gateway):
+        completed = []
+        
+        async def on_completed(batch):
+            completed.extend(batch)
+        
+        pipeline = SettlementPipeline(
+            gateway=gateway, session_factory=TestingSessionLocal,
+            workers=4, batch_size=3, flush_interval=0.01, on_completed=on_completed
+        )
+        await pipeline.start()
+        for job in jobs:
+            await pipeline.submit(job)
+        await pipeline.join()
+        await pipeline.stop()
+        return pipeline, completed
+    
+    async def test_settles_in_batches(self, db):
+        """Test that approved payments become completed with completed_at"""
+        jobs = self._insert_pending(db, 7)
+        pipeline, completed = await self._settle(jobs, SimulatedGateway(0, 5, failure_rate=0.0))
+        
+        assert pipeline.settled == 7
+        assert len(completed) == 7
+        rows = db.execute(text("SELECT status, completed_at FROM payments")).fetchall()
+        assert all(row[0] == "completed" and row[1] is not None for row in rows)
+    
+    async def test_declined_payments_fail(self, db):
+        """Test that declined payments become failed without notifications"""
+        jobs = self._insert_pending(db, 3)
+        pipeline, completed = await self._settle(jobs, SimulatedGateway(failure_rate=1.0))
+        
+        assert pipeline.failed == 3
+        assert completed == []
+        statuses = {row[0] for row in db.execute(text("SELECT status FROM payments"))}
+        assert statuses == {"failed"}
+    
+    async def test_failed_write_keeps_batch(self, db):
+        """Test that gateway results survive a failed settlement write"""
+        jobs = self._insert_pending(db, 3)
+        
+        class FlakyPipeline(SettlementPipeline):
+            writes = 0
+            
+            def _write(self, settlements):
+                self.writes += 1
+                if self.writes == 1:
+                    raise RuntimeError("database is down")
+                return super()._write(settlements)
+        
+        pipeline = FlakyPipeline(
+            gateway=SimulatedGateway(), session_factory=TestingSessionLocal,
+            workers=2, batch_size=3, flush_interval=0.01
+        )
+        await pipeline.start()
+        for job in jobs:
+            await pipeline.submit(job)
+        # Первую запись может выполнить и фоновый flusher, и join()
+        try:
+            await pipeline.join()
+        except RuntimeError:
+            await pipeline.join()
+        await pipeline.stop()
+        
+        assert pipeline.writes == 2
+        assert pipeline.settled == 3
+        statuses = {row[0] for row in db.execute(text("SELECT status FROM payments"))}
+        assert statuses == {"completed"}
+
+
+class TestGatewayWebhook:
+    """Test gateway callback ingestion"""
+    
+    def _insert_pending(self, db, count):
+        for i in range(count):
+            db.execute(text("""
+                INSERT INTO payments (booking_id, user_id, payment_id, amount, currency,
+                                      payment_method, status, created_at)
+                VALUES (:booking_id, 1, :payment_id, 10, 'USD', 'card', 'pending', datetime('now'))
+            """), {"booking_id": 100 + i, "payment_id": f"PAY-{i}"})
+        db.commit()
+    
+    def _post(self, client, payload, secret=None):
+        body = json.dumps(payload).encode()
+        timestamp = int(time.time())
+        signature = hmac.new(
+            (secret or main.GATEWAY_WEBHOOK_SECRET).encode(), f"{timestamp}.".encode() + body, hashlib.sha256
+        ).hexdigest()
+        return client.post(
+            "/webhooks/gateway",
+            content=body,
+            headers={"X-Gateway-Signature": f"t={timestamp},v1={signature}"}
+        )
+    
+    def test_batch_applies_transitions(self, client, db):
+        """Test that a batch completes and fails pending payments"""
+        self._insert_pending(db, 3)
+        response = self._post(client, {"events": [
+            {"event_id": "evt-1", "payment_id": "PAY-0", "status": "completed"},
+            {"event_id": "evt-2", "payment_id": "PAY-1", "status": "failed"},
+            {"event_id": "evt-3", "payment_id": "PAY-2", "status": "completed"},
+        ]})
+        
+        assert response.status_code == 200
+        assert response.json() == {"received": 3, "duplicates": 0, "applied": 3}
+        rows = dict(db.execute(text("SELECT payment_id, status FROM payments")).fetchall())
+        assert rows == {"PAY-0": "completed", "PAY-1": "failed", "PAY-2": "completed"}
+    
+    def test_duplicate_events_are_ignored(self, client, db):
+        """Test that redelivered events do not change settled payments"""
+        self._insert_pending(db, 1)
+        event = {"event_id": "evt-1", "payment_id": "PAY-0", "status": "completed"}
+        assert self._post(client, event).json()["applied"] == 1
+        
+        db.execute(text("UPDATE payments SET status = 'pending'"))
+        db.commit()
+        response = self._post(client, [event, event])
+        
+        assert response.json() == {"received": 2, "duplicates": 2, "applied": 0}
+        assert db.execute(text("SELECT status FROM payments")).scalar() == "pending"
+    
+    def test_settled_payment_not_overwritten(self, client, db):
+        """Test that only pending payments transition"""
+        self._insert_pending(db, 1)
+        self._post(client, {"event_id": "evt-1", "payment_id": "PAY-0", "status": "completed"})
+        response = self._post(client, {"event_id": "evt-2", "payment_id": "PAY-0", "status": "failed"})
+        
+        assert response.json() == {"received": 1, "duplicates": 0, "applied": 0}
+        assert db.execute(text("SELECT status FROM payments")).scalar() == "completed"
+    
+    def test_invalid_signature(self, client, db):
+        """Test that unsigned or wrongly signed deliveries are rejected"""
+        event = {"event_id": "evt-1", "payment_id": "PAY-0", "status": "completed"}
+        assert self._post(client, event, secret="wrong-secret").status_code == 401
+        assert client.post("/webhooks/gateway", json=event).status_code == 401
 
 
 class TestPaymentQueries:
@@ -229,6 +482,42 @@ class TestPaymentQueries:
         payments = response.json()
         assert len(payments) == 1
     
+    def test_get_my_payments_paginated(self, client, test_token, db):
+        """Test keyset pagination with status and date filters"""
+        for i in range(5):
+            db.execute(text("""
+                INSERT INTO payments (booking_id, user_id, payment_id, amount, currency,
+                                      payment_method, status, created_at)
+                VALUES (:booking_id, 1, :payment_id, 10, 'USD', 'card', :status, :created_at)
+            """), {
+                "booking_id": 100 + i, "payment_id": f"PAY-{i}",
+                "status": "failed" if i == 2 else "completed",
+                # Две записи с одинаковым временем проверяют разрешение ничьей по id
+                "created_at": f"2026-03-0{min(i, 3) + 1} 10:00:00"
+            })
+        db.commit()
+        headers = {"Authorization": f"Bearer {test_token}"}
+        
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": 2, "status": "completed"}
+            if cursor:
+                params["cursor"] = cursor
+            response = client.get("/payments", params=params, headers=headers)
+            assert response.status_code == 200
+            seen.extend(payment["payment_id"] for payment in response.json())
+            cursor = response.headers.get("x-next-cursor")
+            if not cursor:
+                break
+        assert seen == ["PAY-4", "PAY-3", "PAY-1", "PAY-0"]
+        
+        response = client.get("/payments", params={"date_from": "2026-03-02", "date_to": "2026-03-03"},
+                              headers=headers)
+        assert [payment["payment_id"] for payment in response.json()] == ["PAY-2", "PAY-1"]
+        
+        assert client.get("/payments", params={"cursor": "garbage"}, headers=headers).status_code == 400
+    
     def test_get_payment_by_id(self, client, test_token, db):
         """Test getting specific payment"""
         # Clear and create test data
@@ -299,6 +588,463 @@ class TestRefund:
         assert "refund_id" in data
 
 
+class TestBulkRefund:
+    """Test refunding a cancelled flight"""
+    
+    @pytest.fixture
+    def admin_token(self):
+        return jwt.encode({"sub": "99", "is_admin": True}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    
+    @pytest.fixture
+    def flight_payments(self, db):
+        # Рейс 1: три завершенных и один ожидающий платеж; рейс 2: один завершенный
+        for booking_id, flight_id, payment_status in [
+            (1, 1, "completed"), (2, 1, "completed"), (3, 1, "completed"),
+            (4, 1, "pending"), (5, 2, "completed"),
+        ]:
+            db.execute(text("""
+                INSERT INTO bookings (id, user_id, flight_id, seat_number, status)
+                VALUES (:id, 1, :flight_id, :seat, 'confirmed')
+            """), {"id": booking_id, "flight_id": flight_id, "seat": f"A{booking_id}"})
+            db.execute(text("""
+                INSERT INTO payments (booking_id, user_id, payment_id, amount, currency,
+                                      payment_method, status, created_at)
+                VALUES (:booking_id, 1, :payment_id, 100.5, 'USD', 'card', :status, datetime('now'))
+            """), {"booking_id": booking_id, "payment_id": f"PAY-{booking_id}", "status": payment_status})
+        db.commit()
+    
+    def test_refund_flight(self, client, admin_token, db, flight_payments):
+        """Test that completed payments of the flight are refunded and pending ones cancelled"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = client.post("/admin/flights/1/refunds", headers=headers)
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert data["status"] == "completed"
+        assert (data["total"], data["refunded"], data["amount"]) == (3, 3, 301.5)
+        assert data["cancelled"] == 1
+        rows = dict(db.execute(text("SELECT payment_id, status FROM payments")).fetchall())
+        assert rows == {"PAY-1": "refunded", "PAY-2": "refunded", "PAY-3": "refunded",
+                        "PAY-4": "cancelled", "PAY-5": "completed"}
+        refund_ids = {row[0] for row in db.execute(text("SELECT refund_id FROM payments WHERE status = 'refunded'"))}
+        assert len(refund_ids) == 3
+        
+        assert client.get("/admin/flights/1/refunds", headers=headers).json()["refunded"] == 3
+    
+    def test_late_approval_of_cancelled_payment_is_refunded(self, client, admin_token, db, flight_payments):
+        """Test that a gateway approval arriving after the flight refund is refunded, not dropped"""
+        client.post("/admin/flights/1/refunds", headers={"Authorization": f"Bearer {admin_token}"})
+        
+        updated = main.apply_settlements(db, [
+            {"payment_id": "PAY-4", "status": "completed", "completed_at": datetime(2026, 1, 10, 12, 0)}
+        ])
+        
+        assert updated == []
+        row = db.execute(text(
+            "SELECT status, completed_at, refund_id FROM payments WHERE payment_id = 'PAY-4'"
+        )).fetchone()
+        assert row[0] == "refunded"
+        assert row[1] is not None
+        assert row[2].startswith("REF-")
+        
+    def test_refund_flight_requires_admin(self, client, test_token, flight_payments):
+        """Test that regular users cannot run bulk refunds"""
+        response = client.post("/admin/flights/1/refunds", headers={"Authorization": f"Bearer {test_token}"})
+        assert response.status_code == 403
+
+
+class TestRevenueRollup:
+    """Test incremental revenue rollups"""
+    
+    def test_rollup_follows_transitions(self, client, test_token, db):
+        """Test that completions and refunds update the daily rollup"""
+        admin_token = jwt.encode({"sub": "99", "is_admin": True}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+        db.execute(text("""
+            INSERT INTO flights (id, flight_number, origin, destination, price)
+            VALUES (1, 'FL001', 'Paris', 'London', 100), (2, 'FL002', 'Rome', 'Oslo', 50)
+        """))
+        for booking_id, flight_id in [(1, 1), (2, 1), (3, 2)]:
+            db.execute(text("""
+                INSERT INTO bookings (id, user_id, flight_id, seat_number, status)
+                VALUES (:id, 1, :flight_id, :seat, 'confirmed')
+            """), {"id": booking_id, "flight_id": flight_id, "seat": f"A{booking_id}"})
+            db.execute(text("""
+                INSERT INTO payments (booking_id, user_id, payment_id, amount, currency,
+                                      payment_method, status, created_at)
+                SELECT :booking_id, 1, :payment_id, price, 'USD', 'card', 'pending', '2026-03-01 10:00:00'
+                FROM flights WHERE id = :flight_id
+            """), {"booking_id": booking_id, "payment_id": f"PAY-{booking_id}", "flight_id": flight_id})
+        db.commit()
+        
+        main.apply_settlements(db, [
+            {"payment_id": f"PAY-{i}", "status": "completed", "completed_at": datetime(2026, 3, 1, 10, 0, 5)}
+            for i in (1, 2, 3)
+        ])
+        client.post("/payments/PAY-1/refund", headers={"Authorization": f"Bearer {test_token}"},
+                    json={"payment_id": "PAY-1"})
+        
+        response = client.get(
+            "/admin/revenue",
+            params={"date_from": "2026-03-01", "date_to": date.today().isoformat(), "group_by": "route"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        rows = {(row["origin"], row["destination"]): row for row in response.json()}
+        assert rows[("Paris", "London")]["payments_count"] == 2
+        assert rows[("Paris", "London")]["gross_amount"] == 200.0
+        assert rows[("Paris", "London")]["refunds_count"] == 1
+        assert rows[("Paris", "London")]["net_amount"] == 100.0
+        assert rows[("Rome", "Oslo")]["net_amount"] == 50.0
+        
+        response = client.get(
+            "/admin/revenue",
+            params={"date_from": "2026-03-01", "date_to": "2026-03-01", "group_by": "day"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.json()[0]["day"] == "2026-03-01"
+        assert response.json()[0]["payments_count"] == 3
+    
+    def test_revenue_never_mixes_currencies(self, client, db):
+        """Test that amounts in different currencies stay in separate rows"""
+        admin_token = jwt.encode({"sub": "99", "is_admin": True}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+        db.execute(text("""
+            INSERT INTO revenue_daily (day, origin, destination, currency, payment_method,
+                                       payments_count, gross_amount, refunds_count, refunded_amount)
+            VALUES ('2026-03-01', 'Paris', 'London', 'USD', 'card', 1, 100, 0, 0),
+                   ('2026-03-01', 'Paris', 'London', 'EUR', 'card', 1, 90, 0, 0)
+        """))
+        db.commit()
+        
+        response = client.get(
+            "/admin/revenue",
+            params={"date_from": "2026-03-01", "date_to": "2026-03-01", "group_by": "day"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        rows = {row["currency"]: row["gross_amount"] for row in response.json()}
+        assert rows == {"EUR": 90.0, "USD": 100.0}
+    
+    def test_revenue_rejects_unknown_dimension(self, client):
+        """Test group_by validation"""
+        admin_token = jwt.encode({"sub": "99", "is_admin": True}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+        response = client.get(
+            "/admin/revenue",
+            params={"date_from": "2026-03-01", "date_to": "2026-03-31", "group_by": "seat"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 400
+
+
+class TestFraudScreening:
+    """Test velocity-based fraud scoring"""
+    
+    def test_ring_counter_window(self):
+        """Test that old buckets fall out of the sliding window"""
+        counter = main.RingCounter(60, 1.0)
+        counter.add(1000.0, 1)
+        counter.add(1030.5, 2)
+        assert counter.total(1030.9) == 3
+        assert counter.total(1060.5) == 2
+        assert counter.total(1100.0) == 0
+        # Слот переиспользуется через полный круг
+        counter.add(1090.0, 5)
+        assert counter.total(1090.0) == 5
+    
+    def test_card_velocity_escalates(self):
+        """Test that rules add up from review to block"""
+        engine = main.FraudEngine(main.FRAUD_RULES, 50, 100, max_keys=100)
+        decisions = [engine.score(100.0, user_id=i, card="card-1", now=1000.0 + i).decision for i in range(4)]
+        assert decisions == ["allow", "allow", "allow", "review"]
+        
+        for _ in range(2):
+            engine.score(100.0, user_id=7, card="card-2", now=2000.0)
+        decision = engine.score(100.0, user_id=7, card="card-2", ip="10.0.0.1", now=2000.0)
+        assert decision.decision == "allow"
+        for _ in range(3):
+            decision = engine.score(100.0, user_id=7, card="card-2", now=2001.0)
+        assert decision.decision == "block"
+        assert set(decision.rules) == {"card_attempts_per_minute", "user_attempts_per_minute"}
+        # Через минуту счетчик попыток обнуляется
+        assert engine.score(100.0, user_id=8, card="card-2", now=2100.0).decision == "allow"
+        
+        stats = engine.stats()
+        assert stats["decisions"]["block"] >= 1
+        assert stats["tracked_keys"]["card"] == 2
+    
+    def test_amount_per_day_and_key_eviction(self):
+        """Test amount limits and the bound on tracked keys"""
+        engine = main.FraudEngine(main.FRAUD_RULES, 50, 100, max_keys=2)
+        limit = main.FRAUD_DAILY_AMOUNT_LIMIT
+        assert engine.score(limit, user_id=1, now=0.0).decision == "allow"
+        decision = engine.score(1.0, user_id=1, now=3600.0 * 5)
+        assert decision.decision == "review"
+        assert decision.rules == ["user_amount_per_day"]
+        
+        engine.score(1.0, user_id=2, now=0.0)
+        engine.score(1.0, user_id=3, now=0.0)
+        assert engine.stats()["tracked_keys"]["user"] == 2
+    
+    def test_blocked_payment(self, client, test_booking_and_flight, test_token):
+        """Test that a blocked attempt is rejected before the payment is recorded"""
+        for _ in range(25):
+            main.fraud_engine.score(1.0, user_id=1, ip="testclient")
+        
+        response = client.post("/payments", headers={"Authorization": f"Bearer {test_token}"}, json={
+            "booking_id": test_booking_and_flight["booking_id"],
+            "payment_method": "card",
+            "amount": 299.99,
+            "currency": "USD"
+        })
+        assert response.status_code == 403
+        
+        assert client.get("/metrics").status_code == 401
+        response = client.get("/metrics", headers={"X-Internal-Key": main.INTERNAL_API_KEY})
+        assert response.json()["fraud"]["decisions"]["block"] >= 1
+        assert response.json()["fraud"]["latency_us"]["max"] > 0
+
+
+class TestReconciliation:
+    """Test the streaming payment/booking reconciliation"""
+    
+    def test_reconcile_report(self, client, db):
+        """Test that every kind of discrepancy is reported in booking order"""
+        admin_token = jwt.encode({"sub": "99", "is_admin": True}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+        db.execute(text("INSERT INTO flights (id, flight_number, origin, destination, price) VALUES (1, 'FL001', 'Paris', 'London', 100)"))
+        # Двойные оплаты остались от данных до появления уникального индекса
+        db.execute(text("DROP INDEX idx_payments_booking_active"))
+        bookings = [
+            (1, "confirmed", "2026-01-01 10:00:00"),  # оплачено - без расхождений
+            (2, "confirmed", "2026-01-01 10:00:00"),  # две оплаты
+            (3, "confirmed", "2026-01-01 10:00:00"),  # не оплачено
+            (4, "confirmed", "2099-01-01 10:00:00"),  # не оплачено, но в пределах отсрочки
+            (5, "cancelled", "2026-01-01 10:00:00"),  # отменено, деньги не возвращены
+            (6, "confirmed", "2026-01-01 10:00:00"),  # возврат без отмены
+            (8, "cancelled", "2026-01-01 10:00:00"),  # отменено и возвращено
+        ]
+        for booking_id, booking_status, booked_at in bookings:
+            db.execute(text("""
+                INSERT INTO bookings (id, user_id, flight_id, seat_number, status, booking_date)
+                VALUES (:id, 1, 1, :seat, :status, :booked_at)
+            """), {"id": booking_id, "seat": f"A{booking_id}", "status": booking_status, "booked_at": booked_at})
+        payments = [(1, "completed"), (2, "completed"), (2, "completed"), (5, "completed"),
+                    (6, "refunded"), (7, "completed"), (8, "refunded"), (9, "pending")]
+        for i, (booking_id, payment_status) in enumerate(payments):
+            db.execute(text("""
+                INSERT INTO payments (booking_id, user_id, payment_id, amount, payment_method, status)
+                VALUES (:booking_id, 1, :payment_id, 100, 'card', :status)
+            """), {"booking_id": booking_id, "payment_id": f"PAY-{i}", "status": payment_status})
+        db.commit()
+        
+        response = client.get("/admin/reconciliation", headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        report = [json.loads(line) for line in response.text.splitlines()]
+        assert [(row["type"], row["booking_id"]) for row in report] == [
+            ("duplicate_payment", 2),
+            ("unpaid_booking", 3),
+            ("payment_not_refunded", 5),
+            ("refund_without_cancellation", 6),
+            ("payment_without_booking", 7),
+            ("payment_without_booking", 9),
+        ]
+        assert [p["payment_id"] for p in report[0]["payments"]] == ["PAY-1", "PAY-2"]
+        
+        response = client.get(
+            "/admin/reconciliation",
+            params={"booking_id_from": 3, "booking_id_to": 5, "unpaid_grace_minutes": 0},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert [json.loads(line)["booking_id"] for line in response.text.splitlines()] == [3, 5]
+    
+    def test_reconcile_requires_admin(self, client, test_token):
+        """Test that regular users cannot run reconciliation"""
+        response = client.get("/admin/reconciliation", headers={"Authorization": f"Bearer {test_token}"})
+        assert response.status_code == 403
+
+
+class TestFxRates:
+    """Test the FX rate snapshot"""
+    
+    async def test_refresh_swaps_snapshot(self, monkeypatch, tmp_path):
+        """Test that a changed file replaces the snapshot and a bad one is ignored"""
+        path = tmp_path / "rates.json"
+        path.write_text(json.dumps({"base": "EUR", "rates": {"USD": 1.25, "MDL": 20.0}}))
+        monkeypatch.setattr(main, "FX_RATES_FILE", str(path))
+        monkeypatch.setattr(main, "fx_snapshot", main.fx_snapshot)
+        
+        assert await main.refresh_fx_rates()
+        # Кросс-курс от USD (валюта цены): 1 USD = 0.8 EUR = 16 MDL
+        assert main.fx_snapshot.convert(100, "MDL") == 1600.0
+        assert main.fx_snapshot.convert(100, "EUR") == 80.0
+        assert not await main.refresh_fx_rates()
+        
+        snapshot = main.fx_snapshot
+        path.write_text(json.dumps({"base": "EUR", "rates": {"USD": -1}}))
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        with pytest.raises(ValueError):
+            await main.refresh_fx_rates()
+        assert main.fx_snapshot is snapshot
+    
+    def test_get_fx_rates(self, client):
+        """Test the public rates endpoint"""
+        response = client.get("/fx-rates")
+        assert response.status_code == 200
+        assert response.json()["base"] == "USD"
+        assert response.json()["rates"]["USD"] == 1.0
+
+
+class TestReceipt:
+    """Test receipt caching"""
+    
+    @pytest.fixture
+    def completed_payment(self, db, test_booking_and_flight):
+        db.execute(text("""
+            INSERT INTO users (id, first_name, last_name, email, phone)
+            VALUES (1, 'Ivan', 'Petrov', 'ivan@example.com', NULL)
+        """))
+        db.execute(text("""
+            INSERT INTO payments (booking_id, user_id, payment_id, amount, currency,
+                                  payment_method, status, created_at, completed_at)
+            VALUES (1, 1, 'PAY-RECEIPT', 299.99, 'USD', 'card', 'completed',
+                    '2026-01-10 12:00:00', '2026-01-10 12:00:05')
+        """))
+        db.commit()
+        return "PAY-RECEIPT"
+    
+    def test_receipt_revalidates_with_etag(self, client, test_token, completed_payment):
+        """Test that a cached receipt answers If-None-Match with 304"""
+        headers = {"Authorization": f"Bearer {test_token}"}
+        response = client.get(f"/payments/{completed_payment}/receipt", headers=headers)
+        
+        assert response.status_code == 200
+        assert response.json()["flight"]["flight_number"] == "FL001"
+        assert response.json()["user"]["email"] == "ivan@example.com"
+        etag = response.headers["etag"]
+        
+        response = client.get(
+            f"/payments/{completed_payment}/receipt",
+            headers={**headers, "If-None-Match": etag}
+        )
+        assert response.status_code == 304
+        assert receipt_cache.stats()["hits"] == 1
+    
+    def test_receipt_hidden_from_other_users(self, client, test_token, completed_payment):
+        """Test that a cached receipt is not served to another user"""
+        other_token = jwt.encode({"sub": "2"}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+        client.get(f"/payments/{completed_payment}/receipt",
+                   headers={"Authorization": f"Bearer {test_token}"})
+        
+        response = client.get(f"/payments/{completed_payment}/receipt",
+                              headers={"Authorization": f"Bearer {other_token}"})
+        assert response.status_code == 404
+    
+    def test_refund_invalidates_receipt(self, client, test_token, completed_payment):
+        """Test that a refund replaces the cached receipt"""
+        headers = {"Authorization": f"Bearer {test_token}"}
+        etag = client.get(f"/payments/{completed_payment}/receipt", headers=headers).headers["etag"]
+        
+        client.post(f"/payments/{completed_payment}/refund", headers=headers,
+                    json={"payment_id": completed_payment})
+        response = client.get(
+            f"/payments/{completed_payment}/receipt",
+            headers={**headers, "If-None-Match": etag}
+        )
+        
+        assert response.status_code == 200
+        assert response.json()["payment"]["status"] == "refunded"
+        assert response.headers["cache-control"] == f"private, max-age={main.RECEIPT_MAX_AGE_SECONDS}, must-revalidate"
+    
+    def test_warm_receipt_cache(self, db, completed_payment):
+        """Test that settled payments are rendered ahead of the first view"""
+        main.warm_receipt_cache(db, [completed_payment])
+        
+        entry = receipt_cache.get(completed_payment)
+        assert entry is not None
+        assert json.loads(entry.body)["payment"]["completed_at"] == "2026-01-10T12:00:05"
+    
+    def test_user_edit_invalidates_receipts(self, client, db, completed_payment):
+        """Test that a profile change drops the user's cached receipts"""
+        main.warm_receipt_cache(db, [completed_payment])
+        
+        response = client.post(
+            "/internal/users/1/receipts/invalidate",
+            headers={"X-Internal-Key": main.INTERNAL_API_KEY}
+        )
+        
+        assert response.status_code == 204
+        assert receipt_cache.get(completed_payment) is None
+    
+    def test_receipt_invalidation_requires_internal_key(self, client):
+        """Test that receipt invalidation is closed to callers without the internal key"""
+        response = client.post("/internal/users/1/receipts/invalidate", headers={"X-Internal-Key": "wrong"})
+        
+        assert response.status_code == 401
+
+
+class TestReceiptPdf:
+    """Test PDF receipts and bulk export"""
+    
+    @pytest.fixture
+    def settled_payments(self, db, monkeypatch, tmp_path):
+        monkeypatch.setattr(main, "RECEIPT_PDF_DIR", str(tmp_path))
+        db.execute(text("""
+            INSERT INTO users (id, first_name, last_name, email, phone)
+            VALUES (1, 'Иван', 'Петров', 'ivan@example.com', NULL)
+        """))
+        db.execute(text("""
+            INSERT INTO flights (id, flight_number, origin, destination, price)
+            VALUES (1, 'FL001', 'Paris', 'London', 299.99)
+        """))
+        for i, created_at in enumerate(["2026-01-10 12:00:00", "2026-02-10 12:00:00"]):
+            db.execute(text("""
+                INSERT INTO bookings (id, user_id, flight_id, seat_number, status)
+                VALUES (:id, 1, 1, :seat, 'confirmed')
+            """), {"id": i + 1, "seat": f"A{i + 1}"})
+            db.execute(text("""
+                INSERT INTO payments (booking_id, user_id, payment_id, amount, currency,
+                                      payment_method, status, created_at, completed_at)
+                VALUES (:booking_id, 1, :payment_id, 299.99, 'USD', 'card', 'completed',
+                        :created_at, :created_at)
+            """), {"booking_id": i + 1, "payment_id": f"PAY-{i}", "created_at": created_at})
+        db.commit()
+        return tmp_path
+    
+    def test_pdf_cached_on_disk(self, client, test_token, settled_payments):
+        """Test that the PDF is rendered once and stored by content hash"""
+        headers = {"Authorization": f"Bearer {test_token}"}
+        response = client.get("/payments/PAY-0/receipt.pdf", headers=headers)
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/pdf"
+        assert response.content.startswith(b"%PDF-1.4")
+        assert b"(Ivan Petrov)" in response.content
+        stored = list(settled_payments.glob("*/*.pdf"))
+        assert len(stored) == 1
+        assert response.headers["etag"] == f'"{stored[0].stem}"'
+        
+        assert client.get("/payments/PAY-0/receipt.pdf", headers=headers).content == response.content
+    
+    def test_export_zip_by_date_range(self, client, test_token, settled_payments):
+        """Test that the export contains only receipts in the range"""
+        response = client.get(
+            "/payments/receipts/export?date_from=2026-02-01&date_to=2026-02-28",
+            headers={"Authorization": f"Bearer {test_token}"}
+        )
+        
+        assert response.status_code == 200
+        archive = zipfile.ZipFile(io.BytesIO(response.content))
+        assert archive.namelist() == ["receipt-PAY-1.pdf"]
+        assert archive.read("receipt-PAY-1.pdf").startswith(b"%PDF")
+    
+    def test_export_other_user_forbidden(self, client, test_token, settled_payments):
+        """Test that regular users can only export their own receipts"""
+        response = client.get(
+            "/payments/receipts/export?user_id=2",
+            headers={"Authorization": f"Bearer {test_token}"}
+        )
+        assert response.status_code == 403
+
+
 class TestHealthCheck:
     """Test health check endpoint"""
     
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Скрипт для подбора параметров хеширования паролей под текущее железо
+Использование: python calibrate_password_hashing.py [--target-ms 250] [--scheme argon2|bcrypt]
+
+Подбирает параметры так, чтобы проверка пароля занимала примерно target-ms,
+и печатает переменные окружения для auth-service.
+"""
+
+import argparse
+import os
+import time
+from passlib.hash import argon2, bcrypt
+
+SAMPLE_PASSWORD = "calibration-password-123"
+
+
+def measure_verify_ms(handler, samples: int) -> float:
+    """Медиана времени проверки пароля в миллисекундах"""
+    hashed = handler.hash(SAMPLE_PASSWORD)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        handler.verify(SAMPLE_PASSWORD, hashed)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def calibrate_bcrypt(target_ms: float, samples: int) -> dict:
+    """Увеличивает rounds, пока проверка не станет дольше target_ms"""
+    best = None
+    for rounds in range(4, 32):
+        elapsed = measure_verify_ms(bcrypt.using(rounds=rounds), samples)
+        print(f"  bcrypt rounds={rounds}: {elapsed:.1f} ms")
+        if best is None or abs(elapsed - target_ms) < abs(best[1] - target_ms):
+            best = (rounds, elapsed)
+        if elapsed >= target_ms:
+            break
+    return {"BCRYPT_ROUNDS": best[0], "_verify_ms": best[1]}
+
+
+def calibrate_argon2(target_ms: float, samples: int, memory_kib: int, parallelism: int) -> dict:
+    """Фиксирует память и параллелизм, подбирает time_cost; если даже
+    time_cost=1 дольше target_ms - уменьшает память вдвое"""
+    while True:
+        elapsed = measure_verify_ms(
+            argon2.using(type="ID", time_cost=1, memory_cost=memory_kib, parallelism=parallelism),
+            samples
+        )
+        if elapsed <= target_ms or memory_kib <= 8 * parallelism * 2:
+            break
+        print(f"  argon2id m={memory_kib} KiB t=1: {elapsed:.1f} ms - уменьшаем память")
+        memory_kib //= 2
+
+    best = None
+    for time_cost in range(1, 64):
+        elapsed = measure_verify_ms(
+            argon2.using(type="ID", time_cost=time_cost, memory_cost=memory_kib, parallelism=parallelism),
+            samples
+        )
+        print(f"  argon2id m={memory_kib} KiB t={time_cost} p={parallelism}: {elapsed:.1f} ms")
+        if best is None or abs(elapsed - target_ms) < abs(best[1] - target_ms):
+            best = (time_cost, elapsed)
+        if elapsed >= target_ms:
+            break
+    return {
+        "ARGON2_TIME_COST": best[0],
+        "ARGON2_MEMORY_COST": memory_kib,
+        "ARGON2_PARALLELISM": parallelism,
+        "_verify_ms": best[1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Калибровка параметров хеширования паролей")
+    parser.add_argument("--target-ms", type=float, default=250.0,
+                        help="Желаемое время проверки пароля, мс (по умолчанию 250)")
+    parser.add_argument("--scheme", choices=["argon2", "bcrypt", "all"], default="all")
+    parser.add_argument("--samples", type=int, default=5, help="Замеров на каждую точку")
+    parser.add_argument("--argon2-memory-kib", type=int, default=65536,
+                        help="Стартовый объем памяти для argon2id, KiB (по умолчанию 64 MiB)")
+    parser.add_argument("--argon2-parallelism", type=int, default=min(os.cpu_count() or 1, 4))
+    args = parser.parse_args()
+
+    results = {}
+    if args.scheme in ("bcrypt", "all"):
+        print("Калибровка bcrypt...")
+        results["bcrypt"] = calibrate_bcrypt(args.target_ms, args.samples)
+    if args.scheme in ("argon2", "all"):
+        print("Калибровка argon2id...")
+        results["argon2"] = calibrate_argon2(
+            args.target_ms, args.samples, args.argon2_memory_kib, args.argon2_parallelism
+        )
+
+    print("-" * 50)
+    print(f"Цель: {args.target_ms:.0f} мс на проверку пароля")
+    for scheme, params in results.items():
+        print(f"\n# {scheme}: ~{params.pop('_verify_ms'):.1f} мс на проверку")
+        print(f"PASSWORD_HASH_SCHEME={scheme}")
+        for key, value in params.items():
+            print(f"{key}={value}")
+    print("\nДобавьте выбранные переменные в окружение auth-service (docker-compose.yml).")
+    print("Существующие хеши будут перехешированы при следующем успешном входе пользователя.")
+
+
+if __name__ == "__main__":
+    main()
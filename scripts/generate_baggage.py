@@ -27,11 +27,25 @@ baggage_locations = [
     "Delivered to Passenger"
 ]
 
-def generate_baggage_tag() -> str:
-    """Генерирует уникальный номер багажной бирки"""
-    letters = ''.join(random.choices(string.ascii_uppercase, k=3))
-    numbers = ''.join(random.choices(string.digits, k=6))
-    return f"{letters}{numbers}"
+# Размер блока номеров, резервируемого одним nextval('baggage_tag_seq') (см. init.sql)
+TAG_BLOCK_SIZE = 1000
+
+def generate_baggage_tag(serial: int) -> str:
+    """Номер бирки по схеме baggage-service: 3 буквы + 5 цифр + контрольная цифра (Luhn)"""
+    high, low = divmod(serial, 10 ** 5)
+    letters = ""
+    for _ in range(3):
+        high, d = divmod(high, 26)
+        letters = string.ascii_uppercase[d] + letters
+    body = f"{letters}{low:05d}"
+    digits = "".join(str(int(ch, 36)) for ch in body)
+    total = 0
+    for i, ch in enumerate(reversed(digits)):
+        d = int(ch)
+        if i % 2 == 0:
+            d = d * 2 - 9 if d > 4 else d * 2
+        total += d
+    return f"{body}{(10 - total % 10) % 10}"
 
 def create_baggage(count: int = 30):
     """Создает тестовые записи багажа"""
@@ -54,6 +68,7 @@ def create_baggage(count: int = 30):
             return []
 
         created_baggage = []
+        serial, block_end = 0, 0
         
         # Для каждого бронирования создаем 0-2 единицы багажа
         for booking_tuple in bookings:
@@ -61,13 +76,13 @@ def create_baggage(count: int = 30):
             baggage_count = random.randint(0, 2)  # 0, 1 или 2 единицы багажа
             
             for _ in range(baggage_count):
-                baggage_tag = generate_baggage_tag()
-                
-                # Проверяем уникальность бирки
-                cur.execute("SELECT id FROM baggage WHERE baggage_tag = %s", (baggage_tag,))
-                while cur.fetchone():
-                    baggage_tag = generate_baggage_tag()
-                    cur.execute("SELECT id FROM baggage WHERE baggage_tag = %s", (baggage_tag,))
+                # Номера из зарезервированного блока уникальны, проверять их не нужно
+                if serial >= block_end:
+                    cur.execute("SELECT nextval('baggage_tag_seq')")
+                    serial = cur.fetchone()[0]
+                    block_end = serial + TAG_BLOCK_SIZE
+                baggage_tag = generate_baggage_tag(serial)
+                serial += 1
                 
                 # Генерируем вес (от 5 до 32 кг)
                 weight = round(random.uniform(5.0, 32.0), 2)
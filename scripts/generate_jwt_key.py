@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Скрипт для ротации ключей подписи JWT (RS256)
+Использование: python generate_jwt_key.py <JWT_KEYS_DIR> [--keep 2]
+
+Создает новый приватный ключ <kid>.pem; после перезапуска auth-service
+подписывает им новые токены. Старые ключи остаются в JWKS, пока не истекут
+выданные ими токены, поэтому удаляются только ключи сверх --keep.
+"""
+
+import argparse
+import os
+from datetime import datetime
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ротация ключей подписи JWT")
+    parser.add_argument("keys_dir", help="Каталог с ключами (JWT_KEYS_DIR auth-service)")
+    parser.add_argument("--keep", type=int, default=2,
+                        help="Сколько последних ключей оставить (по умолчанию 2)")
+    args = parser.parse_args()
+
+    os.makedirs(args.keys_dir, exist_ok=True)
+    kid = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    path = os.path.join(args.keys_dir, f"{kid}.pem")
+    with open(path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ))
+    os.chmod(path, 0o600)
+    print(f"✓ Создан ключ {kid}: {path}")
+
+    keys = sorted(name for name in os.listdir(args.keys_dir) if name.endswith(".pem"))
+    for name in keys[:-args.keep] if args.keep > 0 else []:
+        os.remove(os.path.join(args.keys_dir, name))
+        print(f"✗ Удален старый ключ {name[:-len('.pem')]}")
+
+    print("\nПерезапустите auth-service, чтобы начать подписывать токены новым ключом.")
+
+
+if __name__ == "__main__":
+    main()
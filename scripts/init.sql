@@ -1,5 +1,8 @@
 -- Создание таблиц для всех микросервисов
 
+-- Триграммный поиск (нечеткий поиск багажа в Baggage Service)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 -- Пользователи (Auth Service)
 CREATE TABLE IF NOT EXISTS users (
     id SERIAL PRIMARY KEY,
@@ -33,6 +36,8 @@ CREATE TABLE IF NOT EXISTS flights (
     total_seats INTEGER NOT NULL,
     available_seats INTEGER NOT NULL,
     price DECIMAL(10, 2) NOT NULL,
+    -- scheduled, cancelled: отмененный рейс не удаляется, чтобы сохранить бронирования и возвраты
+    status VARCHAR(20) DEFAULT 'scheduled',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -55,9 +60,58 @@ CREATE TABLE IF NOT EXISTS baggage (
     weight DECIMAL(5, 2),
     status VARCHAR(50) DEFAULT 'checked_in',
     location VARCHAR(255),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_event_at TIMESTAMP
+);
+
+-- Текущий статус багажа - материализованное последнее событие; статус и локация
+-- не индексируются, так что с запасом места на странице обновления идут как HOT
+ALTER TABLE baggage SET (fillfactor = 80);
+
+-- История событий багажа (Baggage Service): только добавление, секции по месяцам.
+-- Старые секции отсоединяются и удаляются целиком (scripts/manage_baggage_partitions.py)
+-- вместо DELETE, поэтому не оставляют мертвых строк для VACUUM
+CREATE TABLE IF NOT EXISTS baggage_events (
+    id BIGSERIAL,
+    baggage_id INTEGER NOT NULL,
+    baggage_tag VARCHAR(50) NOT NULL,
+    status VARCHAR(50) NOT NULL,
+    location VARCHAR(255),
+    source VARCHAR(20) NOT NULL,
+    occurred_at TIMESTAMP NOT NULL,
+    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, occurred_at)
+) PARTITION BY RANGE (occurred_at);
+
+CREATE TABLE IF NOT EXISTS baggage_events_default PARTITION OF baggage_events DEFAULT;
+
+DO $$
+DECLARE
+    month_start DATE;
+BEGIN
+    FOR i IN 0..2 LOOP
+        month_start := (date_trunc('month', CURRENT_DATE) + make_interval(months => i))::date;
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS baggage_events_%s PARTITION OF baggage_events FOR VALUES FROM (%L) TO (%L)',
+            to_char(month_start, 'YYYY_MM'), month_start, (month_start + INTERVAL '1 month')::date
+        );
+    END LOOP;
+END $$;
+
+-- Итоги багажа по рейсам и статусам (Baggage Service): обновляются в той же транзакции,
+-- что и смена статуса багажа; пересчитываются baggage-service/scripts/rebuild_flight_baggage_totals.py
+CREATE TABLE IF NOT EXISTS flight_baggage_totals (
+    flight_id INTEGER NOT NULL,
+    status VARCHAR(50) NOT NULL,
+    bags INTEGER NOT NULL DEFAULT 0,
+    weight DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (flight_id, status)
 );
 
+-- Номера багажных бирок (Baggage Service): каждый nextval резервирует за процессом
+-- блок из 1000 номеров (BAGGAGE_TAG_BLOCK_SIZE в baggage-service)
+CREATE SEQUENCE IF NOT EXISTS baggage_tag_seq START WITH 0 MINVALUE 0 INCREMENT BY 1000;
+
 -- Платежи (Payment Service)
 CREATE TABLE IF NOT EXISTS payments (
     id SERIAL PRIMARY KEY,
@@ -70,7 +124,31 @@ CREATE TABLE IF NOT EXISTS payments (
     status VARCHAR(20) DEFAULT 'pending',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     completed_at TIMESTAMP,
-    refund_id VARCHAR(100)
+    refund_id VARCHAR(100),
+    refunded_at TIMESTAMP
+);
+
+-- Дневные агрегаты выручки (Payment Service): обновляются при завершении и возврате платежа,
+-- первоначально заполняются payment-service/scripts/backfill_revenue_rollups.py
+CREATE TABLE IF NOT EXISTS revenue_daily (
+    day DATE NOT NULL,
+    origin VARCHAR(100) NOT NULL,
+    destination VARCHAR(100) NOT NULL,
+    currency VARCHAR(3) NOT NULL,
+    payment_method VARCHAR(50) NOT NULL,
+    payments_count INTEGER NOT NULL DEFAULT 0,
+    gross_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    refunds_count INTEGER NOT NULL DEFAULT 0,
+    refunded_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, origin, destination, currency, payment_method)
+);
+
+-- Обработанные события вебхуков платежного шлюза (Payment Service)
+CREATE TABLE IF NOT EXISTS gateway_webhook_events (
+    event_id VARCHAR(100) PRIMARY KEY,
+    payment_id VARCHAR(100) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Создание индексов для оптимизации
@@ -80,7 +158,20 @@ CREATE INDEX IF NOT EXISTS idx_bookings_flight_id ON bookings(flight_id);
 CREATE INDEX IF NOT EXISTS idx_flights_departure ON flights(departure_time);
 CREATE INDEX IF NOT EXISTS idx_baggage_booking_id ON baggage(booking_id);
 CREATE INDEX IF NOT EXISTS idx_baggage_tag ON baggage(baggage_tag);
+CREATE INDEX IF NOT EXISTS idx_baggage_events_tag ON baggage_events(baggage_tag, occurred_at);
+-- Нечеткий поиск потерянного багажа (GET /baggage/search): кандидаты по похожести бирки
+-- и имени пассажира находятся по триграммным индексам без полного просмотра
+CREATE INDEX IF NOT EXISTS idx_baggage_tag_trgm ON baggage USING gin (baggage_tag gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_name_trgm ON users USING gin ((first_name || ' ' || last_name) gin_trgm_ops);
 CREATE INDEX IF NOT EXISTS idx_payments_booking_id ON payments(booking_id);
-CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments(user_id);
+-- История платежей пользователя (GET /payments): keyset-пагинация по (created_at, id).
+-- INCLUDE покрывает все возвращаемые поля, так что страница читается index-only scan,
+-- в том числе с фильтром ?status=. HOT-обновления тут ничего не теряют: каждый UPDATE
+-- payments меняет status, который уже входит в условие idx_payments_booking_active.
+-- Индекс начинается с user_id и заменяет отдельный индекс по user_id
+CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments(user_id, created_at, id)
+    INCLUDE (booking_id, payment_id, amount, currency, payment_method, status, completed_at, refund_id);
 CREATE INDEX IF NOT EXISTS idx_payments_payment_id ON payments(payment_id);
+-- Не больше одного активного (ожидающего или завершенного) платежа на бронирование (защита от двойной оплаты)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_booking_active ON payments(booking_id) WHERE status IN ('pending', 'completed');
 
@@ -0,0 +1,51 @@
+"""Local verification of auth-service tokens.
+
+HS* tokens are checked with the shared secret. For RS256 the public keys
+published by auth-service (/.well-known/jwks.json) are cached; a token with
+an unknown kid refetches them at most once per refresh_interval, which is how
+key rotation reaches the services.
+"""
+
+import time
+
+import httpx
+from jose import JWTError, jwt
+
+
+class TokenVerifier:
+    def __init__(self, algorithm: str, secret: str, jwks_url: str, refresh_interval: float = 60):
+        self.algorithm = algorithm
+        self.secret = secret
+        self.jwks_url = jwks_url
+        self.refresh_interval = refresh_interval
+        self.keys: dict = {}
+        self.fetched_at = 0.0
+
+    async def refresh(self):
+        """Fetch the auth-service public key set (kid -> JWK)"""
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await client.get(self.jwks_url, timeout=5.0)
+                response.raise_for_status()
+            self.keys = {key["kid"]: key for key in response.json()["keys"]}
+        except Exception as e:
+            print(f"Failed to fetch JWKS: {e}")
+        self.fetched_at = time.monotonic()
+
+    async def load(self):
+        """Startup hook: prefetch the key set unless tokens use a shared secret"""
+        if not self.algorithm.startswith("HS"):
+            await self.refresh()
+
+    async def decode(self, token: str) -> dict:
+        """Verify a JWT locally: shared secret for HS*, cached JWKS otherwise"""
+        if self.algorithm.startswith("HS"):
+            return jwt.decode(token, self.secret, algorithms=[self.algorithm])
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self.keys.get(kid)
+        if key is None and time.monotonic() - self.fetched_at > self.refresh_interval:
+            await self.refresh()
+            key = self.keys.get(kid)
+        if key is None:
+            raise JWTError("Unknown signing key")
+        return jwt.decode(token, key, algorithms=[self.algorithm])
@@ -0,0 +1,43 @@
+"""Minimal PDF writing shared by payment receipts and baggage labels.
+
+Only the base-14 Helvetica fonts are used, so text is transliterated and
+encoded in WinAnsi (cp1252) instead of embedding a font.
+"""
+
+import unicodedata
+from typing import List
+
+CYRILLIC_TRANSLIT = dict(zip(
+    "абвгдеёжзийклмнопрстуфхцчшщъыьэюя",
+    ["a", "b", "v", "g", "d", "e", "e", "zh", "z", "i", "y", "k", "l", "m", "n", "o", "p",
+     "r", "s", "t", "u", "f", "kh", "ts", "ch", "sh", "shch", "", "y", "", "e", "yu", "ya"]
+))
+
+
+def transliterate(ch: str) -> str:
+    latin = CYRILLIC_TRANSLIT.get(ch.lower())
+    if latin is None:
+        return ch
+    return latin.capitalize() if ch.isupper() else latin
+
+
+def pdf_text(value) -> bytes:
+    """Escape a value for a PDF string in WinAnsi (base-14 fonts have no Cyrillic)"""
+    value = "".join(transliterate(ch) for ch in str(value if value is not None else "N/A"))
+    value = "".join(ch for ch in unicodedata.normalize("NFKD", value) if not unicodedata.combining(ch))
+    encoded = value.encode("cp1252", errors="replace")
+    return encoded.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def write_pdf(objects: List[bytes]) -> bytes:
+    """PDF file from its objects (numbered from 1, the first is the catalog) with the xref table"""
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(pdf)